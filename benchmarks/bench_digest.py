@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the speed of the digest algorithms on a directory tree.
+
+Usage:
+
+    python benchmarks/bench_digest.py [DIRECTORY]
+
+Without a directory a synthetic tree of 2000 files (about 400MB) is generated
+in a temporary directory.
+"""
+from derex.builder import digest
+from derex.builder.builders import base
+from derex.builder.session import BuildSession
+from tempfile import TemporaryDirectory
+
+import os
+import sys
+import time
+
+
+def make_tree(root: str, files: int = 2000, size: int = 200 * 1024):
+    for index in range(files):
+        directory = os.path.join(root, f"dir{index % 20}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{index}"), "wb") as fileobj:
+            fileobj.write(os.urandom(size))
+
+
+def bench(root: str, rounds: int = 3):
+    total = sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, _, names in os.walk(root)
+        for name in names
+    )
+    print(f"{root}: {total / 2 ** 20:.1f} MiB")
+    for algorithm in digest.ALGORITHMS:
+        timings = []
+        for _ in range(rounds):
+            # A fresh session for every round: measure hashing, not the cache
+            session = BuildSession(hash_algorithm=algorithm)
+            start = time.perf_counter()
+            base.get_dir_hash(root, session=session)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print(
+            f"{algorithm:>8}: {best:.3f}s best of {rounds} "
+            f"({total / 2 ** 20 / best:.0f} MiB/s)"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench(sys.argv[1])
+    else:
+        with TemporaryDirectory() as tmpdir:
+            make_tree(tmpdir)
+            bench(tmpdir)
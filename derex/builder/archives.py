@@ -0,0 +1,140 @@
+"""Export images to, and import them from, directories of OCI image layouts.
+
+An export directory contains one OCI image layout per image and a
+`derex-images.json` file mapping image names to layouts:
+
+    export/
+        derex-images.json
+        blobs/sha256/...            <- shared pool of deduplicated blobs
+        derextests_hello_world_0123456789/
+            oci-layout
+            index.json
+            blobs/sha256/...        <- hard links into the shared pool
+
+Layers shared between images are stored only once. The directory can be
+moved around as is, or packed with tar. Builders import their image from the
+export in DEREX_IMPORT_DIR (the `import_dir` of their session) if it's there.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from derex.builder import logger
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import json
+import os
+import re
+
+
+MANIFEST = "derex-images.json"
+COMPRESSION_FORMATS = ("zstd", "gzip")
+
+
+def layout_name(dest: str) -> str:
+    """Return a file system friendly name for the given image.
+    """
+    return re.sub(r"[^a-zA-Z0-9._-]", "_", dest)
+
+
+def read_manifest(directory: str) -> Dict[str, str]:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as fileobj:
+        return json.load(fileobj)["images"]
+
+
+def export_images(
+    builders: List,
+    directory: str,
+    compression: str = "zstd",
+    level: Optional[int] = None,
+    jobs: int = 4,
+) -> Dict[str, str]:
+    """Resolve the images of the given builders and write them to `directory`.
+    Images are compressed concurrently, up to `jobs` at a time.
+    Returns a mapping from image names to layout directories.
+    """
+    if compression not in COMPRESSION_FORMATS:
+        raise ValueError(f"Unsupported compression format: {compression}")
+    os.makedirs(directory, exist_ok=True)
+    for builder in builders:
+        builder.resolve()
+    compression_opts = ["--compression-format", compression]
+    if level is not None:
+        compression_opts += ["--compression-level", str(level)]
+
+    def export(builder) -> str:
+        name = layout_name(builder.dest)
+        logger.info(f"Exporting {builder.dest} to {name}")
+        target = f"oci:{os.path.join(directory, name)}:{name}"
+        builder.buildah("push", *compression_opts, builder.dest, target)
+        return name
+
+    images = read_manifest(directory)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        names = list(executor.map(export, builders))
+    images.update(zip((builder.dest for builder in builders), names))
+    try:
+        saved = deduplicate_blobs(directory, sorted(set(images.values())))
+    except OSError as err:  # Layouts pushed through sudo belong to root
+        logger.warning(f"Not deduplicating shared layers: {err!r}")
+    else:
+        logger.info(f"Deduplicated {saved / 2 ** 20:.1f} MiB of shared layers")
+    with open(os.path.join(directory, MANIFEST), "w") as fileobj:
+        json.dump({"images": images}, fileobj, indent=2, sort_keys=True)
+    return images
+
+
+def deduplicate_blobs(directory: str, layouts: List[str]) -> int:
+    """Replace blobs found in more than one layout with hard links to a single
+    copy in the shared `blobs` directory. Returns the number of bytes saved.
+    Raises OSError if the layouts can't be changed, like when they were written
+    by root through sudo: the export is still complete, only larger.
+    """
+    saved = 0
+    for layout in layouts:
+        blobs_dir = os.path.join(directory, layout, "blobs")
+        for root, _, files in os.walk(blobs_dir):
+            algorithm = os.path.relpath(root, blobs_dir)
+            pool = os.path.join(directory, "blobs", algorithm)
+            os.makedirs(pool, exist_ok=True)
+            for name in files:
+                blob, shared = os.path.join(root, name), os.path.join(pool, name)
+                if not os.path.exists(shared):
+                    os.link(blob, shared)
+                elif not os.path.samefile(blob, shared):
+                    saved += os.path.getsize(blob)
+                    temporary = blob + ".tmp"
+                    os.link(shared, temporary)
+                    try:
+                        os.replace(temporary, blob)
+                    finally:
+                        if os.path.exists(temporary):
+                            os.unlink(temporary)
+    return saved
+
+
+def import_image(builder, directory: str) -> bool:
+    """Load the image of `builder` from the export in `directory`, if present.
+    Returns True on success.
+    """
+    name = read_manifest(directory).get(builder.dest)
+    if name is None:
+        return False
+    logger.info(f"Importing {builder.dest} from {directory}")
+    source = f"oci:{os.path.join(directory, name)}:{name}"
+    image_id = builder.buildah("pull", "--quiet", source, print_output=False)
+    builder.buildah("tag", image_id.split()[-1], builder.dest)
+    return True
+
+
+def import_images(builders: List, directory: str) -> List[str]:
+    """Load all images found in `directory` that belong to the given builders
+    and are not available locally yet. Returns the list of imported images.
+    """
+    imported = []
+    for builder in builders:
+        if not builder.available_buildah() and import_image(builder, directory):
+            imported.append(builder.dest)
+    return imported
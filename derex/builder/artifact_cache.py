@@ -0,0 +1,119 @@
+"""A content addressed cache of built images on a (possibly shared) file system.
+
+Set DEREX_ARTIFACT_CACHE to a directory, for instance on an NFS volume shared by
+several build hosts. Images are stored there as OCI archives named after their
+tag once built, and `resolve()` loads them from there instead of building them
+again. DEREX_ARTIFACT_CACHE_SIZE caps the size of the cache (default 20G):
+the least recently used archives are evicted first.
+Both are settings of the build session: see `derex.builder.session`.
+"""
+from derex.builder import logger
+from derex.builder.archives import layout_name
+from typing import Optional
+from uuid import uuid4
+
+import os
+import time
+
+
+SUFFIX = ".tar"
+STALE_TEMPORARY_FILE = 24 * 3600  # Seconds after which a partial write is removed
+UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_size(size: str) -> int:
+    """Parse sizes like `500M` or `20G` into a number of bytes.
+    """
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in UNITS else ""
+    return int(float(size[: len(size) - len(unit)]) * UNITS[unit])
+
+
+def archive_path(dest: str, directory: str) -> str:
+    return os.path.join(directory, layout_name(dest) + SUFFIX)
+
+
+def fetch(builder, directory: Optional[str] = None) -> bool:
+    """Load the image of `builder` from the cache, the one of its session
+    unless `directory` is given. Returns True on success.
+    """
+    path = archive_path(builder.dest, directory or builder.session.artifact_cache)
+    if not os.path.isfile(path):
+        return False
+    logger.info(f"Loading {builder.dest} from {path}")
+    try:
+        image_id = builder.buildah(
+            "pull", "--quiet", f"oci-archive:{path}", print_output=False
+        )
+    except (OSError, RuntimeError):  # Possibly evicted under our feet
+        logger.warning(f"Could not load {path}")
+        return False
+    builder.buildah("tag", image_id.split()[-1], builder.dest)
+    try:
+        os.utime(path)  # Mark as recently used
+    except OSError:  # Written by root through sudo, or evicted meanwhile
+        logger.debug(f"Could not mark {path} as recently used")
+    return True
+
+
+def store(builder, directory: Optional[str] = None, limit: Optional[int] = None):
+    """Save the image of `builder` into the cache, the one of its session
+    unless `directory` is given, then evict old entries.
+    The archive is written to a temporary file and renamed into place,
+    so readers never see a partial archive.
+    """
+    directory = directory or builder.session.artifact_cache
+    path = archive_path(builder.dest, directory)
+    if os.path.isfile(path):
+        return
+    temporary = os.path.join(
+        directory, f".{os.path.basename(path)}.{os.getpid()}.{uuid4().hex}.tmp"
+    )
+    logger.info(f"Storing {builder.dest} in {path}")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        builder.buildah(
+            "push",
+            *builder.compression_opts(),
+            builder.dest,
+            f"oci-archive:{temporary}:{builder.dest}",
+        )
+        os.replace(temporary, path)
+    except (OSError, RuntimeError) as err:
+        # The image was built anyway: a failure here should not fail the build
+        logger.warning(f"Could not store {builder.dest} in {directory}: {err!r}")
+        return
+    finally:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+    evict(directory, builder.session.artifact_cache_size if limit is None else limit)
+
+
+def evict(directory: str, limit: int) -> int:
+    """Remove the least recently used archives until the cache is smaller
+    than `limit` bytes. Returns the number of bytes freed.
+    """
+    entries = []
+    now = time.time()
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > STALE_TEMPORARY_FILE:
+                    os.unlink(entry.path)
+            elif entry.name.endswith(SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:  # Removed by another host
+            continue
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total - freed <= limit:
+            break
+        logger.info(f"Evicting {path} from the artifact cache")
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        freed += size
+    return freed
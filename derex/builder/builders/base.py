@@ -2,23 +2,44 @@
 """
 from abc import ABC
 from abc import abstractmethod
+from derex.builder import archives
+from derex.builder import artifact_cache
+from derex.builder import copy_engine
+from derex.builder import digest
+from derex.builder import digests
+from derex.builder import docker_daemon
+from derex.builder import fingerprint
+from derex.builder import history
 from derex.builder import logger
-from functools import lru_cache
+from derex.builder import metrics
+from derex.builder import prefetch
+from derex.builder import resources
+from derex.builder.ignore import is_excluded
+from derex.builder.ignore import load_patterns
+from derex.builder.locks import build_lock
+from derex.builder.session import BuildSession
+from derex.builder.session import current_generation
+from derex.builder.session import get_session
+from derex.builder.session import invalidate_inventories
 from functools import partial
-from jsonschema import validate
+from jsonschema.validators import validator_for
 from pathlib import Path
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import Union
 from urllib.error import HTTPError
-from zope.dottedname.resolve import resolve
+from urllib.error import URLError
 
-import hashlib
 import json
 import os
 import re
 import subprocess
+import threading
+import time
 import urllib.request
 import yaml
 
@@ -28,6 +49,16 @@ CACHES = {
     "/var/cache/apk": "APK_CACHE",
     "/root/.npm": "NPM_CACHE",
 }
+# Commands that alter the local store invalidate the image inventory right away
+INVENTORY_MUTATING_COMMANDS = ("commit", "from", "pull", "rmi", "tag")
+
+# Compiled JSON schema validators. The file hash, image inventory and registry
+# caches belong to the build session: see `derex.builder.session`.
+VALIDATORS: Dict[int, Any] = {}
+CACHES_LOCK = threading.Lock()
+
+# Removes the `remove` paths of the `commit` section. Patterns are expanded by the shell.
+REMOVE_SCRIPT = 'for pattern in "$@"; do rm -rf -- $pattern; done'
 
 
 class BaseBuilder(ABC):
@@ -35,6 +66,10 @@ class BaseBuilder(ABC):
     """
 
     _dest = None
+    # The name of the matrix variant this builder builds, if any
+    variant: Optional[str] = None
+    # The session holding the caches and containers this builder uses
+    session: BuildSession
 
     @property
     def dest(self):
@@ -42,14 +77,18 @@ class BaseBuilder(ABC):
             self._dest = f'{self.conf["dest"]}:{self.docker_tag()}'
         return self._dest
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, session: Optional[BuildSession] = None):
         """
         :param file_path: A path to a directory containing a spec yaml file and other support files.
+        :param session: The build session to use, the default one if not given.
         """
         logger.debug(f"Instantiating builder for {path}")
+        self.session = session or get_session()
+        self.pinned: Dict[str, str] = {}
         self.path = self.sanitize_path(path)
         self.conf = load_conf(path)
         self.validate()
+        self.exclude = load_patterns(self.path, self.conf)
 
     def sanitize_path(self, path: str) -> str:
         """Makes sure a path is valid and points to a directory.
@@ -60,9 +99,29 @@ class BaseBuilder(ABC):
         return path
 
     def validate(self):
-        """Check that all resources referenced from the yaml file actually exist.
+        """Check the yaml configuration against the builder's JSON schema.
+        `derex.builder.validation` also checks the resources it references.
+        """
+        get_validator(self.json_schema).validate(self.conf)
+
+    def input_hashes(self) -> Dict[str, str]:
+        """Return a hash for every input of the build, by name, so that
+        `derex.builder.plan` can tell which ones changed since the last build.
+        Concrete classes should override this method.
         """
-        validate(self.conf, self.json_schema)
+        return {"conf": self.hash_conf()}
+
+    def required_files(self) -> List[str]:
+        """Return the files and directories, relative to the spec directory,
+        the build needs. Concrete classes should override this method.
+        """
+        return []
+
+    def resource_budget(self) -> Dict[str, Any]:
+        """Return the `resources` section of the spec, completed with
+        the defaults of the session.
+        """
+        return dict(self.session.resources, **self.conf.get("resources", {}))
 
     @abstractmethod
     def build(self):
@@ -79,20 +138,100 @@ class BaseBuilder(ABC):
 
     def resolve(self):
         """Try to pull or build the image if not already present.
+        Other processes on this host resolving the same image are serialized
+        with a file lock: the ones that have to wait reuse the finished image.
         """
-        if not self.available_buildah():
-            logger.debug(f"Image {self.dest} not found locally")
-            if self.available_docker_registry():
-                logger.info(f"Pulling {self.dest} from docker registry")
+        variants = self.variants()
+        if variants:
+            for variant in variants:
+                variant.resolve()
+            return
+        if self.available_buildah():
+            logger.info(f"{self.dest} found locally")
+            metrics.inc("resolutions_total", spec=self.conf["dest"], outcome="local")
+            return
+        logger.debug(f"Image {self.dest} not found locally")
+        with build_lock(self.dest):
+            outcome = self.resolve_unavailable()
+        metrics.inc("resolutions_total", spec=self.conf["dest"], outcome=outcome)
+
+    def resolve_unavailable(self) -> str:
+        """Get the image from the first place that has it, or build it.
+        Returns where the image came from.
+        """
+        if self.available_buildah(refresh=True):
+            logger.info(f"{self.dest} was made available by another process")
+            return "waited"
+        if self.import_archive():
+            logger.info(f"Imported {self.dest} from {self.session.import_dir}")
+            return "import"
+        if self.session.artifact_cache and artifact_cache.fetch(self):
+            logger.info(f"Loaded {self.dest} from the artifact cache")
+            return "cache"
+        if self.available_docker_registry():
+            logger.info(f"Pulling {self.dest} from docker registry")
+            with history.timed(self, "pull"):
                 self.buildah("pull", f"docker.io/{self.dest}")
                 self.buildah("tag", f"docker.io/{self.dest}", f"{self.dest}")
-            else:
-                logger.info(f"Building {self.dest}")
+            return "registry"
+        # Resolve dependencies first, so they don't count in our build time
+        for dependency in self.dependencies():
+            dependency.resolve()
+        budget = resources.budget(self.resource_budget())
+        with resources.admit(self.dest, *budget):
+            logger.info(f"Building {self.dest}")
+            with history.timed(self, "build"):
                 self.build()
+        history.record_inputs(history.name_of(self), self.dest, self.input_hashes())
+        if self.session.artifact_cache:
+            artifact_cache.store(self)
+        return "built"
+
+    def locate(self, check_registry: bool = True) -> Optional[str]:
+        """Tell where `resolve_unavailable` would get the image from without
+        building it: "local", "import", "cache" or "registry". Returns None
+        if it has to be built. Nothing is pulled or loaded.
+        Without `check_registry` only cached answers of the registry are used.
+        """
+        if self.available_buildah():
+            return "local"
+        import_dir, cache = self.session.import_dir, self.session.artifact_cache
+        if import_dir and self.dest in archives.read_manifest(import_dir):
+            return "import"
+        if cache and os.path.isfile(artifact_cache.archive_path(self.dest, cache)):
+            return "cache"
+        if check_registry:
+            found = self.available_docker_registry()
         else:
-            logger.info(f"{self.dest} found locally")
+            with self.session.lock:
+                cached = self.session.registry_cache.get(self.dest)
+            found = cached is not None and cached[0]
+        return "registry" if found else None
 
-    def available_docker_registry(self):
+    def import_archive(self) -> bool:
+        """Load the image from the import directory of the session, if it's there.
+        """
+        if not self.session.import_dir:
+            return False
+        return archives.import_image(self, self.session.import_dir)
+
+    def available_docker_registry(self) -> bool:
+        """Returns True if the image is available on the docker registry.
+        Answers are cached in the registry cache of the session.
+        """
+        dest, session = self.dest, self.session
+        with session.lock:
+            cached = session.registry_cache.get(dest)
+        if cached is not None:
+            found, timestamp = cached
+            if found or time.time() - timestamp < session.registry_ttl:
+                return found
+        found = bool(self.query_docker_registry())
+        with session.lock:
+            session.registry_cache[dest] = (found, time.time())
+        return found
+
+    def query_docker_registry(self):
         # TODO: refator so this is available without calling `split`
         image_name = self.dest.split(":")[0]
 
@@ -107,30 +246,51 @@ class BaseBuilder(ABC):
         except HTTPError as e:
             logger.error(e)
             return False
+        except URLError as e:  # Offline: the image will be built
+            logger.warning(f"Could not reach the docker registry: {e.reason}")
+            return False
         parsed_response = json.loads(response.read())
         if self.docker_tag() in parsed_response["tags"]:
             logger.debug(f"Found {self.dest} on docker registry")
             return True
 
-    def available_buildah(self) -> bool:
+    def available_buildah(self, refresh: bool = False) -> bool:
         """Returns True if an image generated with this builder can be found in the local buildah registry.
+        If the images can't be listed the image is reported missing: the build
+        will report the actual problem.
         """
-        if self.dest in self.list_buildah_images():
+        try:
+            images = self.list_buildah_images(refresh=refresh, session=self.session)
+        except (OSError, RuntimeError) as err:
+            logger.warning(f"Could not list the local images: {err!r}")
+            return False
+        if self.dest in images:
             return True
         logger.debug(f"{self.dest} could not be found localy")
         return False
 
     @classmethod
-    def list_buildah_images(cls) -> List[str]:
-        """Returns a list of all images locally available to buildah
+    def list_buildah_images(
+        cls, refresh: bool = False, session: Optional[BuildSession] = None
+    ) -> List[str]:
+        """Returns a list of all images locally available to buildah.
+        The list is cached in the session (the default one if not given)
+        for its `inventory_ttl` seconds, unless `refresh` is True.
         """
+        session = session or get_session()
+        cached = session.cached_images()
+        if cached is not None and not refresh:
+            return cached
+        generation = current_generation()
         # Get a list of all images
         images = json.loads(cls.buildah("images", "--json", print_output=False))
         # Collect all their tags
         tags = sum((el["names"] for el in images if el["names"]), [])
 
         # Remove the first path component from image names
-        return sorted([tag.split("/", 1)[1] for tag in tags])
+        result = sorted([tag.split("/", 1)[1] for tag in tags])
+        session.store_images(result, generation)
+        return list(result)
 
     @classmethod
     def buildah(cls, *args: str, print_output=True) -> str:
@@ -140,33 +300,39 @@ class BaseBuilder(ABC):
         if os.getuid() != 0:
             cmd = ["sudo"] + cmd
         res: List[str] = []
-        for line in cls.run(cmd + list(args)):
-            if print_output:
-                logger.info(line.rstrip())
-            res += [line]
+        command = args[0] if args else ""
+        metrics.inc("buildah_calls_total", command=command)
+        try:
+            with metrics.timer("buildah_seconds_total", command=command):
+                for line in cls.run(cmd + list(args)):
+                    if print_output:
+                        logger.info(line.rstrip())
+                    res += [line]
+        finally:
+            if args and args[0] in INVENTORY_MUTATING_COMMANDS:
+                invalidate_inventories()
         return "".join(res).rstrip()
 
-    @classmethod
     def buildah_run(
-        cls, container: str, args: List[str], extra_args: Union[List[str], Tuple] = ()
+        self, container: str, args: List[str], extra_args: Union[List[str], Tuple] = ()
     ):
         """Runs a command inside the container after adding cache directories.
         """
-        caches = cls.ensure_caches()
+        caches = self.ensure_caches()
         volumes: List[str] = []
         for source, dest in caches.items():
             volumes += ["-v", f"{source}:{dest}"]
-        return cls.buildah(
+            metrics.mounted_cache(CACHES.get(dest, dest), source)
+        return self.buildah(
             *(["run"] + list(extra_args) + volumes + [container] + list(args))
         )
 
-    @classmethod
-    def ensure_caches(cls):
-        """Make sure the cache directories exist.
+    def ensure_caches(self):
+        """Make sure the cache directories of the session exist.
         """
         caches = {}
-        for dest, varname in CACHES.items():
-            source = os.environ.get(varname)
+        for dest, source in self.session.caches.items():
+            varname = CACHES.get(dest, "session")
             if source:
                 if not os.path.isdir(source):
                     logger.warning(f"Creating cache directory {source}")
@@ -204,20 +370,27 @@ class BaseBuilder(ABC):
 
     def docker_tag(self) -> str:
         """Returns a string usable as docker tag, derived from the hash.
+        The tag is prefixed with the tag scheme of the hash algorithm in use.
         """
-        return self.hash()[:10]
+        return digest.tag_prefix(self.session.hash_algorithm) + self.hash()[:10]
 
     def hash_conf(self) -> str:
         """Return a hash representing this builder's config.
         The hash is constructed after parsing the file, so comments
         or key ordering is not relevant to hashing
         """
-        return self.mkhash(json.dumps(self.conf, sort_keys=True))
+        return self.mkhash(json.dumps(self.hashed_conf(), sort_keys=True))
+
+    def hashed_conf(self) -> Dict[str, Any]:
+        """Return the configuration that makes up the image: resource budgets
+        change how it's built, not what's built.
+        """
+        return {key: value for key, value in self.conf.items() if key != "resources"}
 
     def mkhash(self, input: Union[str, bytes]) -> str:
-        """Given a string, calculate its hash.
+        """Given a string, calculate its hash with the algorithm of the session.
         """
-        m = hashlib.sha256()
+        m = digest.new(self.session.hash_algorithm)
         if isinstance(input, str):
             m.update(input.encode("utf-8"))
         else:
@@ -227,12 +400,30 @@ class BaseBuilder(ABC):
     def hash_files(self, files: List[str]):
         """Given a list of files or directories relative to the spec.yaml file,
         return a hash based on their contents.
+        Files in directories matching the exclude patterns are left out.
+        With the "git" fingerprint the object IDs in the git index are used
+        for clean tracked files, instead of reading them.
         """
+        if self.session.fingerprint == "git":
+            hashes = fingerprint.git_hashes(
+                self.path, list(files), self.exclude, self.session.hash_algorithm
+            )
+            if hashes is not None:
+                return self.mkhash("\n".join(hashes))
+            logger.debug(f"{self.path} is not in a git work tree: hashing from disk")
         file_paths = tuple(map(partial(Path, self.path), files))
-        text_hashes = [
-            self.mkhash(path.read_bytes()) for path in file_paths if path.is_file()
+        hash_path = partial(hash_file, session=self.session)
+        text_hashes = [hash_path(path) for path in file_paths if path.is_file()]
+        dir_hashes = [
+            get_dir_hash(
+                str(path),
+                excluded_patterns=self.exclude,
+                root=self.path,
+                session=self.session,
+            )
+            for path in file_paths
+            if path.is_dir()
         ]
-        dir_hashes = [get_dir_hash(str(path)) for path in file_paths if path.is_dir()]
         return self.mkhash("\n".join(text_hashes + dir_hashes))
 
     @classmethod
@@ -246,45 +437,204 @@ class BaseBuilder(ABC):
                 f'Unknown type: {source["type"]}'
             )  # pragma: no cover
 
-    @classmethod
-    def resolve_base_image(cls, source: Union[str, Dict], path: str) -> str:
+    def resolve_base_image(self, source: Union[str, Dict], path: str) -> str:
         """Makes sure the base image is available and returns its name.
+        Images from a registry are pinned to their digest if the session says so.
         """
         if not isinstance(source, str):
-            return cls.get_source_target(source, path, resolve=True)
+            return self.get_source_target(source, path, resolve=True)
         else:  # The source is a string, so it should be available in the docker hub
-            return source  # We might pull the image here
+            image = self.pin(source)
+            prefetch.wait(image)  # It might be downloading in the background
+            return image
 
-    @classmethod
     def get_source_target(
-        cls, source: Union[str, Dict], path: str, resolve=False
+        self, source: Union[str, Dict], path: str, resolve=False
     ) -> str:
         """Given a source specification and the path returns the target
-        of the pointed builder.
-        # TODO this should be a function, not an abstract method?
+        of the pointed builder, created in the same session.
+        Images from a registry are pinned to their digest if the session says so.
         """
         if not isinstance(source, str):
-            builder = create_builder(cls.resolve_source_path(source, path))
+            builder = self.session.create_builder(
+                self.resolve_source_path(source, path), source.get("variant")
+            )
+            if builder.variants():
+                raise ConfigurationError(
+                    f"{builder.path} has a matrix: the source must name a variant"
+                )
             if resolve is True:
                 builder.resolve()
             return builder.dest
         else:
-            return source
+            return self.pin(source)
+
+    def pin(self, image: str) -> str:
+        """Return `image` pinned to its digest, if the session pins digests.
+        The builder sticks to the first digest it gets, so that it builds
+        from the image its hash was computed with.
+        """
+        if image not in self.pinned:
+            self.pinned[image] = digests.pin(self.session, image)
+        return self.pinned[image]
+
+    def source_pointers(self) -> List[Union[str, Dict]]:
+        """Return the source specifications of the images this builder uses.
+        Concrete classes should override this method.
+        """
+        return []
+
+    def variants(self) -> List["BaseBuilder"]:
+        """Return the builders of the variants of this spec's matrix.
+        A builder with variants has no image of its own.
+        Concrete classes supporting a matrix should override this method.
+        """
+        return []
+
+    def images(self) -> List[str]:
+        """Return the names of the images this builder produces.
+        """
+        return [variant.dest for variant in self.variants()] or [self.dest]
+
+    def dependencies(self) -> List["BaseBuilder"]:
+        """Return the builders of the images this builder is based on.
+        A builder with a matrix depends on its variants only.
+        """
+        return self.variants() or [
+            self.session.create_builder(
+                self.resolve_source_path(source, self.path), source.get("variant")
+            )
+            for source in self.source_pointers()
+            if not isinstance(source, str)
+        ]
 
     def push_to_docker(self):
         """Push the result of this build to the local docker daemon.
-        Build the image if necessary.
+        Skip the push if the daemon already has the image, otherwise
+        build the image if necessary.
         """
+        variants = self.variants()
+        if variants:
+            for variant in variants:
+                variant.push_to_docker()
+            return
+        if docker_daemon.image_present(self.dest):
+            logger.info(f"{self.dest} already present in docker")
+            return
         self.resolve()
-        self.buildah("push", self.dest, f"docker-daemon:{self.dest}")
+        with history.timed(self, "push"):
+            self.buildah("push", self.dest, f"docker-daemon:{self.dest}")
+
+    def commit(self, container: str, base_image: str):
+        """Commit `container` to this builder's image, applying the `commit`
+        options of the spec, and report the size of the result.
+        """
+        options = self.conf.get("commit", {})
+        remove = options.get("remove", [])
+        if remove:
+            logger.info(f"Removing {' '.join(remove)} from {self.dest}")
+            # No cache volumes here: they must not be purged along with the image
+            self.buildah("run", container, "sh", "-c", REMOVE_SCRIPT, "sh", *remove)
+        copy_engine.unmount(self, container)
+        commit_opts = ["--rm"]
+        if options.get("squash"):
+            commit_opts.append("--squash")
+        self.buildah("commit", *commit_opts, container, self.dest)
+        try:
+            self.report_size(base_image)
+        except (RuntimeError, KeyError, ValueError) as err:
+            logger.warning(f"Could not measure the size of {self.dest}: {err!r}")
+
+    def compression_opts(self) -> List[str]:
+        """Return the `buildah push` options for the compression requested in the spec.
+        """
+        compression = self.conf.get("commit", {}).get("compression", {})
+        opts = []
+        if "format" in compression:
+            opts += ["--compression-format", compression["format"]]
+        if "level" in compression:
+            opts += ["--compression-level", str(compression["level"])]
+        return opts
+
+    def report_size(self, base_image: str):
+        """Log the size of the image, compared to its base image and
+        to the previous build of the same spec.
+        """
+        size = self.image_size(self.dest)
+        name = history.name_of(self)
+        changes = [f"{format_size(size - self.image_size(base_image), True)} over base"]
+        previous = history.previous_size(name, self.dest)
+        if previous is not None:
+            changes.append(f"{format_size(size - previous, True)} since last build")
+        logger.info(f"{self.dest} is {format_size(size)} ({', '.join(changes)})")
+        history.record_size(name, self.dest, size)
+        metrics.set_gauge("image_size_bytes", size, spec=self.conf["dest"])
+
+    @classmethod
+    def image_size(cls, image: str) -> int:
+        """Return the size of `image` in bytes, as the sum of its layer sizes.
+        """
+        output = cls.buildah("inspect", "--type", "image", image, print_output=False)
+        manifest = json.loads(json.loads(output)["Manifest"])
+        return sum(layer["size"] for layer in manifest["layers"])
+
+
+def format_size(size: int, signed: bool = False) -> str:
+    sign = ("+" if size >= 0 else "-") if signed else ""
+    return f"{sign}{abs(size) / 2 ** 20:.1f} MiB"
 
 
-@lru_cache()
-def create_builder(path: str) -> BaseBuilder:
-    """Given a path to a builder configuration, it instantiates the relevant builder.
+def walk_graph(
+    builder: BaseBuilder, available: Optional[Callable[[BaseBuilder], bool]] = None
+) -> List[BaseBuilder]:
+    """Return the given builder and all builders it depends on, directly or
+    indirectly. Every builder comes after the ones it depends on.
+    Builders with a matrix are replaced by their variants.
+    With `available`, the graph is walked from the top and the dependencies
+    of builders it returns True for are left out, since resolving those
+    doesn't need them: see `needed_graph`.
     """
-    conf = load_conf((path))
-    return resolve(conf["builder"]["class"])(path)
+    result: List[BaseBuilder] = []
+    seen = set()
+
+    def visit(node: BaseBuilder):
+        key = (os.path.realpath(node.path), node.variant)
+        if key in seen:
+            return
+        seen.add(key)
+        variants = node.variants()
+        if not variants and available is not None and available(node):
+            result.append(node)
+            return
+        for dependency in node.dependencies():
+            visit(dependency)
+        if not variants:
+            result.append(node)
+
+    visit(builder)
+    return result
+
+
+def needed_graph(builder: BaseBuilder) -> List[BaseBuilder]:
+    """Return the builders resolving `builder` touches, dependencies first:
+    the images that have to be built, and the ones they are based on that
+    can be had without building (locally, from an import, the artifact cache
+    or the registry). Other images of the graph are left out.
+    """
+    return walk_graph(builder, available=lambda node: node.locate() is not None)
+
+
+def nodes_to_build(builder: BaseBuilder) -> List[BaseBuilder]:
+    """Return the builders of the images resolving `builder` will build.
+    """
+    return [node for node in needed_graph(builder) if node.locate() is None]
+
+
+def create_builder(path: str, variant: Optional[str] = None) -> BaseBuilder:
+    """Given a path to a builder configuration, it instantiates the relevant builder
+    in the default session. See `BuildSession.create_builder`.
+    """
+    return get_session().create_builder(path, variant)
 
 
 def load_conf(path: str) -> Dict:
@@ -297,25 +647,55 @@ class ConfigurationError(Exception):
     pass
 
 
+def get_validator(schema: Dict):
+    """Return a validator for `schema`, checking and compiling it only once.
+    """
+    with CACHES_LOCK:
+        validator = VALIDATORS.get(id(schema))
+        if validator is None:
+            validator_class = validator_for(schema)
+            validator_class.check_schema(schema)
+            validator = VALIDATORS[id(schema)] = validator_class(schema)
+    return validator
+
+
 def get_dir_hash(
     dirname: Union[Path, str],
     excluded_files: List = [],
     ignore_hidden: bool = False,
     followlinks: bool = False,
     excluded_extensions: List = [],
+    excluded_patterns: List = [],
+    root: Union[Path, str, None] = None,
+    session: Optional[BuildSession] = None,
 ):
     """Given a directory return an hash based on its contents.
     Function lifted from checksumdir python package.
+    `excluded_patterns` are matched against paths relative to `root`
+    (defaults to `dirname`): see `derex.builder.ignore`.
+    Hashes use the algorithm of `session`, the default one if not given,
+    and file hashes are cached in it.
     """
     if not os.path.isdir(dirname):
         raise TypeError(f"{dirname} is not a directory.")
+    session = session or get_session()
+    if root is None:
+        root = dirname
 
     hashvalues = []
-    for root, dirs, files in os.walk(dirname, topdown=True, followlinks=followlinks):
-        if ignore_hidden and re.search(r"/\.", root):
+    for dirpath, dirs, files in os.walk(
+        dirname, topdown=True, followlinks=followlinks
+    ):
+        if ignore_hidden and re.search(r"/\.", dirpath):
             continue
 
-        dirs.sort()
+        reldir = os.path.relpath(dirpath, root)
+        prefix = "" if reldir == "." else reldir + "/"
+        dirs[:] = [
+            name
+            for name in sorted(dirs)
+            if not is_excluded(prefix + name, excluded_patterns, is_dir=True)
+        ]
         files.sort()
 
         for filename in files:
@@ -328,20 +708,46 @@ def get_dir_hash(
             if filename in excluded_files:
                 continue
 
-            hasher = hashlib.sha256()
-            filepath = os.path.join(root, filename)
+            if is_excluded(prefix + filename, excluded_patterns):
+                continue
+
+            filepath = os.path.join(dirpath, filename)
             if not os.path.exists(filepath):
-                hashvalues.append(hasher.hexdigest())
+                hashvalues.append(digest.new(session.hash_algorithm).hexdigest())
             else:
-                with open(filepath, "rb") as fileobj:
-                    while True:
-                        data = fileobj.read(64 * 1024)
-                        if not data:
-                            break
-                        hasher.update(data)
-                hashvalues.append(hasher.hexdigest())
-
-    hasher = hashlib.sha256()
+                hashvalues.append(hash_file(filepath, session))
+
+    hasher = digest.new(session.hash_algorithm)
     for hashvalue in sorted(hashvalues):
         hasher.update(hashvalue.encode("utf-8"))
     return hasher.hexdigest()
+
+
+def hash_file(
+    filepath: Union[Path, str], session: Optional[BuildSession] = None
+) -> str:
+    """Return the hex digest of the contents of the given file, with the
+    algorithm of the session (the default one if not given).
+    Digests are cached in the session keyed on the file stat signature,
+    so unchanged files are read only once per session.
+    """
+    session = session or get_session()
+    stat = os.stat(filepath)
+    algorithm = digest.check_algorithm(session.hash_algorithm)
+    key = (algorithm, str(filepath), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with session.lock:
+        cached = session.file_hashes.get(key)
+    if cached is not None:
+        return cached
+    hasher = digest.ALGORITHMS[algorithm]()
+    with metrics.timer("hashing_seconds_total"), open(filepath, "rb") as fileobj:
+        while True:
+            data = fileobj.read(64 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    metrics.inc("hashed_bytes_total", stat.st_size)
+    hexdigest = hasher.hexdigest()
+    with session.lock:
+        session.file_hashes[key] = hexdigest
+    return hexdigest
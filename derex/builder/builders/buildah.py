@@ -1,11 +1,21 @@
 """Classes to build docker images using Buildah.
 """
 from .schema import buildah_schema
+from derex.builder import copy_engine
+from derex.builder import digest
+from derex.builder import history
 from derex.builder import logger
+from derex.builder import resources
 from derex.builder.builders.base import BaseBuilder
-from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import ConfigurationError
+from derex.builder.ignore import stage_directory
+from derex.builder.locks import build_lock
+from derex.builder.session import BuildSession
+from tempfile import TemporaryDirectory
 from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
 import json
@@ -18,14 +28,49 @@ class ImageFound:
 
 
 class BuildahBuilder(BaseBuilder):
+    """Build an image by running scripts in a container of the source image.
+
+    A spec with a `matrix` describes variants of the image, each overriding the
+    `source` and/or setting variables (`env`) for the scripts. Every script
+    gets all the variables of the variant, except the ones listed in
+    `shared_scripts`: those run the same way in every variant.
+    Variants are built step by step, saving a checkpoint image after the copy
+    step and after every script: variants whose steps have the same inputs
+    (like a shared script run first) share the checkpoints instead of running
+    the steps again.
+    Checkpoints are kept in the local store for later builds, and left behind
+    when steps change: `derex.builder prune` removes the ones that can't be
+    reused any more.
+    """
+
     json_schema = buildah_schema
+    script_dir = "/opt/derex/bin"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(
+        self,
+        path: str,
+        variant: Optional[str] = None,
+        session: Optional[BuildSession] = None,
+    ):
+        super().__init__(path, session)
         self.scripts = self.conf["scripts"]
-        self.source = self.conf["source"]
         self.copy = self.conf.get("copy", {})
         self.config = self.conf.get("config", {})
+        self.matrix = self.conf.get("matrix", {})
+        self.shared_scripts = self.conf.get("shared_scripts", [])
+        unknown = sorted(set(self.shared_scripts) - set(self.scripts))
+        if unknown:
+            raise ConfigurationError(
+                f"{path}: shared scripts {', '.join(unknown)} are not in scripts"
+            )
+        overrides: Dict = {}
+        if variant is not None:
+            if variant not in self.matrix:
+                raise ConfigurationError(f"{path} has no variant named {variant}")
+            self.variant = variant
+            overrides = self.matrix[variant]
+        self.source = overrides.get("source", self.conf["source"])
+        self.variables = overrides.get("env", {})
 
     def hash(self) -> str:
         """Return a hash representing this builder.
@@ -41,42 +86,54 @@ class BuildahBuilder(BaseBuilder):
         ]
         return self.mkhash("\n".join(elements))
 
+    def input_hashes(self) -> Dict[str, str]:
+        inputs = {
+            "conf": self.hash_conf(),
+            "source": self.get_source_target(self.source, path=self.path),
+        }
+        for name in self.copy:
+            inputs[f"copy {name}"] = self.hash_files([name])
+        for name in self.scripts:
+            inputs[f"script {name}"] = self.hash_files([name])
+        return inputs
+
+    def hash_conf(self) -> str:
+        """The hash of a variant only depends on its own part of the matrix.
+        """
+        if self.variant is None:
+            return super().hash_conf()
+        matrix = {self.variant: self.matrix[self.variant]}
+        conf = dict(self.hashed_conf(), matrix=matrix)
+        return self.mkhash(json.dumps(conf, sort_keys=True))
+
+    def docker_tag(self) -> str:
+        tag = super().docker_tag()
+        return tag if self.variant is None else f"{self.variant}-{tag}"
+
+    def variants(self) -> List[BaseBuilder]:
+        if self.variant is not None:
+            return []
+        create = self.session.create_builder
+        return [create(self.path, name) for name in sorted(self.matrix)]
+
+    def source_pointers(self) -> List[Union[str, Dict]]:
+        return [self.source]
+
+    def required_files(self) -> List[str]:
+        return list(self.copy) + self.scripts
+
     def build(self):
         """Builds the image specified by this builder.
         """
         logger.info(f"Building {self.dest} from {self.path}")
         base_image = self.resolve_base_image(self.source, self.path)
-        container = self.buildah("from", base_image, print_output=False)
-
-        # To support build-only variables we push them to the container config and
-        # re-set them to the empty value immediately before committing the container.
-        # TODO revisit if/when buildah supports `--env` in its `run` command.
-        set_env_opts = []
-        unset_env_opts = []
-        for name in self.conf.get("build_env", []):
-            value = os.environ.get(name)
-            if value is not None:
-                set_env_opts += ["--env", f"{name}={value}"]
-                unset_env_opts += ["--env", f"{name}="]
-        self.buildah("config", *set_env_opts + [container])
-
-        buildah_run = lambda *args: self.buildah_run(container, args)
-        script_dir = "/opt/derex/bin"
-        buildah_run("mkdir", "-p", script_dir)
-
-        def copy(src, dest):
-            logger.info(
-                self.buildah("copy", container, os.path.join(self.path, src), dest)
-            )
-
-        for src, dest in self.copy.items():
-            copy(src, dest)
-        for script in self.scripts:
-            dest = os.path.join(script_dir, script)
-            copy(script, dest)
-            logger.info(f"Running {script}")
-            buildah_run("chmod", "a+x", dest)
-            buildah_run(dest)
+        if self.variant is None:
+            container = self.start_container(base_image)
+            self.copy_files(container)
+            for script in self.scripts:
+                self.run_script(container, script)
+        else:
+            container = self.build_steps(base_image)
         logger.info(f"Finished running scripts")
         if self.config:
             for key, value in self.config.items():
@@ -88,8 +145,150 @@ class BuildahBuilder(BaseBuilder):
                 else:
                     self.buildah("config", f"--{key}", value, container)
 
-        self.buildah(
-            "config", *unset_env_opts + [container]
-        )  # Unset build-only variables
+        self.config_build_env(container, clear=True)
+        self.commit(container, base_image)
+
+    def build_env(self) -> Dict[str, str]:
+        """Return the values of the build-only variables that are set.
+        """
+        return {
+            name: os.environ[name]
+            for name in self.conf.get("build_env", [])
+            if name in os.environ
+        }
+
+    def config_build_env(self, container: str, clear: bool = False):
+        """Push the build-only variables to the container config or, with
+        `clear`, re-set them to the empty value. They must be cleared before
+        committing any image: final image or checkpoint.
+        """
+        # TODO revisit if/when buildah supports `--env` in its `run` command.
+        env_opts = []
+        for name, value in self.build_env().items():
+            env_opts += ["--env", f"{name}={'' if clear else value}"]
+        if env_opts:
+            self.buildah("config", *env_opts + [container])
+
+    def start_container(self, image: str) -> str:
+        options = resources.from_options(self.resource_budget())
+        container = self.buildah("from", *options, image, print_output=False)
+        self.config_build_env(container)
+        self.buildah_run(container, ["mkdir", "-p", self.script_dir])
+        return container
+
+    def copy_to(self, container: str, src: str, dest: str):
+        """Copy `src`, relative to the spec, to `dest` in the container.
+        See `derex.builder.copy_engine`.
+        """
+        source = os.path.join(self.path, src)
+        if not self.exclude or not os.path.isdir(source):
+            copy_engine.copy(self, container, source, dest)
+            return
+        # Copy only what was hashed: stage the files that are not excluded
+        with TemporaryDirectory(prefix="derex-copy-") as staging:
+            stage_directory(source, self.exclude, self.path, staging)
+            copy_engine.copy(self, container, staging, dest)
+
+    def copy_files(self, container: str):
+        for src, dest in self.copy.items():
+            self.copy_to(container, src, dest)
+
+    def run_script(self, container: str, script: str):
+        dest = os.path.join(self.script_dir, script)
+        self.copy_to(container, script, dest)
+        logger.info(f"Running {script}")
+        self.buildah_run(container, ["chmod", "a+x", dest])
+        variables = dict(
+            resources.build_env(self.resource_budget()), **self.script_variables(script)
+        )
+        assignments = [f"{name}={value}" for name, value in variables.items()]
+        command = ["env"] + assignments + [dest] if assignments else [dest]
+        with history.timed(self, "step", script):
+            self.buildah_run(container, command)
+
+    def script_variables(self, script: str) -> Dict[str, str]:
+        """Return the variant variables `script` runs with: all of them,
+        unless the spec lists it in `shared_scripts`.
+        """
+        if script in self.shared_scripts:
+            return {}
+        return dict(sorted(self.variables.items()))
 
-        self.buildah("commit", "--rm", container, self.dest)
+    def checkpoints(self, base_image: str) -> List[Tuple[Optional[str], str]]:
+        """Return `(script, checkpoint image)` for every step of the build, the
+        first one (with no script) being the copy step.
+        The checkpoint of a step depends on its inputs and on those of all
+        steps before it.
+        """
+        key = self.mkhash(
+            "\n".join(
+                [
+                    base_image,
+                    json.dumps(self.build_env(), sort_keys=True),
+                    json.dumps(self.copy, sort_keys=True),
+                    self.hash_files(self.copy.keys()),
+                ]
+            )
+        )
+        steps: List[Tuple[Optional[str], str]] = [(None, key)]
+        for script in self.scripts:
+            variables = json.dumps(self.script_variables(script), sort_keys=True)
+            key = self.mkhash(
+                "\n".join([key, script, self.hash_files([script]), variables])
+            )
+            steps.append((script, key))
+        scheme = digest.tag_prefix(self.session.hash_algorithm)
+        prefix = f"{self.conf['dest']}:checkpoint-{scheme}"
+        return [(script, prefix + key[:16]) for script, key in steps]
+
+    def build_steps(self, base_image: str) -> str:
+        """Run the copy and script steps, starting from the latest checkpoint
+        available and saving one after each step.
+        Returns the container holding the result.
+        """
+        container, image = None, base_image
+        for script, checkpoint in self.checkpoints(base_image):
+            with build_lock(checkpoint):  # Another variant might be on it
+                if checkpoint in self.list_buildah_images(
+                    refresh=True, session=self.session
+                ):
+                    logger.info(f"Reusing checkpoint {checkpoint}")
+                    if container is not None:
+                        copy_engine.unmount(self, container)
+                        self.buildah("rm", container)
+                    container, image = None, checkpoint
+                    continue
+                if container is None:
+                    container = self.start_container(image)
+                if script is None:
+                    self.copy_files(container)
+                else:
+                    self.run_script(container, script)
+                self.config_build_env(container, clear=True)
+                self.buildah("commit", container, checkpoint, print_output=False)
+                self.config_build_env(container)
+        return container or self.start_container(image)
+
+    def prune_checkpoints(self, keep_current: bool = True) -> List[str]:
+        """Remove the checkpoint images of this spec's variants. With
+        `keep_current` the ones a build of the spec as it is now would reuse
+        are kept. Returns the removed images.
+        """
+        prefix = f"{self.conf['dest']}:checkpoint-"
+        images = self.list_buildah_images(refresh=True, session=self.session)
+        keep = set()
+        if keep_current:
+            for variant in self.variants():
+                base_image = variant.get_source_target(variant.source, variant.path)
+                keep.update(image for _, image in variant.checkpoints(base_image))
+        removed = []
+        for image in images:
+            if image.startswith(prefix) and image not in keep:
+                logger.info(f"Removing checkpoint {image}")
+                try:
+                    self.buildah("rmi", image, print_output=False)
+                except RuntimeError:  # Still used by a container
+                    logger.warning(f"Could not remove checkpoint {image}")
+                    continue
+                removed.append(image)
+        return removed
@@ -8,6 +8,7 @@ pointer = {
             "properties": {
                 "type": {"type": "string", "enum": ["derex-relative"]},
                 "path": {"type": "string"},
+                "variant": {"type": "string"},
             },
         },
     ]
@@ -26,6 +27,37 @@ BASE_PROPERTIES = {
             "env": {"type": "object", "patternProperties": {".*": {"type": "string"}}},
         },
     },
+    "commit": {
+        "type": "object",
+        "additionalProperties": False,
+        "properties": {
+            "squash": {"type": "boolean"},
+            "compression": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "format": {"type": "string", "enum": ["gzip", "zstd"]},
+                    "level": {"type": "integer"},
+                },
+            },
+            "remove": {"type": "array", "items": {"type": "string"}},
+        },
+    },
+    # Budgets of the build: see `derex.builder.resources`
+    "resources": {
+        "type": "object",
+        "additionalProperties": False,
+        "properties": {
+            "cpus": {"type": "number", "exclusiveMinimum": 0},
+            "cpuset": {
+                "type": "string",
+                "pattern": "^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$",
+            },
+            "cpu_shares": {"type": "integer", "minimum": 2},
+            "memory": {"type": "string", "pattern": "^[0-9]+[bBkKmMgG]?$"},
+            "jobs": {"type": "integer", "minimum": 1},
+        },
+    },
 }
 BASE_KEYS = ["builder", "dest"]
 
@@ -37,8 +69,28 @@ buildah_schema = {
     "properties": dict(
         BASE_PROPERTIES,
         scripts={"type": "array", "items": {"type": "string"}},
+        # Scripts that don't use the variables of matrix variants
+        shared_scripts={"type": "array", "items": {"type": "string"}},
         source=pointer,
         copy={"type": "object"},
+        exclude={"type": "array", "items": {"type": "string"}},
+        matrix={
+            "type": "object",
+            "minProperties": 1,
+            # Variant names end up in image tags
+            "propertyNames": {"pattern": "^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$"},
+            "additionalProperties": {
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "source": pointer,
+                    "env": {
+                        "type": "object",
+                        "additionalProperties": {"type": "string"},
+                    },
+                },
+            },
+        },
     ),
 }
 
@@ -55,5 +107,6 @@ wheel_compiler_schema = {
             "required": ["builder", "base"],
             "properties": {"builder": pointer, "base": pointer},
         },
+        install={"type": "string", "enum": ["wheelhouse", "exact"]},
     ),
 }
@@ -1,32 +1,43 @@
 from .schema import wheel_compiler_schema
+from derex.builder import history
 from derex.builder import logger
+from derex.builder import metrics
+from derex.builder import resources
 from derex.builder.builders.base import BaseBuilder
-from derex.builder.builders.base import create_builder
 from derex.builder.builders.base import load_conf
-from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Callable
+from typing import Dict
 from typing import List
+from typing import Set
+from typing import Union
 
 import os
+import re
 
 
-WHEELS_CACHE = os.environ.get("WHEELS_CACHE")
-WC_VOLUMES: List[str] = []
-if WHEELS_CACHE is not None:
-    if Path(WHEELS_CACHE).is_dir():
-        WC_VOLUMES = ["-v", f"{WHEELS_CACHE}:/wheels_cache"]
-    else:
-        logger.error(
-            f'The directory "{WHEELS_CACHE} specified in WHEELS_CACHE does not exist"'
-        )
+REQUIREMENTS_DIR = "/etc/derex.builder.requirements"
+# Image label listing the distributions installed by an `install: exact` build
+INSTALLED_LABEL = "derex.builder.installed"
+
+
+class InstallError(Exception):
+    pass
 
 
 class BuildahWheelCompiler(BaseBuilder):
     """Use a builder image to compile a set of python wheels,
     and create a new image by installing them in the base image.
 
-    Use the path in the environment variable WHEELS_CACHE as a wheel cache.
-    Copy the newly built wheels to the cache (maybe overwriting the already present ones).
+    Use the wheels cache of the session (the WHEELS_CACHE environment variable
+    by default). Copy the newly built wheels to the cache (maybe overwriting the
+    already present ones).
+    Builder containers are taken from (and given back to) the session's pool.
+
+    With `install: exact` in the spec only the requirements are installed,
+    from the compiled wheels alone, and the installed distributions are listed
+    in the `derex.builder.installed` image label. The default (`wheelhouse`)
+    installs every compiled wheel.
     """
 
     json_schema = wheel_compiler_schema
@@ -35,30 +46,46 @@ class BuildahWheelCompiler(BaseBuilder):
         super().__init__(*args, **kwargs)
         self.sources = self.conf["sources"]
         self.requirements = self.conf["requirements"]
+        self.install = self.conf.get("install", "wheelhouse")
+
+    def source_pointers(self) -> List[Union[str, Dict]]:
+        return [self.sources["base"], self.sources["builder"]]
+
+    def required_files(self) -> List[str]:
+        return list(self.requirements)
 
     def build(self):
         logger.info(f"Building {self.path}")
         base_image = self.resolve_base_image(self.sources["base"], self.path)
         builder_image = self.resolve_base_image(self.sources["builder"], self.path)
-        base_container = self.buildah("from", base_image)
-        builder_container = self.buildah("from", builder_image)
-        requirements_dir = "/etc/derex.builder.requirements"
-        with TemporaryDirectory("wheelhouse") as tmp_whs:
-            volumes = ["-v", f"{tmp_whs}:/wheelhouse"] + WC_VOLUMES
+        budget = self.resource_budget()
+        options = resources.from_options(budget)
+        base_container = self.buildah("from", *options, base_image)
+        wheels_cache = self.session.wheels_cache
+        builder = self.session.pool.container(
+            builder_image, self.prepare_builder, self.reset_builder, options
+        )
+        env = [f"{name}={value}" for name, value in resources.build_env(budget).items()]
+        with TemporaryDirectory("wheelhouse") as tmp_whs, builder as builder_container:
+            volumes = ["-v", f"{tmp_whs}:/wheelhouse"]
+            if wheels_cache is not None and os.path.isdir(wheels_cache):
+                volumes += ["-v", f"{wheels_cache}:/wheels_cache"]
             base_run = lambda *args: self.buildah_run(
                 container=base_container, args=list(args), extra_args=volumes
             )
             builder_run = lambda *args: self.buildah_run(
-                container=builder_container, args=list(args), extra_args=volumes
+                container=builder_container,
+                args=["env"] + env + list(args) if env else list(args),
+                extra_args=volumes,
             )
-            builder_run("mkdir", "-p", requirements_dir)
-            builder_run("pip", "install", "wheel")
+            builder_run("mkdir", "-p", REQUIREMENTS_DIR)
             wheel_cache_opts = (
-                "" if WHEELS_CACHE is None else "--find-links /wheels_cache"
+                "" if wheels_cache is None else "--find-links /wheels_cache"
             )
+            counted: Set[str] = set()
             for requirement in self.requirements:
                 src = os.path.join(self.path, requirement)
-                dest = os.path.join(requirements_dir, requirement)
+                dest = os.path.join(REQUIREMENTS_DIR, requirement)
                 self.buildah("copy", builder_container, src, dest)
                 logger.info(f"Installing {requirement}")
                 logger.debug(open(src).read())
@@ -66,16 +93,80 @@ class BuildahWheelCompiler(BaseBuilder):
                 # There is some build time potentially wasted. Maybe make it optional.
                 builder_run(*f"pip install {wheel_cache_opts} -r".split(), dest)
                 logger.info(f"Compiling wheels for {requirement}")
-                builder_run(
-                    *f"pip wheel {wheel_cache_opts} --wheel-dir=/wheelhouse -r".split(),
-                    dest,
-                )
-                if WHEELS_CACHE is not None:
+                with history.timed(self, "step", f"compile {requirement}"):
+                    builder_run(
+                        *f"pip wheel {wheel_cache_opts} --wheel-dir=/wheelhouse -r".split(),
+                        dest,
+                    )
+                if wheels_cache is not None:
+                    counted |= count_cached_wheels(tmp_whs, wheels_cache, counted)
                     builder_run("sh", "-c", "cp -rv /wheelhouse/* /wheels_cache/")
             logger.info(f"Created wheeels:\n{'n'.join(os.listdir(tmp_whs))}")
-            base_run("sh", "-c", "pip install /wheelhouse/*")
-        self.buildah("commit", "--rm", base_container, self.dest)
-        self.buildah("rm", builder_container)
+            with history.timed(self, "step", "install"):
+                if self.install == "exact":
+                    self.install_exact(base_container, base_run, tmp_whs)
+                else:
+                    base_run("sh", "-c", "pip install /wheelhouse/*")
+        self.commit(base_container, base_image)
+
+    def prepare_builder(self, container: str) -> Dict[str, str]:
+        """Set up a new builder container.
+        Returns the distributions installed in it.
+        """
+        self.buildah_run(container, ["pip", "install", "wheel"])
+        return parse_freeze(self.buildah_run(container, ["pip", "freeze", "--all"]))
+
+    def reset_builder(self, container: str, baseline: Dict[str, str]) -> bool:
+        """Undo the changes a build made to a builder container, uninstalling
+        the distributions that were not in `baseline`.
+        Returns False if the container can't be brought back to its initial state.
+        """
+        self.buildah_run(container, ["rm", "-rf", REQUIREMENTS_DIR])
+        current = parse_freeze(self.buildah_run(container, ["pip", "freeze", "--all"]))
+        if any(current.get(name) != version for name, version in baseline.items()):
+            return False  # Something that came with the container changed
+        extra = sorted(set(current) - set(baseline))
+        if extra:
+            self.buildah_run(container, ["pip", "uninstall", "--yes"] + extra)
+        return True
+
+    def install_exact(self, container: str, base_run: Callable, wheelhouse: str):
+        """Install the requirements using only the wheels in `wheelhouse`,
+        check that every installed distribution comes from there
+        and record them in an image label.
+        """
+        requirements_dir = "/tmp/derex.builder.requirements"
+        requirement_opts = []
+        for requirement in self.requirements:
+            dest = os.path.join(requirements_dir, requirement)
+            self.buildah("copy", container, os.path.join(self.path, requirement), dest)
+            requirement_opts += ["-r", dest]
+        before = parse_freeze(base_run("pip", "freeze", "--all"))
+        base_run(
+            *"pip install --no-index --only-binary :all: --find-links /wheelhouse".split(),
+            *requirement_opts,
+        )
+        base_run("rm", "-rf", requirements_dir)
+        after = parse_freeze(base_run("pip", "freeze", "--all"))
+        installed = {
+            name: version
+            for name, version in after.items()
+            if before.get(name) != version
+        }
+        check_installed(installed, wheel_versions(wheelhouse))
+        label = ",".join(f"{name}=={installed[name]}" for name in sorted(installed))
+        logger.info(f"Installed {len(installed)} distributions from the wheelhouse")
+        self.buildah("config", "--label", f"{INSTALLED_LABEL}={label}", container)
+
+    def input_hashes(self) -> Dict[str, str]:
+        inputs = {"conf": self.hash_conf()}
+        for role in ("base", "builder"):
+            inputs[f"source {role}"] = self.get_source_target(
+                self.sources[role], path=self.path
+            )
+        for name in self.requirements:
+            inputs[f"requirements {name}"] = self.hash_files([name])
+        return inputs
 
     def hash(self):
         elements = [
@@ -86,3 +177,59 @@ class BuildahWheelCompiler(BaseBuilder):
             self.hash_files(self.requirements),
         ]
         return self.mkhash("\n".join(elements))
+
+
+def count_cached_wheels(
+    wheelhouse: str, wheels_cache: str, exclude: Set[str]
+) -> Set[str]:
+    """Count the wheels in `wheelhouse` found in (hits) or missing from (misses)
+    `wheels_cache`. Wheels in `exclude` were already counted.
+    Returns the set of wheels counted.
+    """
+    wheels = set(os.listdir(wheelhouse)) - exclude
+    cached = set(os.listdir(wheels_cache)) if os.path.isdir(wheels_cache) else set()
+    hits = len(wheels & cached)
+    metrics.inc("wheel_cache_total", hits, result="hit")
+    metrics.inc("wheel_cache_total", len(wheels) - hits, result="miss")
+    return wheels
+
+
+def normalize(name: str) -> str:
+    """Normalize a distribution name as in PEP 503.
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_freeze(output: str) -> Dict[str, str]:
+    """Map normalized distribution names to versions in the output of `pip freeze`.
+    """
+    result = {}
+    for line in output.splitlines():
+        if "==" in line and not line.startswith(("#", "-")):
+            name, version = line.strip().split("==", 1)
+            result[normalize(name)] = version
+    return result
+
+
+def wheel_versions(wheelhouse: str) -> Dict[str, str]:
+    """Map normalized distribution names to the versions of the wheels in `wheelhouse`.
+    """
+    result = {}
+    for filename in os.listdir(wheelhouse):
+        if filename.endswith(".whl"):
+            name, version = filename.split("-")[:2]
+            result[normalize(name)] = version
+    return result
+
+
+def check_installed(installed: Dict[str, str], wheels: Dict[str, str]):
+    """Raise InstallError unless every installed distribution matches a wheel.
+    """
+    # Wheel file names use underscores where versions have dashes
+    foreign = sorted(
+        f"{name}=={version}"
+        for name, version in installed.items()
+        if wheels.get(name) != version.replace("-", "_")
+    )
+    if foreign:
+        raise InstallError(f"Not installed from the wheelhouse: {', '.join(foreign)}")
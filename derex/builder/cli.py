@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 
 """Console script for derex.builder."""
+from . import archives
 from . import arguments
+from . import daemon
+from . import history
 from . import logger
+from . import metrics
+from . import plan
+from . import prefetch
+from . import validation
+from . import workqueue
 from click.exceptions import Abort
 from derex.builder.builders.base import create_builder
-from jsonschema.exceptions import ValidationError
+from derex.builder.builders.base import nodes_to_build
+from derex.builder.builders.base import walk_graph
+from derex.builder.docker_daemon import push_images
+from derex.builder.scheduler import predict
+from derex.builder.scheduler import resolve_graph
+from derex.builder.session import get_session
 
 import click
 import click_log
+import json
 import os
 import sys
 
@@ -17,24 +31,100 @@ click_log.basic_config(logger)
 
 
 @click.group()
-def main(args=None):
+@click.option(
+    "--socket",
+    "socket_path",
+    envvar="DEREX_BUILDER_SOCKET",
+    type=click.Path(),
+    help="Forward commands to the build daemon listening on this socket",
+)
+@click.pass_context
+def main(ctx, socket_path=None):
     """Build docker images based on yaml config files and shell scripts."""
+    ctx.obj = {"socket": socket_path}
+    ctx.call_on_close(metrics.write)
 
 
 @arguments.path
 @main.command()
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    show_default=True,
+    help="Images of the graph resolved at the same time",
+)
+@click.option(
+    "--prefetch-jobs",
+    default=prefetch.PREFETCH_JOBS,
+    show_default=True,
+    help="Base images pulled in the background at the same time (0 to disable)",
+)
+@click.option("--cpus", type=float, help="Default CPU budget of each build")
+@click.option("--cpuset", help="Default CPUs builds may run on, like 0-3,6")
+@click.option("--cpu-shares", type=int, help="Default CPU weight of builds")
+@click.option("--memory", help="Default memory limit of builds, like 4G")
+@click.option("--make-jobs", type=int, help="Default parallel jobs of make and cmake")
 @click_log.simple_verbosity_option(logger)
-def resolve(path: str):
+@click.pass_obj
+def resolve(obj, path: str, jobs: int, prefetch_jobs: int, **budget):
     """Build a docker image based on a directory containing a spec.yml file.
+    Resource budgets given here apply to specs that don't set their own,
+    in this process only (not in the build daemon).
     """
+    if obj["socket"]:
+        click.echo(f"Resolved {path} to {daemon_request(obj, 'resolve', path)}")
+        return
+    budget["jobs"] = budget.pop("make_jobs")
+    get_session().resources.update(
+        (key, value) for key, value in budget.items() if value is not None
+    )
     builder = create_builder(path)
-    click.echo(f"Resolving {path} to {builder.dest}")
-    builder.resolve()
+    click.echo(f"Resolving {path} to {', '.join(builder.images())}")
+    try:
+        prefetch.prefetch(nodes_to_build(builder), jobs=prefetch_jobs)
+        resolve_graph(builder, jobs=jobs)
+    finally:
+        prefetch.shutdown()
+
+
+@arguments.path
+@main.command()
+@click.option(
+    "--graph",
+    is_flag=True,
+    help="Also push all images the given one is based on",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    default=4,
+    show_default=True,
+    help="Maximum number of concurrent pushes (with --graph)",
+)
+@click_log.simple_verbosity_option(logger)
+@click.pass_obj
+def push(obj, path: str, graph: bool, jobs: int):
+    """Push the image built from the given directory to the local docker daemon.
+    Build it first if necessary. Images already present in docker are skipped.
+    """
+    command = "push-graph" if graph else "push"
+    if obj["socket"]:
+        click.echo(f"Pushed {daemon_request(obj, command, path)}")
+        return
+    builder = create_builder(path)
+    if graph:
+        pushed = push_images(walk_graph(builder), jobs=jobs)
+        click.echo(f"Pushed {len(pushed)} images to docker")
+        return
+    click.echo(f"Pushing {', '.join(builder.images())} to docker")
+    builder.push_to_docker()
 
 
 @arguments.path
 @main.command()
-def image(path: str):
+@click.pass_obj
+def image(obj, path: str):
     """Print a docker image identifier for the given builder.
     If stdout is not a tty omit the trailing newline.
     """
@@ -46,19 +136,213 @@ def image(path: str):
     except Exception:
         nl = False
     logger.setLevel("CRITICAL")
-    click.echo(create_builder(path).dest, nl=nl)
+    if obj["socket"]:
+        click.echo(daemon_request(obj, "image", path), nl=nl)
+        return
+    click.echo("\n".join(create_builder(path).images()), nl=nl)
+
+
+@arguments.path
+@main.command()
+@click.option(
+    "--all", "prune_all", is_flag=True, help="Also remove the current checkpoints"
+)
+@click_log.simple_verbosity_option(logger)
+def prune(path: str, prune_all: bool):
+    """Remove the checkpoint images left by builds of the variants of the
+    given spec. Unless --all is given, the checkpoints the next build would
+    reuse are kept.
+    """
+    builder = create_builder(path)
+    if not hasattr(builder, "prune_checkpoints"):
+        click.echo(f"{path} has no checkpoints")
+        return
+    removed = builder.prune_checkpoints(keep_current=not prune_all)
+    click.echo(f"Removed {len(removed)} checkpoint images")
 
 
 @arguments.path
 @main.command()
+@click.option(
+    "--jobs",
+    "-j",
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Specs checked at the same time",
+)
 @click_log.simple_verbosity_option(logger)
-def validate(path: str):
-    """Validate spec.yml yaml configuration in the given directory.
+def validate(path: str, jobs: int):
+    """Validate spec.yml yaml configuration in the given directory, the files
+    it uses and the specs it is based on, and look for dependency cycles.
+    Given a directory without a spec.yml, validate all specs below it.
     """
     click.echo(f"Validating {path}")
-    try:
-        create_builder(path).validate()
-    except ValidationError as err:
-        logger.error(err)
+    report = validation.validate_tree(validation.find_specs(path), jobs=jobs)
+    for spec, errors in sorted(report.items()):
+        for error in errors:
+            logger.error(f"{os.path.relpath(spec)}: {error}")
+    if any(report.values()):
         raise Abort()  # Make sure our exit status code is non-zero
+    click.echo(f"{len(report)} specs are valid")
     click.echo(f"All good")
+
+
+@arguments.path
+@main.command("export")
+@click.option(
+    "--output",
+    "-o",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="Directory to write the images to",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(archives.COMPRESSION_FORMATS),
+    default="zstd",
+    show_default=True,
+)
+@click.option("--level", type=int, default=None, help="Compression level")
+@click.option(
+    "--jobs", "-j", default=4, show_default=True, help="Images compressed at once"
+)
+@click_log.simple_verbosity_option(logger)
+def export_command(path: str, output: str, compression: str, level, jobs: int):
+    """Export the image built from the given directory, and all images it is
+    based on, as OCI image layouts. Layers shared between images are stored once.
+    """
+    builders = walk_graph(create_builder(path))
+    images = archives.export_images(builders, output, compression, level, jobs)
+    click.echo(f"Exported {len(images)} images to {output}")
+
+
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@arguments.path
+@main.command("import")
+@click_log.simple_verbosity_option(logger)
+def import_command(path: str, directory: str):
+    """Import the images of the given directory's graph from an export directory.
+    Images already available locally are skipped.
+    """
+    imported = archives.import_images(walk_graph(create_builder(path)), directory)
+    click.echo(f"Imported {len(imported)} images from {directory}")
+
+
+@arguments.path
+@main.command("plan")
+@click.option("--json", "as_json", is_flag=True, help="Print the plan as JSON")
+@click.option(
+    "--check-registry",
+    is_flag=True,
+    help="Ask the docker registry about images not found anywhere else",
+)
+@click.option(
+    "--fail-on-build",
+    is_flag=True,
+    help="Exit with status 1 if any image would be built",
+)
+@click_log.simple_verbosity_option(logger)
+@click.pass_context
+def plan_command(ctx, path: str, as_json: bool, check_registry: bool, fail_on_build):
+    """Tell which images of the graph are present, would be imported, fetched,
+    pulled or built, and for the ones to build which inputs changed since
+    their last build. Nothing is pulled or built.
+    """
+    entries = plan.plan(create_builder(path), check_registry=check_registry)
+    if as_json:
+        output = {"images": entries, "summary": plan.summary(entries)}
+        click.echo(json.dumps(output, indent=2, sort_keys=True))
+    else:
+        click.echo(plan.render(entries))
+    if fail_on_build and any(entry["action"] == "build" for entry in entries):
+        ctx.exit(1)
+
+
+@main.command()
+@click.argument("path", type=click.Path(exists=True), required=False)
+@click_log.simple_verbosity_option(logger)
+def stats(path: str = None):
+    """Show build, pull and push durations recorded so far, flagging regressions.
+    Given a spec directory, predict how long resolving its graph will take.
+    """
+    for entry in history.summary():
+        step = f" {entry['step']}" if entry["step"] else ""
+        flag = "  REGRESSION" if entry["regression"] else ""
+        click.echo(
+            f"{entry['name']} {entry['phase']}{step}: {entry['runs']} runs, "
+            f"last {entry['last']:.1f}s, mean {entry['mean']:.1f}s, "
+            f"min {entry['min']:.1f}s, max {entry['max']:.1f}s{flag}"
+        )
+    if path:
+        prediction = predict(create_builder(path))
+        click.echo(
+            f"Predicted time to resolve {path}: "
+            f"{prediction['sequential']:.0f}s sequentially, "
+            f"{prediction['critical_path']:.0f}s with unlimited jobs"
+        )
+
+
+@main.command("daemon")
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(),
+    default=daemon.DEFAULT_SOCKET,
+    show_default=True,
+    help="Path of the Unix socket to listen on",
+)
+@click_log.simple_verbosity_option(logger)
+def daemon_command(socket_path: str):
+    """Serve image, resolve and push requests over a Unix socket.
+    Caches stay warm between requests and concurrent builds of the same
+    image are coalesced.
+    """
+    daemon.serve(socket_path)
+
+
+@click.argument("directory", type=click.Path(file_okay=False))
+@arguments.path
+@main.command()
+@click.option(
+    "--timeout", type=float, default=None, help="Seconds to wait for the workers"
+)
+@click_log.simple_verbosity_option(logger)
+def coordinate(path: str, directory: str, timeout):
+    """Queue the images resolving the given directory needs in the shared queue
+    DIRECTORY and wait until workers have resolved them all. Images already
+    available are queued without the ones they are based on.
+    """
+    ids = workqueue.submit(create_builder(path), directory)
+    click.echo(f"Queued {len(ids)} jobs in {directory}")
+    try:
+        workqueue.wait_for(directory, ids, timeout=timeout)
+    except workqueue.JobFailed as err:
+        logger.error(err)
+        raise Abort()
+    click.echo(f"All {len(ids)} jobs done")
+
+
+@main.command()
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--name", default=None, help="Worker name (default: host-pid)")
+@click.option(
+    "--exit-when-idle",
+    is_flag=True,
+    help="Exit when no job is ready and none is in progress",
+)
+@click_log.simple_verbosity_option(logger)
+def worker(directory: str, name, exit_when_idle: bool):
+    """Resolve images queued in the shared queue DIRECTORY by `coordinate`.
+    Run as many workers as wanted, on this host or on others sharing
+    the directory and the spec paths.
+    """
+    count = workqueue.work(directory, worker=name, exit_when_idle=exit_when_idle)
+    click.echo(f"Ran {count} jobs")
+
+
+def daemon_request(obj, command: str, path: str) -> str:
+    try:
+        return daemon.request(obj["socket"], command, path)
+    except (OSError, daemon.DaemonError) as err:
+        logger.error(err)
+        raise Abort()
@@ -0,0 +1,150 @@
+"""Copy files from the host into working containers through a mount.
+
+`buildah copy` streams every file through a separate process and writes a
+full copy of it. Instead, the container is mounted once with `buildah mount`
+and files are copied into the mount point with `cp --reflink=auto`: on
+filesystems supporting it (XFS, btrfs) the copy shares the blocks of the
+source and is almost instantaneous, elsewhere it's a plain copy.
+Files end up owned by root, with their mode and timestamps, like with
+`buildah copy`.
+
+The mount is only used when running as root, since the storage of the
+containers is not readable by other users. Set DEREX_COPY_MODE=buildah to
+always use `buildah copy`, which is also the fallback when the container
+can't be mounted or the copy fails.
+"""
+from derex.builder import logger
+from derex.builder import metrics
+from typing import List
+from typing import Optional
+
+import os
+import subprocess
+
+
+COPY_MODE = os.environ.get("DEREX_COPY_MODE", "mount")
+MAX_SYMLINKS = 40
+# Replace existing files instead of writing through them: they might be symbolic links
+CP_OPTIONS = [
+    "--reflink=auto",
+    "--preserve=mode,timestamps,links",
+    "--remove-destination",
+]
+
+
+def copy(builder, container: str, source: str, dest: str):
+    """Copy `source`, a file or directory on the host, to `dest` in `container`,
+    with the semantics of `buildah copy`.
+    """
+    root = mount(builder, container) if COPY_MODE == "mount" else None
+    if root is not None:
+        try:
+            copy_into(root, source, dest)
+            metrics.inc("copies_total", method="mount")
+            return
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warning(f"Copying {source} through the mount failed: {err!r}")
+    logger.info(builder.buildah("copy", container, source, dest))
+    metrics.inc("copies_total", method="buildah")
+
+
+def mount(builder, container: str) -> Optional[str]:
+    """Return the mount point of `container`, mounting it the first time.
+    Returns None if it can't be mounted. Mount points are kept in the session
+    of `builder`.
+    """
+    session = builder.session
+    with session.lock:
+        if container in session.mounts:
+            return session.mounts[container]
+    root = None
+    if os.getuid() == 0:
+        try:
+            output = builder.buildah("mount", container, print_output=False)
+            root = output.strip().splitlines()[-1] if output.strip() else None
+        except RuntimeError:
+            logger.debug(f"Could not mount {container}")
+    if root is not None and not (os.path.isabs(root) and os.path.isdir(root)):
+        logger.debug(f"Unexpected mount point for {container}: {root!r}")
+        root = None
+    with session.lock:
+        session.mounts[container] = root
+    return root
+
+
+def unmount(builder, container: str):
+    """Unmount `container` if it was mounted. Call before committing or removing it.
+    """
+    with builder.session.lock:
+        root = builder.session.mounts.pop(container, None)
+    if root is not None:
+        try:
+            builder.buildah("umount", container, print_output=False)
+        except RuntimeError:
+            logger.warning(f"Could not unmount {container}")
+
+
+def copy_into(root: str, source: str, dest: str):
+    """Copy `source` to `dest` below `root`, as `buildah copy` would: the
+    contents of a directory are merged into `dest`; a file is copied into
+    `dest` if it's a directory (or ends with a slash), to `dest` otherwise.
+    """
+    if os.path.isdir(source):
+        target = resolve_in_root(root, dest)
+        os.makedirs(target, exist_ok=True)
+        check_directories(source, target)
+        run_cp("-R", os.path.join(source, "."), target + "/")
+        return
+    target = resolve_in_root(root, dest)
+    if dest.endswith("/") or os.path.isdir(target):
+        os.makedirs(target, exist_ok=True)
+        target = os.path.join(target, os.path.basename(source))
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    run_cp(source, target)
+
+
+def check_directories(source: str, target: str):
+    """Make sure no directory of `source` would be copied into a symbolic link
+    in `target`: `cp` would follow it, maybe outside of the container.
+    """
+    for dirpath, dirs, _ in os.walk(source):
+        relpath = os.path.relpath(dirpath, source)
+        for name in dirs:
+            if os.path.islink(os.path.join(target, relpath, name)):
+                link = os.path.normpath(os.path.join(relpath, name))
+                raise OSError(f"{link} is a symbolic link in the container")
+
+
+def run_cp(*args: str):
+    subprocess.run(["cp"] + CP_OPTIONS + list(args), check=True)
+
+
+def resolve_in_root(root: str, path: str) -> str:
+    """Return the host path of `path` in the container mounted on `root`,
+    following symbolic links as the container would see them: absolute
+    links are relative to `root` and nothing resolves outside of it.
+    """
+    parts = [part for part in path.split("/") if part]
+    resolved: List[str] = []
+    followed = 0
+    while parts:
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = os.path.join(root, *resolved, part)
+        if os.path.islink(candidate):
+            followed += 1
+            if followed > MAX_SYMLINKS:
+                raise OSError(f"Too many levels of symbolic links in {path}")
+            link = os.readlink(candidate)
+            if link.startswith("/"):
+                resolved = []
+            parts = [item for item in link.split("/") if item] + parts
+            continue
+        resolved.append(part)
+    return os.path.join(root, *resolved)
@@ -0,0 +1,158 @@
+"""A long running build server listening on a Unix socket.
+
+Clients send one JSON object per line, like
+`{"command": "resolve", "path": "/abs/path/to/spec/dir"}`
+and get back a single JSON line: `{"result": ...}` or `{"error": "..."}`.
+
+Keeping the process alive keeps the file hash, image inventory and registry caches
+of its build session warm across requests, along with the pool of prepared
+builder containers.
+Concurrent requests for the same image are coalesced into a single build.
+"""
+from derex.builder import logger
+from derex.builder import metrics
+from derex.builder import prefetch
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.builders.base import nodes_to_build
+from derex.builder.builders.base import walk_graph
+from derex.builder.docker_daemon import push_images
+from derex.builder.session import BuildSession
+from derex.builder.session import get_session
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "derex.builder.sock"
+)
+COMMANDS = ("image", "resolve", "push", "push-graph")
+
+
+class DaemonError(Exception):
+    pass
+
+
+class SingleFlight:
+    """Run a function at most once at a time for a given key.
+    Callers arriving while a call for the same key is in flight wait
+    for it and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[str, "_Call"] = {}
+
+    def do(self, key: str, function: Callable[[], Any]) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            logger.info(f"Waiting for in-flight {key}")
+            call.done.wait()
+        else:
+            try:
+                call.result = function()
+            except Exception as exc:
+                call.error = exc
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error = None
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, session: Optional[BuildSession] = None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # Left over from a previous run
+        super().__init__(socket_path, RequestHandler)
+        self.session = session or get_session()
+        self.flights = SingleFlight()
+
+    def dispatch(self, command: str, path: str) -> str:
+        if command not in COMMANDS:
+            raise DaemonError(f"Unknown command: {command}")
+        # Always re-read the spec: the hashes of unchanged files come from the cache
+        self.session.clear_builders()
+        builder = self.session.create_builder(path)
+        if command == "resolve":
+            self.flights.do(f"resolve {builder.dest}", lambda: resolve(builder))
+        elif command == "push":
+            self.flights.do(f"push {builder.dest}", builder.push_to_docker)
+        elif command == "push-graph":
+            push_graph = lambda: push_images(walk_graph(builder))
+            self.flights.do(f"push-graph {builder.dest}", push_graph)
+        return "\n".join(builder.images())
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def resolve(builder: BaseBuilder):
+    prefetch.prefetch(nodes_to_build(builder))
+    builder.resolve()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            logger.info(f"Serving {request['command']} {request['path']}")
+            response = {"result": self.server.dispatch(**request)}
+        except Exception as exc:
+            logger.exception("Error serving request")
+            response = {"error": f"{exc.__class__.__name__}: {exc}"}
+        finally:
+            metrics.write()
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def serve(socket_path: str = DEFAULT_SOCKET):
+    """Serve build requests on the given socket until interrupted.
+    """
+    with BuildServer(socket_path) as server:
+        logger.info(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down")
+        finally:
+            server.session.close()
+
+
+def request(socket_path: str, command: str, path: str) -> str:
+    """Ask the daemon listening on `socket_path` to run `command` on the
+    spec in `path`. Returns the image name.
+    """
+    payload = {"command": command, "path": os.path.abspath(path)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as response_file:
+            response = json.loads(response_file.readline())
+    if "error" in response:
+        raise DaemonError(response["error"])
+    return response["result"]
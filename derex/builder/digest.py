@@ -0,0 +1,47 @@
+"""Pluggable digest algorithms used to hash builder inputs.
+
+The algorithm is a setting of the build session, usually chosen per project:
+`BuildSession(hash_algorithm="blake2b")`, or the DEREX_HASH_ALGORITHM
+environment variable (for instance in a `.envrc` file) for the command line.
+BLAKE2b is usually faster than SHA-256 on CPUs without SHA extensions; run
+`benchmarks/bench_digest.py` to compare them on your build hosts.
+"""
+from typing import Callable
+from typing import Dict
+
+import hashlib
+
+
+ALGORITHMS: Dict[str, Callable] = {
+    "sha256": hashlib.sha256,
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+}
+# Docker tags carry a prefix naming the tag scheme version and the algorithm,
+# so tags produced with different algorithms can never collide.
+# SHA-256 keeps the original, unversioned scheme: existing tags stay valid.
+TAG_PREFIXES = {"sha256": "", "blake2b": "v2-b2-"}
+DEFAULT_ALGORITHM = "sha256"
+
+
+class UnknownAlgorithm(ValueError):
+    pass
+
+
+def check_algorithm(algorithm: str) -> str:
+    if algorithm not in ALGORITHMS:
+        raise UnknownAlgorithm(
+            f"Unknown hash algorithm {algorithm}. Choose one of {', '.join(ALGORITHMS)}"
+        )
+    return algorithm
+
+
+def new(algorithm: str):
+    """Return a new hasher object for the given algorithm.
+    """
+    return ALGORITHMS[check_algorithm(algorithm)]()
+
+
+def tag_prefix(algorithm: str) -> str:
+    """Return the prefix of docker tags for the given algorithm.
+    """
+    return TAG_PREFIXES[check_algorithm(algorithm)]
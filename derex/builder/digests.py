@@ -0,0 +1,197 @@
+"""Pin base images pulled from a registry to the digest their tag points to.
+
+Specs name their registry base images by tag, like `docker.io/library/alpine:3.9`.
+Tags move: with DEREX_PIN_DIGESTS=1 the digest of every such image is looked
+up in its registry and goes into the hash of the builders using it, and the
+image is built from that exact digest. When upstream moves a tag only the
+images based on it (and the ones depending on them) get a new hash.
+
+Digests are looked up in batch, for all the base images the session knows
+about, and cached for DEREX_DIGEST_TTL seconds in DEREX_DIGEST_CACHE (default
+`~/.cache/derex.builder/digests.json`), shared by all processes on the host.
+When a registry can't be reached the last known digest is used, or the tag if
+there is none.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from derex.builder import logger
+from derex.builder.locks import build_lock
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request
+from urllib.request import urlopen
+
+import json
+import os
+import re
+import time
+
+
+DIGEST_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "derex.builder", "digests.json"
+)
+DIGEST_JOBS = 8
+TIMEOUT = 30
+REGISTRY_HOSTS = {"docker.io": "registry-1.docker.io"}
+MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ]
+)
+
+
+def split_tag(image: str) -> Tuple[str, str]:
+    """Split an image reference into its name and tag.
+    """
+    if ":" in image.rsplit("/", 1)[-1]:
+        name, tag = image.rsplit(":", 1)
+        return name, tag
+    return image, "latest"
+
+
+def parse_reference(image: str) -> Tuple[str, str, str]:
+    """Return the registry, repository and tag of an image reference.
+    """
+    name, tag = split_tag(image)
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = "docker.io", name
+    if registry == "docker.io" and "/" not in repository:
+        repository = f"library/{repository}"
+    return registry, repository, tag
+
+
+def query_digest(image: str) -> Optional[str]:
+    """Ask the registry of `image` the digest of the manifest its tag points to.
+    Returns None if the registry can't tell.
+    """
+    registry, repository, tag = parse_reference(image)
+    host = REGISTRY_HOSTS.get(registry, registry)
+    url = f"https://{host}/v2/{repository}/manifests/{tag}"
+    headers = {"Accept": MANIFEST_TYPES}
+    head = lambda: urlopen(
+        Request(url, headers=headers, method="HEAD"), timeout=TIMEOUT
+    )
+    try:
+        try:
+            response = head()
+        except HTTPError as err:
+            challenge = err.headers.get("WWW-Authenticate", "")
+            if err.code != 401 or not challenge.startswith("Bearer "):
+                raise
+            headers["Authorization"] = f"Bearer {get_token(challenge, repository)}"
+            response = head()
+    except (OSError, ValueError, KeyError) as err:
+        logger.warning(f"Could not get the digest of {image}: {err!r}")
+        return None
+    return response.headers.get("Docker-Content-Digest")
+
+
+def get_token(challenge: str, repository: str) -> str:
+    """Get an anonymous pull token as requested by a `WWW-Authenticate` challenge.
+    """
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    query = {
+        "service": params.get("service", ""),
+        "scope": params.get("scope", f"repository:{repository}:pull"),
+    }
+    response = urlopen(f"{params['realm']}?{urlencode(query)}", timeout=TIMEOUT)
+    body = json.loads(response.read())
+    return body.get("token") or body["access_token"]
+
+
+def pin(session, image: str) -> str:
+    """Return `image` pinned to its digest, if the session pins digests.
+    A missing or expired digest is looked up along with the ones of all the
+    other base images of the builders in the session.
+    """
+    if not session.pin_digests or "@" in image:
+        return image
+    if not is_fresh(session, image):
+        with session.lock:
+            builders = list(session.builders.values())
+        sources = [
+            source
+            for builder in builders
+            for source in builder.source_pointers()
+            if isinstance(source, str) and "@" not in source
+        ]
+        refresh(session, [image] + sources)
+    with session.lock:
+        digest = session.digests.get(image, (None,))[0]
+    if digest is None:
+        logger.warning(f"No digest known for {image}: using the tag")
+        return image
+    return f"{split_tag(image)[0]}@{digest}"
+
+
+def is_fresh(session, image: str) -> bool:
+    with session.lock:
+        entry = session.digests.get(image)
+    return entry is not None and time.time() - entry[1] < session.digest_ttl
+
+
+def refresh(session, images: List[str]):
+    """Look up, concurrently, the digests of the `images` not checked in the
+    last `digest_ttl` seconds, by this session or any process using the same cache.
+    """
+    if session.digest_cache:
+        merge(session, read_cache(session.digest_cache))
+    stale = sorted({image for image in images if not is_fresh(session, image)})
+    if not stale:
+        return
+    logger.info(f"Looking up the digests of {len(stale)} base images")
+    with ThreadPoolExecutor(min(len(stale), DIGEST_JOBS)) as executor:
+        found = dict(zip(stale, executor.map(query_digest, stale)))
+    now = time.time()
+    checked = {image: (digest, now) for image, digest in found.items() if digest}
+    merge(session, checked)
+    with session.lock:  # Keep the last known digest (if any) and don't ask again now
+        for image in set(stale) - set(checked):
+            session.digests[image] = (session.digests.get(image, (None,))[0], now)
+    if session.digest_cache and checked:
+        write_cache(session.digest_cache, checked)
+
+
+def merge(session, entries: Dict[str, Tuple[Optional[str], float]]):
+    """Add `entries` to the digests of the session, keeping the most recent ones.
+    """
+    with session.lock:
+        for image, (digest, checked) in entries.items():
+            current = session.digests.get(image)
+            if current is None or current[1] < checked:
+                session.digests[image] = (digest, checked)
+
+
+def read_cache(path: str) -> Dict[str, Tuple[str, float]]:
+    try:
+        with open(path) as fileobj:
+            return {image: tuple(entry) for image, entry in json.load(fileobj).items()}
+    except FileNotFoundError:
+        return {}
+    except (ValueError, TypeError, AttributeError) as err:
+        logger.warning(f"Ignoring unreadable digest cache {path}: {err!r}")
+        return {}
+
+
+def write_cache(path: str, entries: Dict[str, Tuple[str, float]]):
+    """Merge `entries` into the cache file, atomically.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with build_lock(f"digests {os.path.abspath(path)}"):
+        cached = read_cache(path)
+        for image, entry in entries.items():
+            if image not in cached or cached[image][1] < entry[1]:
+                cached[image] = entry
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as fileobj:
+            json.dump(cached, fileobj, indent=2, sort_keys=True)
+        os.replace(temporary, path)
@@ -0,0 +1,108 @@
+"""Talk to the local docker daemon over its Unix socket.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from derex.builder import history
+from derex.builder import logger
+from typing import Iterable
+from typing import List
+from typing import Set
+from urllib.parse import quote
+
+import http.client
+import json
+import os
+import socket
+
+
+def default_socket() -> str:
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://") :]
+    return "/var/run/docker.sock"
+
+
+DOCKER_SOCKET = default_socket()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = 60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def api_get(url: str, socket_path: str = None):
+    """Issue a GET request to the docker daemon API.
+    Returns a tuple (status, parsed JSON body).
+    """
+    connection = UnixHTTPConnection(socket_path or DOCKER_SOCKET)
+    try:
+        connection.request("GET", url)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or "null")
+    finally:
+        connection.close()
+
+
+def normalize(name: str) -> str:
+    """Strip the default registry prefixes docker omits in image names.
+    """
+    for prefix in ("docker.io/library/", "docker.io/", "localhost/"):
+        if name.startswith(prefix):
+            return name[len(prefix) :]
+    return name
+
+
+def present_images(names: Iterable[str], socket_path: str = None) -> Set[str]:
+    """Return the subset of `names` the docker daemon already holds,
+    using a single request. If the daemon can't be reached assume none is present.
+    """
+    try:
+        status, images = api_get("/images/json", socket_path)
+    except OSError as err:
+        logger.warning(f"Could not query the docker daemon: {err}")
+        return set()
+    if status != 200:
+        logger.warning(f"Unexpected response from the docker daemon: {status}")
+        return set()
+    tags = {normalize(tag) for image in images for tag in image.get("RepoTags") or []}
+    return {name for name in names if normalize(name) in tags}
+
+
+def image_present(name: str, socket_path: str = None) -> bool:
+    """Tell whether the docker daemon already holds the image `name`.
+    """
+    try:
+        status, _ = api_get(f"/images/{quote(name, safe='/:')}/json", socket_path)
+    except OSError as err:
+        logger.warning(f"Could not query the docker daemon: {err}")
+        return False
+    return status == 200
+
+
+def push_images(builders: List, jobs: int = 4, socket_path: str = None) -> List[str]:
+    """Push the images of the given builders the docker daemon does not hold
+    yet, running up to `jobs` pushes at the same time. Only those are
+    resolved first: images docker has are neither pulled nor built.
+    Returns the list of pushed images.
+    """
+    dests = [builder.dest for builder in builders]
+    present = present_images(dests, socket_path)
+    for dest in sorted(present):
+        logger.info(f"{dest} already present in docker")
+    missing = [builder for builder in builders if builder.dest not in present]
+    for builder in missing:
+        builder.resolve()
+
+    def push(builder) -> str:
+        logger.info(f"Pushing {builder.dest} to docker")
+        with history.timed(builder, "push"):
+            builder.buildah("push", builder.dest, f"docker-daemon:{builder.dest}")
+        return builder.dest
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return list(executor.map(push, missing))
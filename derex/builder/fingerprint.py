@@ -0,0 +1,174 @@
+"""Fingerprint builder inputs using the git index.
+
+Reading every file in a large `copy:` tree is slow. When the inputs live in a
+git work tree the index already records the object ID of every tracked file,
+so only files that differ from the index (or are not tracked at all) need to
+be read from disk. Those are hashed the same way git would hash them, so a
+file gets the same fingerprint whether it is clean or not.
+Set DEREX_FINGERPRINT=git, or create the session with `fingerprint="git"`,
+to use it.
+"""
+from derex.builder import digest
+from derex.builder import logger
+from derex.builder import metrics
+from derex.builder.ignore import is_excluded_path
+from functools import partial
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import hashlib
+import os
+import subprocess
+
+
+SYMLINK_MODE = "120000"
+GITLINK_MODE = "160000"
+
+
+def git(cwd: str, *args: str) -> bytes:
+    return subprocess.check_output(
+        ("git",) + args, cwd=cwd, stderr=subprocess.DEVNULL
+    )
+
+
+def hash_object(filepath: str, object_format: str = "sha1") -> str:
+    """Return the object ID git would assign to the contents of `filepath`.
+    """
+    size = os.stat(filepath).st_size
+    hasher = hashlib.new(object_format)
+    hasher.update(f"blob {size}\0".encode("utf-8"))
+    with metrics.timer("hashing_seconds_total"), open(filepath, "rb") as fileobj:
+        while True:
+            data = fileobj.read(64 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    metrics.inc("hashed_bytes_total", size)
+    return hasher.hexdigest()
+
+
+def git_file_ids(
+    cwd: str, paths: List[str], exclude: List[str] = []
+) -> Optional[Dict[str, str]]:
+    """Map the absolute path of every file found below `paths` (relative to `cwd`)
+    to its git object ID. Files matching the `exclude` patterns are left out.
+    Returns None if `cwd` is not inside a git work tree.
+    """
+    try:
+        toplevel = git(cwd, "rev-parse", "--show-toplevel").decode().strip()
+        toplevel = os.path.realpath(toplevel)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    try:
+        object_format = (
+            git(cwd, "rev-parse", "--show-object-format").decode().strip()
+        )
+    except subprocess.CalledProcessError:  # git < 2.25 only knows about sha1
+        object_format = "sha1"
+    pathspecs = ["--"] + list(paths)
+    absolute = lambda name: os.path.join(toplevel, name)
+
+    ids: Dict[str, str] = {}
+    from_disk: List[str] = []
+    # Tracked files, with the object ID recorded in the index
+    staged = git(cwd, "ls-files", "-s", "-z", "--full-name", *pathspecs)
+    for entry in filter(None, staged.split(b"\0")):
+        info, name = entry.decode("utf-8").split("\t", 1)
+        mode, object_id, stage = info.split()
+        if mode == GITLINK_MODE:  # A submodule: walk it like any other directory
+            from_disk += [
+                str(path) for path in Path(absolute(name)).rglob("*") if path.is_file()
+            ]
+        elif mode == SYMLINK_MODE or stage != "0":  # Follow links, as os.walk does
+            from_disk.append(absolute(name))
+        else:
+            ids[absolute(name)] = object_id
+    # Tracked files whose work tree content differs from the index
+    for name in modified_files(cwd, pathspecs):
+        ids.pop(absolute(name), None)
+        from_disk.append(absolute(name))
+    # Untracked files, ignored ones included, since they end up in the image too
+    others = git(cwd, "ls-files", "-o", "-z", "--full-name", *pathspecs)
+    from_disk += [
+        absolute(name.decode("utf-8")) for name in filter(None, others.split(b"\0"))
+    ]
+
+    if exclude:
+        wanted = partial(is_wanted, os.path.realpath(cwd), paths, exclude)
+        ids = {key: value for key, value in ids.items() if wanted(key)}
+        from_disk = list(filter(wanted, from_disk))
+    for filepath in from_disk:
+        if os.path.isfile(filepath):
+            ids[filepath] = hash_object(filepath, object_format)
+    logger.debug(f"Read {len(from_disk)} files from disk, {len(ids)} fingerprinted")
+    return ids
+
+
+def modified_files(cwd: str, pathspecs: List[str]) -> List[str]:
+    """Return the names (relative to the repository root) of tracked files
+    whose work tree content differs from the index.
+    """
+    status = git(
+        cwd, "status", "--porcelain", "-z", "--untracked-files=no", *pathspecs
+    )
+    names = []
+    entries = iter(status.split(b"\0"))
+    for entry in filter(None, entries):
+        code, name = entry[:2].decode(), entry[3:].decode("utf-8")
+        if code[0] in "RC":
+            next(entries)  # Skip the rename/copy source
+        if code[1] != " ":
+            names.append(name)
+    return names
+
+
+def is_wanted(realcwd: str, paths: List[str], exclude: List[str], filepath: str):
+    """Tell whether `filepath` belongs to the requested `paths` once the
+    exclude patterns are applied.
+    """
+    relpath = os.path.relpath(filepath, realcwd)
+    for top in map(os.path.normpath, paths):
+        if relpath == top:  # Files listed explicitly are never excluded
+            return True
+        below = top == "." or relpath.startswith(top + os.sep)
+        if below and not is_excluded_path(relpath, exclude, top):
+            return True
+    return False
+
+
+def git_hashes(
+    cwd: str,
+    files: List[str],
+    exclude: List[str] = [],
+    algorithm: str = digest.DEFAULT_ALGORITHM,
+) -> Optional[List[str]]:
+    """Return a list of hex digests for the given files or directories,
+    like `BaseBuilder.hash_files` computes them, but based on git object IDs.
+    Directories are hashed with `algorithm`.
+    Returns None if `cwd` is not inside a git work tree.
+    """
+    ids = git_file_ids(cwd, files, exclude)
+    if ids is None:
+        return None
+    realcwd = os.path.realpath(cwd)
+    paths = [os.path.realpath(os.path.join(cwd, name)) for name in files]
+    file_hashes = [
+        ids.get(path) or hash_object(path) for path in paths if os.path.isfile(path)
+    ]
+    dir_hashes = []
+    for path in filter(os.path.isdir, paths):
+        prefix = path + os.sep
+        top = os.path.relpath(path, realcwd)
+        values = [
+            value
+            for filepath, value in ids.items()
+            if filepath.startswith(prefix)
+            and not is_excluded_path(os.path.relpath(filepath, realcwd), exclude, top)
+        ]
+        hasher = digest.new(algorithm)
+        for value in sorted(values):
+            hasher.update(value.encode("utf-8"))
+        dir_hashes.append(hasher.hexdigest())
+    return file_hashes + dir_hashes
@@ -0,0 +1,223 @@
+"""Record how long builds, pulls and pushes take, how big the built images
+are and what their inputs were, in a small sqlite database.
+
+The database lives in DEREX_HISTORY_DB (default
+`~/.cache/derex.builder/history.sqlite`). Set the variable to an empty string
+to disable recording.
+Timings are keyed on the image name (the `dest` in the spec, without tag),
+so they survive changes to the spec, plus the variant for specs with a matrix.
+History is only advisory: a database that can't be opened or read is logged
+and treated as empty, it never fails a build.
+"""
+from contextlib import contextmanager
+from derex.builder import logger
+from typing import Dict
+from typing import Any
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import json
+import os
+import sqlite3
+import time
+
+
+HISTORY_DB = os.environ.get(
+    "DEREX_HISTORY_DB",
+    os.path.join(os.path.expanduser("~"), ".cache", "derex.builder", "history.sqlite"),
+)
+# Used for images we never built before
+DEFAULT_ESTIMATE = 60.0
+# How many recent runs to consider when estimating durations
+WINDOW = 5
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS timings (
+    name TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    step TEXT NOT NULL DEFAULT '',
+    seconds REAL NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_name ON timings (name, phase, step, finished);
+CREATE TABLE IF NOT EXISTS sizes (
+    name TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    name TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    hashes TEXT NOT NULL,
+    finished REAL NOT NULL
+);
+"""
+
+
+@contextmanager
+def connect() -> Iterator[sqlite3.Connection]:
+    os.makedirs(os.path.dirname(HISTORY_DB), exist_ok=True)
+    connection = sqlite3.connect(HISTORY_DB, timeout=30)
+    try:
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def name_of(builder) -> str:
+    """Return the name the history of `builder` is kept under. The variants of
+    a matrix share the image name, so theirs include the variant.
+    """
+    if builder.variant is None:
+        return builder.conf["dest"]
+    return f"{builder.conf['dest']}@{builder.variant}"
+
+
+def read(query: str, params: Tuple) -> List[Tuple[Any, ...]]:
+    """Return the rows of a query on the database, or none if it can't be read.
+    """
+    if not HISTORY_DB or not os.path.exists(HISTORY_DB):
+        return []
+    try:
+        with connect() as connection:
+            return connection.execute(query, params).fetchall()
+    except (OSError, sqlite3.Error) as err:
+        logger.warning(f"Could not read the history in {HISTORY_DB}: {err}")
+        return []
+
+
+def record(name: str, dest: str, phase: str, seconds: float, step: str = ""):
+    """Store a timing. Failures are logged and otherwise ignored.
+    """
+    if not HISTORY_DB:
+        return
+    try:
+        with connect() as connection:
+            connection.execute(
+                "INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?)",
+                (name, dest, phase, step, seconds, time.time()),
+            )
+    except (OSError, sqlite3.Error) as err:
+        logger.warning(f"Could not record timing in {HISTORY_DB}: {err}")
+
+
+@contextmanager
+def timed(builder, phase: str, step: str = "") -> Iterator[None]:
+    """Record the time spent in the context, unless it raises.
+    """
+    start = time.monotonic()
+    yield
+    seconds = time.monotonic() - start
+    logger.debug(f"{builder.dest} {phase} {step} took {seconds:.1f}s")
+    record(name_of(builder), builder.dest, phase, seconds, step)
+
+
+def record_size(name: str, dest: str, size: int):
+    """Store the size of a freshly built image. Failures are logged and otherwise ignored.
+    """
+    if not HISTORY_DB:
+        return
+    try:
+        with connect() as connection:
+            connection.execute(
+                "INSERT INTO sizes VALUES (?, ?, ?, ?)", (name, dest, size, time.time())
+            )
+    except (OSError, sqlite3.Error) as err:
+        logger.warning(f"Could not record size in {HISTORY_DB}: {err}")
+
+
+def previous_size(name: str, dest: str) -> Optional[int]:
+    """Return the size of the most recent build of `name` other than `dest`,
+    or None if there is no record.
+    """
+    rows = read(
+        "SELECT bytes FROM sizes WHERE name = ? AND dest != ? "
+        "ORDER BY finished DESC LIMIT 1",
+        (name, dest),
+    )
+    return rows[0][0] if rows else None
+
+
+def record_inputs(name: str, dest: str, hashes: Dict[str, str]):
+    """Store the input hashes of a freshly built image.
+    Failures are logged and otherwise ignored.
+    """
+    if not HISTORY_DB:
+        return
+    try:
+        with connect() as connection:
+            connection.execute(
+                "INSERT INTO inputs VALUES (?, ?, ?, ?)",
+                (name, dest, json.dumps(hashes, sort_keys=True), time.time()),
+            )
+    except (OSError, sqlite3.Error) as err:
+        logger.warning(f"Could not record inputs in {HISTORY_DB}: {err}")
+
+
+def previous_inputs(name: str, dest: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """Return the image and input hashes of the most recent build of `name`
+    other than `dest`, or None if there is no record.
+    """
+    rows = read(
+        "SELECT dest, hashes FROM inputs WHERE name = ? AND dest != ? "
+        "ORDER BY finished DESC LIMIT 1",
+        (name, dest),
+    )
+    return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+
+def durations(name: str, phase: str = "build", step: str = "") -> List[float]:
+    """Return the recorded durations, most recent first.
+    """
+    rows = read(
+        "SELECT seconds FROM timings WHERE name = ? AND phase = ? AND step = ? "
+        "ORDER BY finished DESC",
+        (name, phase, step),
+    )
+    return [seconds for seconds, in rows]
+
+
+def estimate(name: str, phase: str = "build") -> Optional[float]:
+    """Return the expected duration based on the most recent runs,
+    or None if there is no record.
+    """
+    recent = durations(name, phase)[:WINDOW]
+    if not recent:
+        return None
+    return sorted(recent)[len(recent) // 2]
+
+
+def summary() -> List[Dict]:
+    """Return one entry per image name, phase and step with statistics on
+    the recorded durations. An entry is flagged as a regression when its last
+    run took more than 1.5 times the average of the previous ones.
+    """
+    keys = read(
+        "SELECT DISTINCT name, phase, step FROM timings ORDER BY name, phase, step", ()
+    )
+    result = []
+    for name, phase, step in keys:
+        values = durations(name, phase, step)
+        if not values:  # The database went away meanwhile
+            continue
+        previous = values[1:]
+        mean = sum(previous) / len(previous) if previous else values[0]
+        result.append(
+            {
+                "name": name,
+                "phase": phase,
+                "step": step,
+                "runs": len(values),
+                "last": values[0],
+                "mean": sum(values) / len(values),
+                "min": min(values),
+                "max": max(values),
+                "regression": bool(previous) and values[0] > 1.5 * mean,
+            }
+        )
+    return result
@@ -0,0 +1,135 @@
+"""Exclude files from hashing and copying.
+
+Patterns come from a `.derexignore` file in the spec directory and from the
+`exclude` list in the spec. They follow a subset of the gitignore syntax:
+
+* blank lines and lines starting with `#` are ignored
+* a pattern without a slash is matched against the name of each file or directory
+* a pattern containing a slash is matched against the path relative to the
+  spec directory
+* a trailing slash restricts the pattern to directories
+* a leading `!` re-includes what a previous pattern excluded
+
+Excluded directories are never descended into.
+"""
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from typing import Union
+
+import errno
+import os
+import shutil
+
+
+IGNORE_FILE = ".derexignore"
+
+
+def load_patterns(path: str, conf: Dict) -> List[str]:
+    """Return the exclude patterns for the spec in `path`.
+    """
+    patterns: List[str] = []
+    ignore_file = os.path.join(path, IGNORE_FILE)
+    if os.path.isfile(ignore_file):
+        with open(ignore_file) as fileobj:
+            for line in fileobj:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+    return patterns + list(conf.get("exclude", []))
+
+
+def is_excluded(relpath: str, patterns: List[str], is_dir: bool = False) -> bool:
+    """Tell whether `relpath` (relative to the spec directory) matches the patterns.
+    Only the path itself is checked, not its parent directories.
+    """
+    relpath = relpath.replace(os.sep, "/")
+    name = relpath.rsplit("/", 1)[-1]
+    excluded = False
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip("/")
+        if "/" in pattern:
+            matches = fnmatchcase(relpath, pattern.lstrip("/"))
+        else:
+            matches = fnmatchcase(name, pattern)
+        if matches:
+            excluded = not negated
+    return excluded
+
+
+def is_excluded_path(relpath: str, patterns: List[str], top: str = ".") -> bool:
+    """Tell whether the file at `relpath` or any of its parent directories
+    below `top` matches the patterns. This is what `walk_files` would decide
+    when walking `top`.
+    """
+    parts = relpath.replace(os.sep, "/").split("/")
+    top = os.path.normpath(top)
+    start = 0 if top == "." else len(top.split(os.sep))
+    for index in range(start + 1, len(parts)):
+        if is_excluded("/".join(parts[:index]), patterns, is_dir=True):
+            return True
+    return is_excluded(relpath, patterns)
+
+
+def walk_files(
+    dirname: Union[Path, str],
+    patterns: List[str],
+    root: Union[Path, str],
+    include_dirs: bool = False,
+) -> Iterator[Tuple[str, str]]:
+    """Yield `(path, relative_path)` for every file below `dirname` that is not
+    excluded. Paths used for matching are relative to `root`, the spec directory.
+    Directories are yielded too if `include_dirs` is True.
+    Directories and files are visited in sorted order.
+    """
+    for dirpath, dirs, files in os.walk(dirname):
+        reldir = os.path.relpath(dirpath, root)
+        prefix = "" if reldir == "." else reldir + "/"
+        dirs[:] = sorted(
+            name
+            for name in dirs
+            if not is_excluded(prefix + name, patterns, is_dir=True)
+        )
+        if include_dirs:
+            for name in dirs:
+                yield os.path.join(dirpath, name), prefix + name
+        for name in sorted(files):
+            if not is_excluded(prefix + name, patterns):
+                yield os.path.join(dirpath, name), prefix + name
+
+
+def stage_directory(
+    dirname: str, patterns: List[str], root: str, destination: str
+) -> str:
+    """Populate `destination` with the files of `dirname` that are not excluded.
+    Files are hard linked when possible, copied otherwise. Symbolic links are
+    recreated as they are, like `buildah copy` does: the contents of linked
+    directories are neither hashed nor copied.
+    Returns `destination`.
+    """
+    for path, _ in walk_files(dirname, patterns, root, include_dirs=True):
+        target = os.path.join(destination, os.path.relpath(path, dirname))
+        if os.path.islink(path):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.symlink(os.readlink(path), target)
+            continue
+        if os.path.isdir(path):
+            os.makedirs(target, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(path, target)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(path, target)
+    return destination
@@ -0,0 +1,115 @@
+"""Advisory file locks shared by all derex.builder processes on a host.
+
+Processes also hold a lock on an owner lease for their whole lifetime, so
+that what they leave behind (pool containers, resource reservations) can be
+told apart from what live processes are using. Unlike process IDs, leases
+mean the same thing in every PID namespace sharing the lock directory.
+"""
+from contextlib import contextmanager
+from derex.builder import logger
+from typing import Dict
+from typing import IO
+from typing import Iterator
+from typing import Optional
+from urllib.parse import quote
+from uuid import uuid4
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+
+LOCK_DIR = os.environ.get(
+    "DEREX_LOCK_DIR", os.path.join(tempfile.gettempdir(), "derex.builder.locks")
+)
+OWNER_LENGTH = 12
+
+# The owner ID of this process, the process it was taken by, and its leases
+# by lock directory
+OWNER: Optional[str] = None
+OWNER_PID: Optional[int] = None
+OWNER_LEASES: Dict[str, IO] = {}
+OWNER_LOCK = threading.Lock()
+
+
+def lock_path(name: str) -> str:
+    """Return the path of the lock file for the given name (usually an image tag).
+    """
+    return os.path.join(LOCK_DIR, quote(name, safe="") + ".lock")
+
+
+def ensure_lock_dir():
+    if not os.path.isdir(LOCK_DIR):
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        try:  # Let other users on this host take locks too
+            os.chmod(LOCK_DIR, 0o1777)
+        except PermissionError:
+            pass
+
+
+def lease_path(owner: str) -> str:
+    return os.path.join(LOCK_DIR, f"owner-{owner}.lease")
+
+
+def owner_id() -> str:
+    """Return the owner ID of this process, taking its lease in the lock
+    directory the first time.
+    """
+    global OWNER, OWNER_PID
+    with OWNER_LOCK:
+        if OWNER is None or OWNER_PID != os.getpid():  # Not inherited by forks
+            OWNER, OWNER_PID = uuid4().hex[:OWNER_LENGTH], os.getpid()
+            OWNER_LEASES.clear()
+        if LOCK_DIR not in OWNER_LEASES:
+            ensure_lock_dir()
+            lease = open(lease_path(OWNER), "a")
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            OWNER_LEASES[LOCK_DIR] = lease
+        return OWNER
+
+
+def owner_alive(owner: str) -> Optional[bool]:
+    """Tell whether the process that took the owner ID `owner` is still running.
+    Returns None if its lease is unknown here: it was taken with another lock
+    directory, maybe on another host. The lease of a dead owner is removed.
+    """
+    path = lease_path(owner)
+    try:
+        lease = open(path, "r")
+    except FileNotFoundError:
+        return None
+    with lease:
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+@contextmanager
+def build_lock(name: str) -> Iterator[float]:
+    """Hold an exclusive lock on `name` for the duration of the context.
+    Yields the number of seconds spent waiting for it.
+    Works across processes as well as across threads of the same process.
+    """
+    ensure_lock_dir()
+    with open(lock_path(name), "a") as lockfile:
+        waited = 0.0
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Waiting for lock on {name} held by another build")
+            start = time.monotonic()
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            waited = time.monotonic() - start
+            logger.info(f"Acquired lock on {name} after {waited:.1f}s")
+        try:
+            yield waited
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
@@ -0,0 +1,180 @@
+"""Export metrics in the Prometheus textfile collector format.
+
+Set DEREX_METRICS_TEXTFILE to the path of a `.prom` file (or to the textfile
+collector directory) to have metrics written at the end of every run.
+Counters are added to the values already in the file, so they keep growing
+across runs like the counters of a long running process would.
+"""
+from contextlib import contextmanager
+from derex.builder import logger
+from derex.builder.locks import build_lock
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+
+import os
+import threading
+import time
+
+
+METRICS_TEXTFILE = os.environ.get("DEREX_METRICS_TEXTFILE")
+PREFIX = "derex_builder_"
+METRICS = {
+    "resolutions_total": (
+        "counter",
+        "Images resolved, by spec and outcome (local, waited, import, cache, "
+        "registry or built)",
+    ),
+    "hashed_bytes_total": ("counter", "Bytes read to hash builder inputs"),
+    "hashing_seconds_total": ("counter", "Seconds spent hashing builder inputs"),
+    "buildah_seconds_total": ("counter", "Seconds spent in buildah, by subcommand"),
+    "buildah_calls_total": ("counter", "Buildah invocations, by subcommand"),
+    "admission_wait_seconds_total": (
+        "counter",
+        "Seconds builds waited for their resource budget to fit the host",
+    ),
+    "copies_total": (
+        "counter",
+        "Files and directories copied into containers, by method (mount or buildah)",
+    ),
+    "wheel_cache_total": (
+        "counter",
+        "Wheels found in (hit) or missing from (miss) the wheels cache",
+    ),
+    "image_size_bytes": ("gauge", "Size of the last image built, by spec"),
+    "cache_size_bytes": ("gauge", "Size of the cache directories mounted in builds"),
+    "last_run_timestamp_seconds": ("gauge", "When metrics were last written"),
+}
+
+VALUES: Dict[str, float] = {}
+# Host directories of the caches mounted in build containers during this run
+MOUNTED_CACHES: Dict[str, str] = {}
+LOCK = threading.Lock()
+
+
+def series(name: str, labels: Dict[str, str]) -> str:
+    if name not in METRICS:
+        raise KeyError(f"Unknown metric {name}")
+    if not labels:
+        return PREFIX + name
+    rendered = ",".join(
+        f'{key}="{escape(str(value))}"' for key, value in sorted(labels.items())
+    )
+    return f"{PREFIX}{name}{{{rendered}}}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def inc(name: str, value: float = 1.0, **labels: str):
+    """Increment a counter.
+    """
+    key = series(name, labels)
+    with LOCK:
+        VALUES[key] = VALUES.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels: str):
+    key = series(name, labels)
+    with LOCK:
+        VALUES[key] = value
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    """Add the seconds spent in the context to a counter.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        inc(name, time.monotonic() - start, **labels)
+
+
+def metric_name(key: str) -> str:
+    return key.split("{", 1)[0][len(PREFIX) :]
+
+
+def read_textfile(path: str) -> Dict[str, float]:
+    values: Dict[str, float] = {}
+    if not os.path.isfile(path):
+        return values
+    with open(path) as fileobj:
+        for line in fileobj:
+            if line.startswith("#") or not line.strip():
+                continue
+            key, value = line.rstrip().rsplit(" ", 1)
+            if metric_name(key) in METRICS:
+                values[key] = float(value)
+    return values
+
+
+def render(values: Dict[str, float]) -> str:
+    lines = []
+    for name, (kind, description) in sorted(METRICS.items()):
+        keys = sorted(key for key in values if metric_name(key) == name)
+        if not keys:
+            continue
+        lines.append(f"# HELP {PREFIX}{name} {description}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        lines += [f"{key} {values[key]!r}" for key in keys]
+    return "\n".join(lines) + "\n"
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def mounted_cache(name: str, source: str):
+    """Remember that the cache directory `source` was mounted in a build,
+    so that its size is reported when metrics are written.
+    """
+    with LOCK:
+        MOUNTED_CACHES[name] = source
+
+
+def collect_cache_sizes():
+    """Measure the caches mounted in builds during this run. Runs that
+    built nothing don't walk the cache directories.
+    """
+    with LOCK:
+        caches = dict(MOUNTED_CACHES)
+        MOUNTED_CACHES.clear()
+    for name, source in caches.items():
+        if os.path.isdir(source):
+            set_gauge("cache_size_bytes", directory_size(source), cache=name)
+
+
+def write(path: Optional[str] = None):
+    """Merge the metrics of this run into the textfile, atomically.
+    Does nothing unless a path is given or DEREX_METRICS_TEXTFILE is set.
+    """
+    path = path or METRICS_TEXTFILE
+    if not path:
+        return
+    if os.path.isdir(path):
+        path = os.path.join(path, "derex_builder.prom")
+    collect_cache_sizes()
+    set_gauge("last_run_timestamp_seconds", time.time())
+    with LOCK:
+        current = dict(VALUES)
+        VALUES.clear()
+    with build_lock(f"metrics {os.path.abspath(path)}"):
+        values = read_textfile(path)
+        for key, value in current.items():
+            if METRICS[metric_name(key)][0] == "counter":
+                value += values.get(key, 0.0)
+            values[key] = value
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as fileobj:
+            fileobj.write(render(values))
+        os.replace(temporary, path)
+    logger.debug(f"Wrote metrics to {path}")
@@ -0,0 +1,103 @@
+"""Tell what resolving a graph would do, without pulling or building anything.
+
+Only cheap checks are made: the hashes of the inputs (cached by the session),
+the local image inventory, the import directory and artifact cache, and the
+registry availability cache of the session. The docker registry is only
+asked when requested. Like resolving, planning starts from the requested
+image and doesn't look at what available images are based on.
+For every image that would be built the inputs that
+changed since the last recorded build of the same spec are listed:
+the spec itself (`conf`), single scripts, copied paths, requirements files,
+and the images it's based on (`source`).
+"""
+from derex.builder import history
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.builders.base import walk_graph
+from typing import Dict
+from typing import List
+
+import os
+
+
+# What resolving would do with each image, from cheapest to most expensive
+ACTIONS = ("present", "import", "fetch", "pull", "build")
+# Action and reason for each place `BaseBuilder.locate` finds images in
+LOCATIONS = {
+    "local": ("present", "found locally"),
+    "import": ("import", "in the import directory"),
+    "cache": ("fetch", "in the artifact cache"),
+    "registry": ("pull", "on the docker registry"),
+}
+
+
+def plan(builder: BaseBuilder, check_registry: bool = False) -> List[Dict]:
+    """Return an entry for every image resolving `builder` would touch,
+    dependencies first: the images that are available are listed, but not
+    the ones they are based on. With `check_registry` images not known to be
+    on the docker registry are looked up there.
+    """
+    entries: Dict[str, Dict] = {}
+
+    def available(node: BaseBuilder) -> bool:
+        entries[node.dest] = plan_node(node, check_registry)
+        return entries[node.dest]["action"] != "build"
+
+    nodes = walk_graph(builder, available=available)
+    return [entries[node.dest] for node in nodes]
+
+
+def plan_node(node: BaseBuilder, check_registry: bool) -> Dict:
+    entry = {
+        "dest": node.dest,
+        "spec": node.conf["dest"],
+        "path": os.path.abspath(node.path),
+        "variant": node.variant,
+        "action": "build",
+    }
+    location = node.locate(check_registry=check_registry)
+    if location is not None:
+        action, reason = LOCATIONS[location]
+        return dict(entry, action=action, reason=reason)
+    previous = history.previous_inputs(history.name_of(node), node.dest)
+    if previous is None:
+        return dict(entry, reason="no previous build recorded", changes=[])
+    changes = diff_inputs(previous[1], node.input_hashes())
+    reason = "inputs changed" if changes else "not available"
+    return dict(entry, reason=reason, previous=previous[0], changes=changes)
+
+
+def diff_inputs(old: Dict[str, str], new: Dict[str, str]) -> List[Dict]:
+    """Return the inputs that were added, removed or modified between two builds.
+    """
+    changes = []
+    for name in sorted(set(old) | set(new)):
+        if name not in old:
+            changes.append({"input": name, "change": "added"})
+        elif name not in new:
+            changes.append({"input": name, "change": "removed"})
+        elif old[name] != new[name]:
+            changes.append({"input": name, "change": "modified"})
+    return changes
+
+
+def summary(entries: List[Dict]) -> Dict[str, int]:
+    return {
+        action: sum(1 for entry in entries if entry["action"] == action)
+        for action in ACTIONS
+    }
+
+
+def render(entries: List[Dict]) -> str:
+    """Format a plan for humans.
+    """
+    lines = []
+    for entry in entries:
+        line = f"{entry['action']:8} {entry['dest']}: {entry['reason']}"
+        changes = entry.get("changes")
+        if changes:
+            names = ", ".join(f"{item['input']} {item['change']}" for item in changes)
+            line += f" ({names})"
+        lines.append(line)
+    counts = summary(entries)
+    lines.append(", ".join(f"{counts[action]} {action}" for action in ACTIONS))
+    return "\n".join(lines)
@@ -0,0 +1,155 @@
+"""Keep prepared builder containers around for reuse.
+
+Builds based on the same builder image all start with `buildah from` and the same
+setup commands. Containers given back in a clean state are kept, at most
+`size` per image, and handed out to later builds using the same pool: every
+build session has one, that lives as long as the session (for the length of
+a run, or for the whole lifetime of the daemon).
+Idle containers are removed when the session is closed, or on exit for the
+sessions still alive then.
+Containers left behind by processes that died without cleaning up are removed
+the next time a pool is used. Container names carry the owner ID of the process
+that created them: see `derex.builder.locks`.
+"""
+from contextlib import contextmanager
+from derex.builder import logger
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.locks import OWNER_LENGTH
+from derex.builder.locks import owner_alive
+from derex.builder.locks import owner_id
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Sequence
+from typing import Tuple
+from uuid import uuid4
+
+import atexit
+import re
+import threading
+import weakref
+
+
+PREFIX = "derex-pool"
+
+SWEEP_LOCK = threading.Lock()
+SWEPT = False
+# Pools of the sessions still alive, closed on exit
+POOLS: "weakref.WeakSet[ContainerPool]" = weakref.WeakSet()
+
+
+class ContainerPool:
+    """Idle builder containers, at most `size` per image.
+    """
+
+    def __init__(self, size: int = 2):
+        self.size = size
+        self.idle: Dict[str, List[Tuple[str, Any]]] = {}
+        self.lock = threading.Lock()
+        POOLS.add(self)
+
+    @contextmanager
+    def container(
+        self,
+        image: str,
+        prepare: Callable[[str], Any],
+        reset: Callable[[str, Any], bool],
+        options: Sequence[str] = (),
+    ) -> Iterator[str]:
+        """Yield a container of `image`. New containers are set up by calling
+        `prepare(container)`. When the context exits `reset(container, state)`,
+        `state` being what `prepare` returned, must undo the changes made to the
+        container and tell whether it can be reused.
+        Containers are removed if the context raises or if they can't be reused.
+        They are created with the `buildah from` `options`, and only reused
+        with the same ones.
+        """
+        sweep()
+        key = " ".join([image] + list(options))
+        with self.lock:
+            idle = self.idle.get(key, [])
+            entry = idle.pop() if idle else None
+        if entry is not None:
+            logger.info(f"Reusing container {entry[0]} of {image}")
+        else:
+            name = f"{PREFIX}-{owner_id()}-{uuid4().hex[:8]}"
+            new = BaseBuilder.buildah(
+                "from", "--name", name, *options, image, print_output=False
+            )
+            try:
+                entry = new, prepare(new)
+            except BaseException:
+                remove(new)
+                raise
+        try:
+            yield entry[0]
+        except BaseException:
+            remove(entry[0])
+            raise
+        self.release(key, entry, reset)
+
+    def release(
+        self, key: str, entry: Tuple[str, Any], reset: Callable[[str, Any], bool]
+    ):
+        try:
+            reusable = self.size > 0 and reset(*entry)
+        except Exception as err:
+            logger.warning(f"Could not reset container {entry[0]}: {err!r}")
+            reusable = False
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if reusable and len(idle) < self.size:
+                idle.append(entry)
+                return
+        remove(entry[0])
+
+    def close(self):
+        """Remove all idle containers.
+        """
+        with self.lock:
+            entries = [entry for idle in self.idle.values() for entry in idle]
+            self.idle.clear()
+        for name, _ in entries:
+            remove(name)
+
+
+@atexit.register
+def close_pools():
+    for containers in list(POOLS):
+        containers.close()
+
+
+def remove(name: str):
+    try:
+        BaseBuilder.buildah("rm", name, print_output=False)
+    except RuntimeError:
+        logger.warning(f"Could not remove container {name}")
+
+
+def sweep():
+    """Remove pool containers whose process is gone. Runs once per process.
+    Containers of unknown owners, like processes in another container sharing
+    the buildah store, are left alone.
+    """
+    global SWEPT
+    with SWEEP_LOCK:
+        if SWEPT:
+            return
+        SWEPT = True
+    try:
+        names = BaseBuilder.buildah(
+            "containers",
+            "--noheading",
+            "--format",
+            "{{.ContainerName}}",
+            print_output=False,
+        ).split()
+    except RuntimeError:
+        return
+    for name in names:
+        match = re.match(rf"{PREFIX}-([0-9a-f]{{{OWNER_LENGTH}}})-", name)
+        if match and owner_alive(match.group(1)) is False:
+            logger.info(f"Removing stale container {name}")
+            remove(name)
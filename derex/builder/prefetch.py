@@ -0,0 +1,102 @@
+"""Pull base images in the background while other images are being built.
+"""
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from derex.builder import logger
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import os
+import threading
+
+
+PREFETCH_JOBS = int(os.environ.get("DEREX_PREFETCH_JOBS", "3"))
+
+FUTURES: Dict[str, Future] = {}
+LOCK = threading.Lock()
+EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def base_images(builders: List) -> List[str]:
+    """Return the images pulled from a registry the given builders are based on,
+    as the builds will refer to them: pinned to their digest if the session
+    pins digests.
+    """
+    images: List[str] = []
+    for builder in builders:
+        for source in builder.source_pointers():
+            if not isinstance(source, str):
+                continue
+            image = builder.pin(source)
+            if image not in images:
+                images.append(image)
+    return images
+
+
+def is_local(image: str, local_images: List[str]) -> bool:
+    """Tell whether `image`, a tag or a reference pinned to a digest, is in
+    the buildah inventory. Having the tag doesn't mean having the digest
+    it's pinned to: a pinned reference is only local if it was pulled before.
+    """
+    # Image names in the buildah inventory lack the registry component
+    return image in local_images or image.split("/", 1)[-1] in local_images
+
+
+def prefetch(builders: List, jobs: int = PREFETCH_JOBS) -> List[str]:
+    """Start pulling in the background the base images of the given builders
+    that are not available locally, at most `jobs` at a time. Pass the
+    builders that are going to be built: see `nodes_to_build`.
+    Returns the list of images being pulled. Prefetching is only an
+    optimization: errors are logged and nothing is pulled.
+    """
+    global EXECUTOR
+    if not builders or jobs < 1:
+        return []
+    try:
+        local_images = builders[0].list_buildah_images(session=builders[0].session)
+    except (OSError, RuntimeError) as err:
+        logger.warning(f"Not prefetching base images: {err!r}")
+        return []
+    missing = [
+        image for image in base_images(builders) if not is_local(image, local_images)
+    ]
+    with LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(jobs, thread_name_prefix="prefetch")
+        for image in missing:
+            if image not in FUTURES or FUTURES[image].done():
+                logger.info(f"Prefetching {image}")
+                FUTURES[image] = EXECUTOR.submit(
+                    builders[0].buildah, "pull", "--quiet", image, print_output=False
+                )
+    return missing
+
+
+def wait(image: str):
+    """If `image` is being prefetched wait for the pull to finish.
+    Errors are only logged: `buildah from` will try pulling it again.
+    """
+    with LOCK:
+        future = FUTURES.get(image)
+    if future is None:
+        return
+    if not future.done():
+        logger.info(f"Waiting for {image} to be downloaded")
+    try:
+        future.result()
+    except Exception as err:
+        logger.warning(f"Prefetching {image} failed: {err!r}")
+
+
+def shutdown():
+    """Cancel pending pulls and wait for the running ones.
+    """
+    global EXECUTOR
+    with LOCK:
+        for future in FUTURES.values():
+            future.cancel()
+        FUTURES.clear()
+        executor, EXECUTOR = EXECUTOR, None
+    if executor is not None:
+        executor.shutdown(wait=True)
@@ -0,0 +1,218 @@
+"""Resource budgets of builds, and admission of builds on a host.
+
+A spec gives its builds a budget in its `resources` section; the session
+(the command line, or DEREX_CPUS, DEREX_CPUSET, DEREX_CPU_SHARES, DEREX_MEMORY
+and DEREX_MAKE_JOBS) provides defaults for the keys a spec leaves out:
+
+    resources:
+      cpus: 2           # CPU time, in CPUs
+      cpuset: "0-3"     # CPUs the build may run on
+      cpu_shares: 512   # Weight against other containers when CPUs are busy
+      memory: 4G
+      jobs: 4           # Parallel jobs of make and cmake
+
+Limits are set when working containers are created, since `buildah from`
+is where buildah takes them: they apply to every `buildah run` in the
+container. The number of jobs is passed to scripts and wheel compilations
+as MAKEFLAGS and CMAKE_BUILD_PARALLEL_LEVEL. Budgets don't change images,
+so they're left out of hashes.
+
+Before building, `admit` waits until the budget fits the host next to the
+builds of all derex.builder processes running on it. Reservations are files
+in the lock directory, named after the owner ID of their process: see
+`derex.builder.locks`. The capacity of the host is its number of CPUs and
+its physical memory, or DEREX_HOST_CPUS and DEREX_HOST_MEMORY.
+A build too large for the host is admitted when nothing else is building.
+"""
+from contextlib import contextmanager
+from derex.builder import locks
+from derex.builder import logger
+from derex.builder import metrics
+from derex.builder.artifact_cache import parse_size
+from derex.builder.locks import build_lock
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+from uuid import uuid4
+
+import json
+import os
+import time
+
+
+ENV_VARS = {
+    "cpus": ("DEREX_CPUS", float),
+    "cpuset": ("DEREX_CPUSET", str),
+    "cpu_shares": ("DEREX_CPU_SHARES", int),
+    "memory": ("DEREX_MEMORY", str),
+    "jobs": ("DEREX_MAKE_JOBS", int),
+}
+CPU_PERIOD = 100000  # Microseconds
+POLL_INTERVAL = 2.0  # Seconds between attempts to fit a build on the host
+
+
+def from_environ(environ: Mapping[str, str] = os.environ) -> Dict[str, Any]:
+    """Return the default budget set by environment variables.
+    """
+    return {
+        key: convert(environ[var])
+        for key, (var, convert) in ENV_VARS.items()
+        if environ.get(var)
+    }
+
+
+def from_options(resources: Mapping[str, Any]) -> List[str]:
+    """Return the `buildah from` options enforcing a budget.
+    """
+    options = []
+    if resources.get("cpus"):
+        quota = int(resources["cpus"] * CPU_PERIOD)
+        options += [f"--cpu-period={CPU_PERIOD}", f"--cpu-quota={quota}"]
+    if resources.get("cpuset"):
+        options.append(f"--cpuset-cpus={resources['cpuset']}")
+    if resources.get("cpu_shares"):
+        options.append(f"--cpu-shares={resources['cpu_shares']}")
+    if resources.get("memory"):
+        options.append(f"--memory={resources['memory']}")
+    return options
+
+
+def build_env(resources: Mapping[str, Any]) -> Dict[str, str]:
+    """Return the variables telling build tools how many jobs to run.
+    """
+    jobs = resources.get("jobs")
+    if not jobs:
+        return {}
+    return {"CMAKE_BUILD_PARALLEL_LEVEL": str(jobs), "MAKEFLAGS": f"-j{jobs}"}
+
+
+def budget(resources: Mapping[str, Any]) -> Tuple[float, int]:
+    """Return the CPUs and bytes of memory a build with `resources` reserves.
+    Without an explicit CPU budget a build counts for the CPUs of its set,
+    or its number of jobs, or one CPU. Memory only counts when limited.
+    """
+    if resources.get("cpus"):
+        cpus = float(resources["cpus"])
+    elif resources.get("cpuset"):
+        cpus = float(count_cpus(resources["cpuset"]))
+    else:
+        cpus = float(resources.get("jobs") or 1)
+    memory = parse_size(resources["memory"]) if resources.get("memory") else 0
+    return cpus, memory
+
+
+def count_cpus(cpuset: str) -> int:
+    """Count the CPUs of a set like `0-3,6`.
+    """
+    count = 0
+    for part in cpuset.split(","):
+        first, _, last = part.partition("-")
+        count += int(last) - int(first) + 1 if last else 1
+    return count
+
+
+def host_capacity() -> Tuple[float, int]:
+    """Return the CPUs and bytes of memory builds can share on this host.
+    """
+    cpus = os.environ.get("DEREX_HOST_CPUS")
+    memory = os.environ.get("DEREX_HOST_MEMORY")
+    return (
+        float(cpus) if cpus else float(os.cpu_count() or 1),
+        parse_size(memory) if memory else physical_memory(),
+    )
+
+
+def physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return 0  # Unknown: memory is not accounted for
+
+
+def reservations_dir() -> str:
+    return os.path.join(locks.LOCK_DIR, "reservations")
+
+
+@contextmanager
+def admit(name: str, cpus: float, memory: int) -> Iterator[float]:
+    """Reserve `cpus` and `memory` on this host for the duration of the context,
+    waiting until they fit next to the builds already running.
+    Yields the number of seconds spent waiting.
+    """
+    directory = reservations_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{locks.owner_id()}-{uuid4().hex}.json")
+    start = time.monotonic()
+    waiting = False
+    while True:
+        with build_lock("admission"):
+            if fits(read_reservations(directory), cpus, memory):
+                with open(path, "w") as fileobj:
+                    json.dump({"name": name, "cpus": cpus, "memory": memory}, fileobj)
+                break
+        if not waiting:
+            logger.info(f"Waiting for {cpus:g} CPUs to build {name}")
+            waiting = True
+        time.sleep(POLL_INTERVAL)
+    waited = time.monotonic() - start
+    if waiting:
+        logger.info(f"Admitted build of {name} after {waited:.1f}s")
+        metrics.inc("admission_wait_seconds_total", waited)
+    try:
+        yield waited
+    finally:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def fits(reserved: List[Tuple[float, int]], cpus: float, memory: int) -> bool:
+    """Tell whether a build fits the host next to the `reserved` ones.
+    """
+    if not reserved:
+        return True
+    capacity_cpus, capacity_memory = host_capacity()
+    if sum(item[0] for item in reserved) + cpus > capacity_cpus:
+        return False
+    if memory and capacity_memory:
+        return sum(item[1] for item in reserved) + memory <= capacity_memory
+    return True
+
+
+def read_reservations(directory: str) -> List[Tuple[float, int]]:
+    """Return the budgets of the builds running on this host, removing the
+    reservations of processes that died. Reservations are in the lock directory
+    of the leases of their owners: one without a lease is stale too.
+    """
+    reserved = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        owner = parse_owner(filename)
+        if owner is None:
+            continue
+        if not locks.owner_alive(owner):
+            logger.debug(f"Removing reservation {filename} of dead process {owner}")
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(path) as fileobj:
+                entry = json.load(fileobj)
+        except (OSError, ValueError):
+            continue
+        reserved.append((float(entry["cpus"]), int(entry["memory"])))
+    return reserved
+
+
+def parse_owner(filename: str) -> Optional[str]:
+    owner, _, rest = filename.partition("-")
+    if len(owner) != locks.OWNER_LENGTH or not rest.endswith(".json"):
+        return None
+    return owner
@@ -0,0 +1,95 @@
+"""Resolve a whole graph of builders, running independent work concurrently.
+
+Ready nodes are started longest critical path first: the critical path of a
+node is its own expected duration plus the longest critical path among the
+nodes that depend on it. Expected durations come from the build history.
+"""
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from derex.builder import history
+from derex.builder import logger
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.builders.base import needed_graph
+from derex.builder.builders.base import walk_graph
+from typing import Dict
+from typing import List
+from typing import Set
+
+
+def expected_duration(builder: BaseBuilder) -> float:
+    """Return how long resolving `builder` is expected to take, assuming
+    its dependencies are available.
+    """
+    if builder.available_buildah():
+        return 0.0
+    estimate = history.estimate(history.name_of(builder))
+    return history.DEFAULT_ESTIMATE if estimate is None else estimate
+
+
+def critical_paths(
+    nodes: List[BaseBuilder], costs: Dict[str, float]
+) -> Dict[str, float]:
+    """Map every node's dest to the length of its critical path.
+    `nodes` must be sorted with dependencies first, as `walk_graph` returns them.
+    Dependencies left out of `nodes` are ignored.
+    """
+    dependents: Dict[str, List[str]] = {node.dest: [] for node in nodes}
+    for node in nodes:
+        for dependency in node.dependencies():
+            if dependency.dest in dependents:
+                dependents[dependency.dest].append(node.dest)
+    paths: Dict[str, float] = {}
+    for node in reversed(nodes):
+        downstream = [paths[dest] for dest in dependents[node.dest]]
+        paths[node.dest] = costs[node.dest] + max(downstream, default=0.0)
+    return paths
+
+
+def predict(builder: BaseBuilder) -> Dict[str, float]:
+    """Predict how long resolving the graph of `builder` will take.
+    `sequential` is the sum of all expected durations, `critical_path` is the
+    time it would take with unlimited concurrency.
+    """
+    nodes = walk_graph(builder)
+    costs = {node.dest: expected_duration(node) for node in nodes}
+    paths = critical_paths(nodes, costs)
+    return {
+        "sequential": sum(costs.values()),
+        "critical_path": max(paths.values(), default=0.0),
+    }
+
+
+def resolve_graph(builder: BaseBuilder, jobs: int = 1) -> List[str]:
+    """Resolve `builder` and what it needs, running up to `jobs` nodes at the
+    same time, longest critical path first. Images that can be had without
+    building them are resolved without their dependencies: see `needed_graph`.
+    Returns the images in the order they were started.
+    """
+    nodes = needed_graph(builder)
+    costs = {node.dest: expected_duration(node) for node in nodes}
+    paths = critical_paths(nodes, costs)
+    waiting_on: Dict[str, Set[str]] = {
+        node.dest: {dep.dest for dep in node.dependencies() if dep.dest in costs}
+        for node in nodes
+    }
+    pending = {node.dest: node for node in nodes}
+    started: List[str] = []
+    running: Dict = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            ready = sorted(
+                (dest for dest in pending if not waiting_on[dest]),
+                key=lambda dest: -paths[dest],
+            )
+            for dest in ready[: max(jobs, 1) - len(running)]:
+                logger.debug(f"Starting {dest} (critical path {paths[dest]:.0f}s)")
+                running[executor.submit(pending.pop(dest).resolve)] = dest
+                started.append(dest)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dest = running.pop(future)
+                future.result()  # Raise errors. The executor waits for running jobs
+                for dependencies in waiting_on.values():
+                    dependencies.discard(dest)
+    return started
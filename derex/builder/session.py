@@ -0,0 +1,229 @@
+"""A build session owns what builders share: configuration, caches and containers.
+
+Tools embedding derex.builder can create their own `BuildSession`, configured
+explicitly instead of through environment variables, and get builders from it:
+
+    with BuildSession(caches={"/root/.cache/pip": "/tmp/pip"}) as session:
+        session.create_builder("path/to/spec").resolve()
+
+Builders created through a session share its file hash, image inventory and
+registry caches, its pool of builder containers and the mount points of their
+containers. Builders created without
+one (the command line, the daemon) use the default session, configured from
+the environment the first time it's needed.
+"""
+from derex.builder import logger
+from derex.builder.digest import DEFAULT_ALGORITHM
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+import os
+import threading
+import time
+
+
+# Bumped by commands that alter the local buildah store (commit, pull, tag...).
+# The store is shared by all sessions, so this invalidates all their inventories.
+GENERATION = 0
+GENERATION_LOCK = threading.Lock()
+
+DEFAULT: Optional["BuildSession"] = None
+DEFAULT_LOCK = threading.Lock()
+
+
+class BuildSession:
+    """Configuration and warm caches for a set of builders.
+
+    :param caches: Host directories to mount as caches in build containers,
+        keyed on the directory they are mounted on.
+    :param wheels_cache: A host directory where compiled wheels are kept.
+    :param inventory_ttl: Seconds a listing of the local buildah images is trusted.
+    :param registry_ttl: Seconds a negative answer from the docker registry
+        is remembered. Positive answers never expire.
+    :param pool_size: How many idle builder containers to keep per image.
+    :param pin_digests: Whether to pin base images pulled from a registry
+        to the digest of their tag: see `derex.builder.digests`.
+    :param digest_ttl: Seconds a digest is trusted before asking the registry again.
+    :param digest_cache: A file where digests are kept across sessions.
+    :param resources: The default resource budget of builds, for the keys
+        their spec leaves out: see `derex.builder.resources`.
+    :param fingerprint: How input files are hashed: "content" or "git",
+        see `derex.builder.fingerprint`.
+    :param artifact_cache: A directory where built images are shared:
+        see `derex.builder.artifact_cache`.
+    :param artifact_cache_size: Bytes the artifact cache is allowed to grow to.
+    :param import_dir: An export directory images are imported from:
+        see `derex.builder.archives`.
+    :param hash_algorithm: The digest algorithm inputs are hashed with:
+        see `derex.builder.digest`.
+    """
+
+    def __init__(
+        self,
+        caches: Optional[Mapping[str, str]] = None,
+        wheels_cache: Optional[str] = None,
+        inventory_ttl: float = 30.0,
+        registry_ttl: float = 300.0,
+        pool_size: int = 2,
+        pin_digests: bool = False,
+        digest_ttl: float = 3600.0,
+        digest_cache: Optional[str] = None,
+        resources: Optional[Mapping[str, Any]] = None,
+        fingerprint: str = "content",
+        artifact_cache: Optional[str] = None,
+        artifact_cache_size: int = 20 * 2 ** 30,
+        import_dir: Optional[str] = None,
+        hash_algorithm: str = DEFAULT_ALGORITHM,
+    ):
+        from derex.builder.pool import ContainerPool
+
+        self.caches = dict(caches or {})
+        self.wheels_cache = wheels_cache
+        if wheels_cache is not None and not os.path.isdir(wheels_cache):
+            logger.error(f'The wheels cache directory "{wheels_cache}" does not exist')
+        self.inventory_ttl = inventory_ttl
+        self.registry_ttl = registry_ttl
+        self.pool = ContainerPool(pool_size)
+        self.pin_digests = pin_digests
+        self.digest_ttl = digest_ttl
+        self.digest_cache = digest_cache
+        self.resources = dict(resources or {})
+        self.fingerprint = fingerprint
+        self.artifact_cache = artifact_cache
+        self.artifact_cache_size = artifact_cache_size
+        self.import_dir = import_dir
+        self.hash_algorithm = hash_algorithm
+        self.lock = threading.Lock()
+        self.file_hashes: Dict[Tuple, str] = {}
+        self.registry_cache: Dict[str, Tuple[bool, float]] = {}
+        self.digests: Dict[str, Tuple[Optional[str], float]] = {}
+        self.inventory: Optional[Tuple[List[str], float, int]] = None
+        self.builders: Dict[Tuple[str, Optional[str]], Any] = {}
+        # Mount points of the containers mounted so far, None for those that can't be
+        self.mounts: Dict[str, Optional[str]] = {}
+
+    @classmethod
+    def from_environ(cls, environ: Mapping[str, str] = os.environ) -> "BuildSession":
+        """Create a session configured by environment variables, like the command line.
+        """
+        from derex.builder.artifact_cache import parse_size
+        from derex.builder.builders.base import CACHES
+        from derex.builder.digests import DIGEST_CACHE
+        from derex.builder.resources import from_environ
+
+        caches = {
+            dest: environ[var] for dest, var in CACHES.items() if environ.get(var)
+        }
+        return cls(
+            caches=caches,
+            wheels_cache=environ.get("WHEELS_CACHE"),
+            inventory_ttl=float(environ.get("DEREX_INVENTORY_TTL", "30")),
+            registry_ttl=float(environ.get("DEREX_REGISTRY_TTL", "300")),
+            pool_size=int(environ.get("DEREX_POOL_SIZE", "2")),
+            pin_digests=environ.get("DEREX_PIN_DIGESTS", "") not in ("", "0"),
+            digest_ttl=float(environ.get("DEREX_DIGEST_TTL", "3600")),
+            digest_cache=environ.get("DEREX_DIGEST_CACHE", DIGEST_CACHE) or None,
+            resources=from_environ(environ),
+            fingerprint=environ.get("DEREX_FINGERPRINT", "content"),
+            artifact_cache=environ.get("DEREX_ARTIFACT_CACHE") or None,
+            artifact_cache_size=parse_size(
+                environ.get("DEREX_ARTIFACT_CACHE_SIZE", "20G")
+            ),
+            import_dir=environ.get("DEREX_IMPORT_DIR") or None,
+            hash_algorithm=environ.get("DEREX_HASH_ALGORITHM", DEFAULT_ALGORITHM),
+        )
+
+    def create_builder(self, path: str, variant: Optional[str] = None):
+        """Given a path to a builder configuration, instantiate the relevant builder.
+        If `variant` is given the builder builds that variant of the spec's matrix.
+        Builders are created once per session: later calls return the same object.
+        """
+        from derex.builder.builders.base import load_conf
+        from zope.dottedname.resolve import resolve
+
+        key = (path, variant)
+        with self.lock:
+            builder = self.builders.get(key)
+        if builder is not None:
+            return builder
+        builder_class = resolve(load_conf(path)["builder"]["class"])
+        if variant is None:
+            builder = builder_class(path, session=self)
+        else:
+            builder = builder_class(path, variant=variant, session=self)
+        with self.lock:
+            return self.builders.setdefault(key, builder)
+
+    def clear_builders(self):
+        """Forget the builders created so far, so that specs are read again.
+        The caches are kept: unchanged files are not hashed again.
+        """
+        with self.lock:
+            self.builders.clear()
+
+    def cached_images(self) -> Optional[List[str]]:
+        """Return the cached listing of the local images, if it's still valid.
+        """
+        with self.lock:
+            inventory = self.inventory
+        if inventory is None:
+            return None
+        images, timestamp, generation = inventory
+        if generation != GENERATION or time.time() - timestamp >= self.inventory_ttl:
+            return None
+        return list(images)
+
+    def store_images(self, images: List[str], generation: int):
+        """Cache a listing of the local images, taken at `generation`.
+        """
+        with self.lock:
+            self.inventory = (list(images), time.time(), generation)
+
+    def close(self):
+        """Remove the idle containers of the pool.
+        """
+        self.pool.close()
+
+    def __enter__(self) -> "BuildSession":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_session() -> BuildSession:
+    """Return the default session, creating it from the environment if needed.
+    """
+    global DEFAULT
+    with DEFAULT_LOCK:
+        if DEFAULT is None:
+            DEFAULT = BuildSession.from_environ()
+        return DEFAULT
+
+
+def set_session(session: Optional[BuildSession]):
+    """Replace the default session. With None, the next one is read
+    from the environment again.
+    """
+    global DEFAULT
+    with DEFAULT_LOCK:
+        DEFAULT = session
+
+
+def invalidate_inventories() -> int:
+    """Mark the image listings of all sessions as stale.
+    Returns the new generation.
+    """
+    global GENERATION
+    with GENERATION_LOCK:
+        GENERATION += 1
+        return GENERATION
+
+
+def current_generation() -> int:
+    with GENERATION_LOCK:
+        return GENERATION
@@ -0,0 +1,142 @@
+"""Validate whole trees of specs in one pass.
+
+Every spec is checked against the JSON schema of its builder, then the files
+it uses and the specs it is based on must exist. The specs it references are
+checked too, wherever they are, and the graph they form must have no cycles.
+Specs are checked in parallel, in separate processes.
+All errors are collected instead of stopping at the first one.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from derex.builder.builders.base import ConfigurationError
+from derex.builder.builders.base import get_validator
+from derex.builder.builders.base import load_conf
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from zope.dottedname.resolve import resolve
+
+import os
+import yaml
+
+
+SPEC_FILE = "spec.yml"
+
+
+def find_specs(path: str) -> List[str]:
+    """Return `path` if it contains a spec, otherwise all spec directories below it.
+    """
+    if os.path.isfile(os.path.join(path, SPEC_FILE)):
+        return [path]
+    specs = []
+    for dirpath, dirs, files in os.walk(path):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        if SPEC_FILE in files:
+            specs.append(dirpath)
+    return specs
+
+
+def format_error(error) -> str:
+    location = "/".join(str(part) for part in error.absolute_path) or "spec"
+    return f"{location}: {error.message}"
+
+
+def check_spec(path: str) -> Tuple[List[str], List[str]]:
+    """Check the spec in `path`.
+    Returns the errors found and the real paths of the specs it is based on.
+    """
+    try:
+        conf = load_conf(path)
+        builder_class = resolve(conf["builder"]["class"])
+    except (OSError, yaml.YAMLError) as err:
+        return [f"Could not read {SPEC_FILE}: {err}"], []
+    except (KeyError, TypeError, ImportError, AttributeError) as err:
+        return [f"Could not find the builder class: {err!r}"], []
+    schema_errors = get_validator(builder_class.json_schema).iter_errors(conf)
+    errors = sorted(format_error(error) for error in schema_errors)
+    if errors:
+        return errors, []
+
+    try:
+        builder = builder_class(path)
+    except (ConfigurationError, OSError) as err:
+        return [str(err)], []
+    references: List[str] = []
+    for node in [builder] + builder.variants():
+        for name in node.required_files():
+            if isinstance(name, str) and not os.path.exists(os.path.join(path, name)):
+                errors.append(f"{name} not found")
+        for source in node.source_pointers():
+            if isinstance(source, str):
+                continue
+            target = node.resolve_source_path(source, path)
+            error = check_reference(target, source.get("variant"))
+            if error is not None:
+                errors.append(f"source {source['path']}: {error}")
+            else:
+                references.append(os.path.realpath(target))
+    return sorted(set(errors)), sorted(set(references))
+
+
+def check_reference(target: str, variant: Optional[str]) -> Optional[str]:
+    if not os.path.isfile(os.path.join(target, SPEC_FILE)):
+        return f"no {SPEC_FILE} in {target}"
+    try:
+        matrix = load_conf(target).get("matrix", {})
+    except (OSError, yaml.YAMLError, AttributeError):
+        return None  # Reported when checking the target itself
+    if variant is not None and variant not in matrix:
+        return f"no variant {variant} in {target}"
+    if variant is None and matrix:
+        return f"{target} has a matrix: the source must name a variant"
+    return None
+
+
+def find_cycles(graph: Dict[str, List[str]]) -> List[List[str]]:
+    """Return the cycles in `graph`, each as a list of nodes starting and
+    ending with the same one.
+    """
+    cycles = []
+    state: Dict[str, str] = {}  # "visiting" or "done"
+    stack: List[str] = []
+
+    def visit(node: str):
+        state[node] = "visiting"
+        stack.append(node)
+        for target in graph.get(node, []):
+            if state.get(target) == "visiting":
+                cycles.append(stack[stack.index(target) :] + [target])
+            elif target not in state:
+                visit(target)
+        stack.pop()
+        state[node] = "done"
+
+    for node in sorted(graph):
+        if node not in state:
+            visit(node)
+    return cycles
+
+
+def validate_tree(paths: List[str], jobs: int = 1) -> Dict[str, List[str]]:
+    """Check the specs in `paths` and all the specs they reference,
+    `jobs` at a time. Returns the errors found, by spec real path.
+    """
+    errors: Dict[str, List[str]] = {}
+    graph: Dict[str, List[str]] = {}
+    pending = sorted({os.path.realpath(path) for path in paths})
+    executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        while pending:
+            run = executor.map if executor is not None else map
+            for path, (spec_errors, references) in zip(
+                pending, run(check_spec, pending)
+            ):
+                errors[path], graph[path] = spec_errors, references
+            referenced = {ref for refs in graph.values() for ref in refs}
+            pending = sorted(referenced - set(graph))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    for cycle in find_cycles(graph):
+        errors[cycle[0]].append(f"dependency cycle: {' -> '.join(cycle)}")
+    return errors
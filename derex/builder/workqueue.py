@@ -0,0 +1,322 @@
+"""Spread the images of a graph over several workers through a shared directory.
+
+The coordinator turns a graph into one job per image and writes them to the
+queue directory. Workers, on the same host or on others sharing the directory
+(and the spec paths), claim the jobs whose dependencies are done and resolve
+them. The directory looks like this:
+
+    queue/
+        jobs/       <- waiting to be claimed
+        claimed/    <- being worked on, with the lease of the worker
+        done/       <- finished
+        failed/     <- given up after DEREX_QUEUE_ATTEMPTS attempts
+        artifacts/  <- built images, unless DEREX_ARTIFACT_CACHE is set
+
+Jobs move between states by renaming their file, so exactly one worker wins a
+claim. Workers renew their lease (DEREX_QUEUE_LEASE seconds) while they work:
+a job whose lease expired, because its worker died, goes back to the queue.
+Leases are wall clock times, so hosts need synchronized clocks.
+Images are published through the artifact cache, so that workers on other
+hosts can load the images they depend on instead of building them again.
+"""
+from derex.builder import artifact_cache
+from derex.builder import logger
+from derex.builder.archives import layout_name
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.builders.base import walk_graph
+from derex.builder.scheduler import critical_paths
+from derex.builder.scheduler import expected_duration
+from derex.builder.session import BuildSession
+from derex.builder.session import get_session
+from typing import Dict
+from typing import List
+from typing import Optional
+from uuid import uuid4
+
+import json
+import os
+import socket
+import threading
+import time
+
+
+LEASE = float(os.environ.get("DEREX_QUEUE_LEASE", "60"))
+MAX_ATTEMPTS = int(os.environ.get("DEREX_QUEUE_ATTEMPTS", "3"))
+POLL_INTERVAL = 1.0
+STATES = ("jobs", "claimed", "done", "failed")
+
+
+class JobFailed(Exception):
+    pass
+
+
+def state_path(directory: str, state: str, job_id: str = "") -> str:
+    return os.path.join(directory, state, job_id + ".json" if job_id else "")
+
+
+def read_json(path: str) -> Optional[Dict]:
+    """Return the content of a job file, or None if it's gone.
+    """
+    try:
+        with open(path) as fileobj:
+            return json.load(fileobj)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data: Dict):
+    temporary = f"{path}.{uuid4().hex}.tmp"
+    with open(temporary, "w") as fileobj:
+        json.dump(data, fileobj, indent=2, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def list_jobs(directory: str, state: str) -> List[str]:
+    names = os.listdir(state_path(directory, state))
+    return sorted(name[: -len(".json")] for name in names if name.endswith(".json"))
+
+
+def submit(builder: BaseBuilder, directory: str) -> List[str]:
+    """Queue a job for every image resolving `builder` needs: the ones to
+    build and the available ones they are based on, but not what those
+    are based on. Images only this host has are published in the artifact
+    cache first, so that workers on other hosts can load them.
+    Returns the job IDs.
+    """
+    for state in STATES:
+        os.makedirs(state_path(directory, state), exist_ok=True)
+    cache = builder.session.artifact_cache or os.path.join(directory, "artifacts")
+
+    def available(node: BaseBuilder) -> bool:
+        location = node.locate()
+        if location == "local":
+            artifact_cache.store(node, cache)
+        return location is not None
+
+    nodes = walk_graph(builder, available=available)
+    costs = {node.dest: expected_duration(node) for node in nodes}
+    paths = critical_paths(nodes, costs)
+    ids = []
+    for node in nodes:
+        job_id = layout_name(node.dest)
+        for state in ("done", "failed"):  # Left over from a previous run
+            if os.path.exists(state_path(directory, state, job_id)):
+                os.unlink(state_path(directory, state, job_id))
+        job = {
+            "id": job_id,
+            "dest": node.dest,
+            "path": os.path.abspath(node.path),
+            "variant": node.variant,
+            "dependencies": [
+                layout_name(dep.dest)
+                for dep in node.dependencies()
+                if dep.dest in costs
+            ],
+            "priority": paths[node.dest],
+            "attempts": 0,
+            "errors": [],
+        }
+        write_json(state_path(directory, "jobs", job_id), job)
+        ids.append(job_id)
+    logger.info(f"Queued {len(ids)} jobs in {directory}")
+    return ids
+
+
+def ready_jobs(directory: str) -> List[Dict]:
+    """Return the queued jobs whose dependencies are done, most urgent first.
+    """
+    done = set(list_jobs(directory, "done"))
+    jobs = []
+    for job_id in list_jobs(directory, "jobs"):
+        job = read_json(state_path(directory, "jobs", job_id))
+        if job is not None and set(job["dependencies"]) <= done:
+            jobs.append(job)
+    return sorted(jobs, key=lambda job: -job["priority"])
+
+
+def claim(directory: str, job: Dict, worker: str) -> bool:
+    """Try to take `job`. Returns False if another worker was faster.
+    """
+    claimed = state_path(directory, "claimed", job["id"])
+    try:
+        os.rename(state_path(directory, "jobs", job["id"]), claimed)
+    except FileNotFoundError:
+        return False
+    write_json(claimed, dict(job, worker=worker, expires=time.time() + LEASE))
+    return True
+
+
+def renew(directory: str, job_id: str, worker: str) -> bool:
+    """Extend the lease on a claimed job. Returns False if it was lost.
+    """
+    path = state_path(directory, "claimed", job_id)
+    job = read_json(path)
+    if job is None or job.get("worker") != worker:
+        return False
+    write_json(path, dict(job, expires=time.time() + LEASE))
+    return True
+
+
+def take_claim(directory: str, job_id: str, worker: str) -> Optional[str]:
+    """Move the claim of `worker` on a job out of the way of `requeue_expired`,
+    before completing or releasing the job. Returns the path it was moved to,
+    or None if the lease was lost: the job went back to the queue, and maybe
+    to another worker.
+    """
+    path = state_path(directory, "claimed", job_id)
+    job = read_json(path)
+    if job is None or job.get("worker") != worker:
+        return None
+    private = f"{path}.{uuid4().hex}.taken"
+    try:
+        os.rename(path, private)
+    except FileNotFoundError:  # Requeued meanwhile
+        return None
+    job = read_json(private)
+    if job is None or job.get("worker") != worker:
+        os.rename(private, path)  # Claimed again meanwhile: not ours to take
+        return None
+    return private
+
+
+def release(directory: str, path: str, job: Dict, error: str):
+    """Put back a job that could not be completed, or give up on it
+    after MAX_ATTEMPTS attempts. `path` is the file holding the claim.
+    """
+    job = dict(job, attempts=job["attempts"] + 1, errors=job["errors"] + [error])
+    job.pop("worker", None)
+    job.pop("expires", None)
+    state = "failed" if job["attempts"] >= MAX_ATTEMPTS else "jobs"
+    logger.warning(f"Job {job['id']} failed ({error}), moving it to {state}")
+    write_json(state_path(directory, state, job["id"]), job)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def requeue_expired(directory: str) -> List[str]:
+    """Put back the jobs whose worker stopped renewing its lease.
+    Returns their IDs.
+    """
+    expired = []
+    for job_id in list_jobs(directory, "claimed"):
+        path = state_path(directory, "claimed", job_id)
+        try:
+            # Until the worker writes its lease, count from the claim
+            expires = os.stat(path).st_mtime + LEASE
+            job = read_json(path)
+        except (FileNotFoundError, ValueError):
+            continue
+        if job is None or time.time() < job.get("expires", expires):
+            continue
+        stale = f"{path}.{uuid4().hex}.stale"
+        try:
+            os.rename(path, stale)  # Only one participant gets to requeue it
+        except FileNotFoundError:
+            continue
+        release(directory, stale, job, f"lease of {job.get('worker')} expired")
+        expired.append(job_id)
+    return expired
+
+
+def run_job(
+    directory: str, job: Dict, worker: str, session: Optional[BuildSession] = None
+):
+    """Resolve the image of a claimed job while keeping its lease alive,
+    and publish it in the artifact cache.
+    If the lease was lost meanwhile the job belongs to the queue again: the
+    outcome is dropped.
+    Builders are created in `session`, the default one if not given.
+    """
+    session = session or get_session()
+    cache = session.artifact_cache or os.path.join(directory, "artifacts")
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(LEASE / 3):
+            if not renew(directory, job["id"], worker):
+                logger.warning(f"Lost the lease on {job['id']}")
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    start = time.monotonic()
+    try:
+        logger.info(f"{worker} resolving {job['dest']}")
+        builder = session.create_builder(job["path"], job["variant"])
+        builder.resolve()
+        if not os.path.exists(artifact_cache.archive_path(builder.dest, cache)):
+            artifact_cache.store(builder, cache)  # Found locally: publish it anyway
+    except Exception as exc:
+        error: Optional[str] = f"{worker}: {exc.__class__.__name__}: {exc}"
+    else:
+        error = None
+    finally:
+        stop.set()
+        thread.join()
+    claimed = take_claim(directory, job["id"], worker)
+    if claimed is None:
+        logger.warning(f"{worker} lost the lease on {job['id']}: dropping the outcome")
+        return
+    if error is not None:
+        release(directory, claimed, job, error)
+        return
+    result = dict(job, worker=worker, seconds=time.monotonic() - start)
+    result.pop("expires", None)
+    write_json(state_path(directory, "done", job["id"]), result)
+    try:
+        os.unlink(claimed)
+    except FileNotFoundError:
+        pass
+
+
+def work(
+    directory: str, worker: Optional[str] = None, exit_when_idle: bool = False
+) -> int:
+    """Claim and run jobs until interrupted. With `exit_when_idle`, return
+    as soon as no job is ready and none is being worked on.
+    Returns the number of jobs run.
+    Jobs are run in a session of their own, whose artifact cache defaults
+    to the one of the queue.
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    for state in STATES:
+        os.makedirs(state_path(directory, state), exist_ok=True)
+    logger.info(f"Worker {worker} waiting for jobs in {directory}")
+    count = 0
+    with BuildSession.from_environ() as session:
+        if not session.artifact_cache:
+            session.artifact_cache = os.path.join(directory, "artifacts")
+        while True:
+            requeue_expired(directory)
+            claimed = False
+            for job in ready_jobs(directory):
+                if claim(directory, job, worker):
+                    claimed = True
+                    run_job(directory, job, worker, session)
+                    count += 1
+                    break
+            if claimed:
+                continue
+            if exit_when_idle and not list_jobs(directory, "claimed"):
+                return count
+            time.sleep(POLL_INTERVAL)
+
+
+def wait_for(directory: str, ids: List[str], timeout: Optional[float] = None):
+    """Wait until the given jobs are done, requeuing expired ones meanwhile.
+    Raises JobFailed as soon as one of them is given up on.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        requeue_expired(directory)
+        failed = set(ids) & set(list_jobs(directory, "failed"))
+        if failed:
+            raise JobFailed(f"Gave up on {', '.join(sorted(failed))}")
+        pending = set(ids) - set(list_jobs(directory, "done"))
+        if not pending:
+            return
+        if deadline is not None and time.monotonic() > deadline:
+            raise JobFailed(f"Timed out waiting for {', '.join(sorted(pending))}")
+        time.sleep(POLL_INTERVAL)
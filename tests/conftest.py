@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fixtures shared by several test modules"""
+
+from pathlib import PosixPath
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path_factory, monkeypatch):
+    """Keep the build history and lock files of tests out of the user's.
+    They go to a directory of their own, so tests can list `tmp_path`.
+    """
+    state = tmp_path_factory.mktemp("state")
+    monkeypatch.setattr("derex.builder.history.HISTORY_DB", str(state / "history.db"))
+    monkeypatch.setattr("derex.builder.locks.LOCK_DIR", str(state / "locks"))
+
+
+def make_spec(root: PosixPath, name: str, spec: str) -> str:
+    (root / name).mkdir()
+    (root / name / "spec.yml").write_text(spec)
+    (root / name / "script.sh").write_text("echo hello")
+    (root / name / "requirements.txt").write_text("rapidjson")
+    return str(root / name)
+
+
+@pytest.fixture
+def fork(tmp_path: PosixPath) -> str:
+    """A wheel compiler whose two sources can be built independently"""
+    for name in ("short", "long"):
+        make_spec(
+            tmp_path,
+            name,
+            "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+            "source: docker.io/library/alpine:3.9\n"
+            f"scripts: [script.sh]\ndest: derextests/{name}\n",
+        )
+    return make_spec(
+        tmp_path,
+        "root",
+        "builder: {class: derex.builder.builders.BuildahWheelCompiler}\n"
+        "requirements: [requirements.txt]\n"
+        "sources:\n"
+        "  base: {type: derex-relative, path: short}\n"
+        "  builder: {type: derex-relative, path: long}\n"
+        "dest: derextests/root\n",
+    )
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Offline export and import of images"""
+
+from .utils import get_builder_path
+from derex.builder import archives
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import walk_graph
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import hashlib
+import os
+
+
+def fake_push(*args, print_output=True):
+    """Write an OCI layout with a layer shared by all images and one of its own"""
+    if args[0] != "push":
+        return "sha256:1234"
+    dest, target = args[-2:]
+    _, path, _ = target.split(":")
+    blobs = os.path.join(path, "blobs", "sha256")
+    os.makedirs(blobs, exist_ok=True)
+    for content in (b"shared layer", dest.encode("utf-8")):
+        digest = hashlib.sha256(content).hexdigest()
+        with open(os.path.join(blobs, digest), "wb") as fileobj:
+            fileobj.write(content)
+    return ""
+
+
+def test_export_import(tmp_path: PosixPath, mocker: MockFixture):
+    mocker.patch("derex.builder.builders.buildah.BuildahBuilder.resolve")
+    mocker.patch("derex.builder.builders.wheel_compiler.BuildahWheelCompiler.resolve")
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    buildah.side_effect = fake_push
+    builders = walk_graph(create_builder(get_builder_path("rapidjson")))
+
+    images = archives.export_images(builders, str(tmp_path), "gzip", level=3)
+    assert sorted(images) == sorted(builder.dest for builder in builders)
+    assert ["--compression-format", "gzip", "--compression-level", "3"] == list(
+        buildah.call_args[0][1:5]
+    )
+    shared = hashlib.sha256(b"shared layer").hexdigest()
+    copies = [
+        os.stat(tmp_path / name / "blobs" / "sha256" / shared) for name in images.values()
+    ]
+    assert len({stat.st_ino for stat in copies}) == 1  # Stored only once
+    assert archives.read_manifest(str(tmp_path)) == images
+
+    buildah.reset_mock()
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    assert archives.import_images(builders, str(tmp_path)) == list(images)
+    tagged = [call[0][2] for call in buildah.call_args_list if call[0][0] == "tag"]
+    assert tagged == list(images)
+
+
+def test_export_as_user(tmp_path: PosixPath, mocker: MockFixture):
+    mocker.patch("derex.builder.builders.buildah.BuildahBuilder.resolve")
+    mocker.patch("derex.builder.builders.wheel_compiler.BuildahWheelCompiler.resolve")
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    buildah.side_effect = fake_push
+    mocker.patch("derex.builder.builders.base.os.getuid", return_value=1000)
+    # Blobs pushed through sudo belong to root: fs.protected_hardlinks denies links
+    mocker.patch(
+        "derex.builder.archives.os.link",
+        side_effect=PermissionError(1, "Operation not permitted"),
+    )
+    builders = walk_graph(create_builder(get_builder_path("rapidjson")))
+    images = archives.export_images(builders, str(tmp_path))
+    assert archives.read_manifest(str(tmp_path)) == images
+
+
+def test_resolve_from_import_dir(tmp_path: PosixPath, mocker: MockFixture):
+    builder = create_builder(get_builder_path("base"))
+    mocker.patch.object(builder.session, "import_dir", str(tmp_path))
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    build = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.build")
+    registry = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_docker_registry"
+    )
+    import_image = mocker.patch("derex.builder.archives.import_image")
+    import_image.return_value = True
+    builder.resolve()
+    import_image.assert_called_once_with(builder, str(tmp_path))
+    build.assert_not_called()
+    registry.assert_not_called()
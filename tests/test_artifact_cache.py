@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Shared file system artifact cache"""
+
+from .utils import get_builder_path
+from derex.builder import artifact_cache
+from derex.builder.builders.base import create_builder
+from derex.builder.session import get_session
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import os
+import pytest
+
+
+@pytest.fixture
+def cache_dir(tmp_path: PosixPath, mocker: MockFixture) -> PosixPath:
+    mocker.patch.object(get_session(), "artifact_cache", str(tmp_path))
+    return tmp_path
+
+
+def fake_buildah(*args, print_output=True):
+    if args[0] == "push":
+        with open(args[-1].split(":")[1], "w") as fileobj:
+            fileobj.write("An OCI archive")
+    return "sha256:1234"
+
+
+def test_parse_size():
+    assert artifact_cache.parse_size("20G") == 20 * 2 ** 30
+    assert artifact_cache.parse_size("1.5kb") == 1536
+    assert artifact_cache.parse_size("100") == 100
+
+
+def test_resolve_stores_and_fetches(cache_dir: PosixPath, mocker: MockFixture):
+    builder = create_builder(get_builder_path("base"))
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_docker_registry",
+        return_value=False,
+    )
+    build = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.build")
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    buildah.side_effect = fake_buildah
+
+    builder.resolve()
+    build.assert_called_once()
+    archive = artifact_cache.archive_path(builder.dest, str(cache_dir))
+    assert os.listdir(cache_dir) == [os.path.basename(archive)]
+
+    # Another host resolving the same image finds it in the cache
+    build.reset_mock()
+    buildah.reset_mock()
+    builder.resolve()
+    build.assert_not_called()
+    assert buildah.call_args[0] == ("tag", "sha256:1234", builder.dest)
+
+
+def test_fetch_archives_of_others(cache_dir: PosixPath, mocker: MockFixture):
+    builder = create_builder(get_builder_path("base"))
+    archive = PosixPath(artifact_cache.archive_path(builder.dest, str(cache_dir)))
+    archive.write_text("An OCI archive written by root")
+    # Not ours: we can read it, but not change its timestamps
+    mocker.patch(
+        "derex.builder.artifact_cache.os.utime",
+        side_effect=PermissionError(1, "Operation not permitted"),
+    )
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    buildah.side_effect = fake_buildah
+    assert artifact_cache.fetch(builder)
+    assert buildah.call_args[0] == ("tag", "sha256:1234", builder.dest)
+
+
+def test_evict(cache_dir: PosixPath):
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        path = cache_dir / f"{name}.tar"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+    (cache_dir / ".partial.tmp").write_bytes(b"x" * 1000)
+    os.utime(cache_dir / ".partial.tmp", (0, 0))
+    assert artifact_cache.evict(str(cache_dir), 150) == 200
+    assert os.listdir(cache_dir) == ["newest.tar"]
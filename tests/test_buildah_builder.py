@@ -5,6 +5,7 @@
 
 from .utils import get_builder_path
 from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.session import BuildSession
 from jsonschema.exceptions import ValidationError
 from pathlib import Path
 from pathlib import PosixPath
@@ -74,9 +75,9 @@ def test_hash_files(buildah_base: BuildahBuilder):
 
 
 def test_caches(buildah_base: BuildahBuilder, tmp_path: PosixPath):
-    os.environ["PIP_CACHE"] = f"{tmp_path}/pip-alpine"
-    buildah_base.ensure_caches()
-    assert os.path.exists(os.environ["PIP_CACHE"])
+    session = BuildSession.from_environ({"PIP_CACHE": f"{tmp_path}/pip-alpine"})
+    session.create_builder(buildah_base.path).ensure_caches()
+    assert os.path.exists(f"{tmp_path}/pip-alpine")
 
 
 @pytest.mark.slowtest
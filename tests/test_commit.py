@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Committing images"""
+
+from .utils import get_builder_path
+from derex.builder import history
+from derex.builder.builders.buildah import BuildahBuilder
+from jsonschema.exceptions import ValidationError
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import pytest
+import shutil
+
+
+@pytest.fixture
+def buildah_base(tmp_path: PosixPath) -> BuildahBuilder:
+    """Return an editable copy of the base conf"""
+    spec_copy_path = str(tmp_path / "base")
+    shutil.copytree(get_builder_path("base"), spec_copy_path)
+    return BuildahBuilder(spec_copy_path)
+
+
+def test_commit_options(buildah_base: BuildahBuilder, mocker: MockFixture):
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    sizes = {"base-image": 5 * 2 ** 20, buildah_base.dest: 8 * 2 ** 20}
+    mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.image_size",
+        side_effect=sizes.get,
+    )
+    buildah_base.conf["commit"] = {
+        "squash": True,
+        "compression": {"format": "zstd", "level": 19},
+        "remove": ["/var/cache/apk/*", "/tmp/a_directory"],
+    }
+    buildah_base.commit("container-id", "base-image")
+
+    remove_call, commit_call = buildah.call_args_list
+    assert remove_call[0][:4] == ("run", "container-id", "sh", "-c")
+    assert remove_call[0][-2:] == ("/var/cache/apk/*", "/tmp/a_directory")
+    assert commit_call[0] == (
+        "commit",
+        "--rm",
+        "--squash",
+        "container-id",
+        buildah_base.dest,
+    )
+    assert buildah_base.compression_opts() == [
+        "--compression-format",
+        "zstd",
+        "--compression-level",
+        "19",
+    ]
+    assert history.previous_size("derextests/hello_world", "other:tag") == 8 * 2 ** 20
+
+
+def test_commit_defaults(buildah_base: BuildahBuilder, mocker: MockFixture):
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    report_size = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.report_size"
+    )
+    buildah_base.commit("container-id", "base-image")
+    buildah.assert_called_once_with("commit", "--rm", "container-id", buildah_base.dest)
+    report_size.assert_called_once_with("base-image")
+    assert buildah_base.compression_opts() == []
+
+
+def test_commit_schema(buildah_base: BuildahBuilder):
+    buildah_base.conf["commit"] = {"compression": {"format": "lzma"}}
+    with pytest.raises(ValidationError):
+        buildah_base.validate()
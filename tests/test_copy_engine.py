@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Copying into mounted containers"""
+
+from derex.builder import copy_engine
+from derex.builder.session import BuildSession
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import os
+import pytest
+
+
+@pytest.fixture
+def root(tmp_path: PosixPath) -> PosixPath:
+    (tmp_path / "root").mkdir()
+    return tmp_path / "root"
+
+
+@pytest.fixture
+def builder(root: PosixPath, mocker: MockFixture):
+    mocker.patch("derex.builder.copy_engine.COPY_MODE", "mount")
+    mocker.patch("derex.builder.copy_engine.os.getuid", return_value=0)
+    outputs = {"mount": f"{root}\n"}
+    builder = mocker.Mock()
+    builder.session = BuildSession()
+    builder.buildah.side_effect = lambda command, *args, **kwargs: outputs.get(
+        command, ""
+    )
+    return builder
+
+
+@pytest.fixture
+def source(tmp_path: PosixPath) -> PosixPath:
+    (tmp_path / "source" / "sub").mkdir(parents=True)
+    (tmp_path / "source" / "sub" / "file.txt").write_text("content")
+    (tmp_path / "source" / "script.sh").write_text("echo hello")
+    os.chmod(tmp_path / "source" / "script.sh", 0o755)
+    return tmp_path / "source"
+
+
+def test_copy_semantics(builder, root: PosixPath, source: PosixPath):
+    copy_engine.copy(builder, "container", str(source), "/app")
+    copy_engine.copy(builder, "container", str(source / "script.sh"), "/bin/")
+    copy_engine.copy(builder, "container", str(source / "script.sh"), "/run.sh")
+    assert (root / "app" / "sub" / "file.txt").read_text() == "content"
+    assert (root / "bin" / "script.sh").stat().st_mode & 0o777 == 0o755
+    assert (root / "run.sh").read_text() == "echo hello"
+    # The container is mounted once and never copied into with buildah
+    commands = [call[0][0] for call in builder.buildah.call_args_list]
+    assert commands == ["mount"]
+
+    copy_engine.unmount(builder, "container")
+    copy_engine.unmount(builder, "container")
+    builder.buildah.assert_called_with("umount", "container", print_output=False)
+    assert builder.buildah.call_count == 2
+
+
+def test_links_resolve_inside_the_container(
+    builder, root: PosixPath, source: PosixPath, tmp_path: PosixPath
+):
+    (root / "opt").symlink_to(str(tmp_path / "outside"))
+    (root / "up").symlink_to("../../..")
+    copy_engine.copy(builder, "container", str(source / "script.sh"), "/opt/bin/")
+    copy_engine.copy(builder, "container", str(source / "script.sh"), "/up/x.sh")
+    inside = root / str(tmp_path / "outside").lstrip("/")
+    assert (inside / "bin" / "script.sh").exists()
+    assert (root / "x.sh").exists()
+    assert not (tmp_path / "outside").exists()
+
+    # Directories are not merged into links: buildah copy takes over
+    (root / "app").mkdir()
+    (root / "app" / "sub").symlink_to(str(tmp_path / "outside"))
+    copy_engine.copy(builder, "container", str(source), "/app")
+    builder.buildah.assert_called_with("copy", "container", str(source), "/app")
+    assert not (tmp_path / "outside").exists()
+
+
+def test_fallback_to_buildah_copy(builder, root: PosixPath, mocker: MockFixture):
+    mocker.patch("derex.builder.copy_engine.os.getuid", return_value=1000)
+    copy_engine.copy(builder, "container", "/src", "/dest")
+    builder.buildah.assert_called_once_with("copy", "container", "/src", "/dest")
+
+    builder.session.mounts.clear()
+    copy_engine.COPY_MODE = "buildah"
+    copy_engine.copy(builder, "container", "/src", "/dest")
+    assert builder.buildah.call_count == 2
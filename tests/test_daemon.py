@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Build daemon"""
+
+from .utils import get_builder_path
+from click.testing import CliRunner
+from concurrent.futures import ThreadPoolExecutor
+from derex.builder import cli
+from derex.builder import daemon
+from derex.builder.builders.buildah import BuildahBuilder
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import pytest
+import threading
+import time
+
+
+@pytest.fixture
+def server(tmp_path: PosixPath):
+    socket_path = str(tmp_path / "derex.sock")
+    server = daemon.BuildServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_single_flight():
+    flights = daemon.SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "done"
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: flights.do("key", slow), range(4)))
+    assert results == ["done"] * 4
+    assert len(calls) == 1
+
+
+def test_daemon_coalesces_resolve(server: daemon.BuildServer, mocker: MockFixture):
+    calls = []
+    resolve = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.resolve")
+    resolve.side_effect = lambda: calls.append(time.sleep(0.2))
+    prefetch = mocker.patch("derex.builder.prefetch.prefetch")
+    path = get_builder_path("base")
+    with ThreadPoolExecutor(3) as executor:
+        results = list(
+            executor.map(
+                lambda _: daemon.request(server.server_address, "resolve", path),
+                range(3),
+            )
+        )
+    assert results == [BuildahBuilder(path).dest] * 3
+    assert len(calls) == 1
+    assert prefetch.call_count == 1
+
+
+def test_daemon_errors(server: daemon.BuildServer):
+    with pytest.raises(daemon.DaemonError):
+        daemon.request(server.server_address, "foobar", get_builder_path("base"))
+
+
+def test_cli_client(server: daemon.BuildServer):
+    path = get_builder_path("base")
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ["--socket", server.server_address, "image", path])
+    assert result.exit_code == 0
+    assert result.output.rstrip() == BuildahBuilder(path).dest
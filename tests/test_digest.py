@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Selectable digest algorithms"""
+
+from .utils import get_builder_path
+from derex.builder import digest
+from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.session import BuildSession
+
+import pytest
+
+
+def test_tag_scheme():
+    path = get_builder_path("base")
+    sha256_tag = BuildahBuilder(path).docker_tag()
+    assert len(sha256_tag) == 10  # The original scheme is left untouched
+
+    session = BuildSession(hash_algorithm="blake2b")
+    blake2b_tag = BuildahBuilder(path, session=session).docker_tag()
+    assert blake2b_tag.startswith("v2-b2-")
+    assert blake2b_tag[-10:] != sha256_tag
+
+
+def test_unknown_algorithm():
+    session = BuildSession(hash_algorithm="md5")
+    with pytest.raises(digest.UnknownAlgorithm):
+        BuildahBuilder(get_builder_path("base"), session=session).docker_tag()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Digest-pinned base images"""
+
+from .conftest import make_spec
+from derex.builder import digests
+from derex.builder.builders.base import walk_graph
+from derex.builder.session import BuildSession
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+from urllib.error import HTTPError
+
+import json
+import pytest
+
+
+@pytest.fixture
+def specs(tmp_path: PosixPath) -> str:
+    for name, source in (("alpine", "alpine:3.9"), ("python", "python:3.8-alpine")):
+        make_spec(
+            tmp_path,
+            name,
+            "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+            f"source: docker.io/library/{source}\n"
+            f"scripts: [script.sh]\ndest: derextests/{name}\n",
+        )
+    return make_spec(
+        tmp_path,
+        "root",
+        "builder: {class: derex.builder.builders.BuildahWheelCompiler}\n"
+        "requirements: [requirements.txt]\n"
+        "sources:\n"
+        "  base: {type: derex-relative, path: alpine}\n"
+        "  builder: {type: derex-relative, path: python}\n"
+        "dest: derextests/root\n",
+    )
+
+
+@pytest.fixture
+def registry(mocker: MockFixture):
+    tags = {
+        "docker.io/library/alpine:3.9": "sha256:aaaa",
+        "docker.io/library/python:3.8-alpine": "sha256:bbbb",
+    }
+    query = mocker.patch("derex.builder.digests.query_digest", side_effect=tags.get)
+    query.tags = tags
+    return query
+
+
+def pinned_session(tmp_path: PosixPath, **kwargs) -> BuildSession:
+    cache = str(tmp_path / "digests.json")
+    return BuildSession(pin_digests=True, digest_cache=cache, **kwargs)
+
+
+def test_parse_reference():
+    assert digests.parse_reference("alpine") == (
+        "docker.io",
+        "library/alpine",
+        "latest",
+    )
+    assert digests.parse_reference("docker.io/library/alpine:3.9") == (
+        "docker.io",
+        "library/alpine",
+        "3.9",
+    )
+    assert digests.parse_reference("localhost:5000/derex/base:1") == (
+        "localhost:5000",
+        "derex/base",
+        "1",
+    )
+    assert digests.split_tag("quay.io/derex/base") == ("quay.io/derex/base", "latest")
+
+
+def test_digests_are_looked_up_in_batch(specs, registry, tmp_path: PosixPath):
+    session = pinned_session(tmp_path)
+    alpine, python, root = walk_graph(session.create_builder(specs))
+    assert alpine.resolve_base_image(alpine.source, alpine.path) == (
+        "docker.io/library/alpine@sha256:aaaa"
+    )
+    root.dest
+    assert sorted(call[0][0] for call in registry.call_args_list) == sorted(
+        registry.tags
+    )
+    with open(tmp_path / "digests.json") as fileobj:
+        assert {image: entry[0] for image, entry in json.load(fileobj).items()} == (
+            registry.tags
+        )
+
+    # Other sessions use the cached digests while they're fresh
+    registry.reset_mock()
+    walk_graph(pinned_session(tmp_path).create_builder(specs))[-1].dest
+    registry.assert_not_called()
+    expired = {image: [digest, 0.0] for image, digest in registry.tags.items()}
+    (tmp_path / "digests.json").write_text(json.dumps(expired))
+    walk_graph(pinned_session(tmp_path).create_builder(specs))[-1].dest
+    assert registry.call_count == 2
+
+
+def test_only_moved_bases_change_hashes(specs, registry, tmp_path: PosixPath):
+    def images(session: BuildSession):
+        return [node.dest for node in walk_graph(session.create_builder(specs))]
+
+    pinned = images(pinned_session(tmp_path))
+    assert all(old != new for old, new in zip(images(BuildSession()), pinned))
+
+    registry.tags["docker.io/library/python:3.8-alpine"] = "sha256:cccc"
+    moved = images(pinned_session(tmp_path, digest_ttl=0))
+    assert moved[0] == pinned[0]  # alpine
+    assert moved[1] != pinned[1]  # python
+    assert moved[2] != pinned[2]  # root, based on python
+
+
+def test_unreachable_registry(specs, registry, tmp_path: PosixPath):
+    session = pinned_session(tmp_path)
+    registry.tags.clear()
+    alpine = session.create_builder(str(tmp_path / "alpine"))
+    assert alpine.pin(alpine.source) == "docker.io/library/alpine:3.9"
+
+    # The last known digest is used when the registry can't be reached
+    session.digests["docker.io/library/alpine:3.9"] = ("sha256:aaaa", 0.0)
+    assert digests.pin(session, alpine.source) == "docker.io/library/alpine@sha256:aaaa"
+
+
+def test_query_digest(mocker: MockFixture):
+    challenge = (
+        'Bearer realm="https://auth.example.com/token",service="registry.example.com"'
+    )
+    unauthorized = HTTPError(
+        "url", 401, "Unauthorized", {"WWW-Authenticate": challenge}, None
+    )
+    token = mocker.Mock(**{"read.return_value": b'{"token": "secret"}'})
+    manifest = mocker.Mock(headers={"Docker-Content-Digest": "sha256:dddd"})
+    urlopen = mocker.patch(
+        "derex.builder.digests.urlopen", side_effect=[unauthorized, token, manifest]
+    )
+    assert digests.query_digest("registry.example.com/derex/base:1") == "sha256:dddd"
+    token_url = urlopen.call_args_list[1][0][0]
+    assert token_url.startswith("https://auth.example.com/token?")
+    assert "scope=repository%3Aderex%2Fbase%3Apull" in token_url
+    request = urlopen.call_args_list[2][0][0]
+    assert request.full_url == "https://registry.example.com/v2/derex/base/manifests/1"
+    assert request.get_header("Authorization") == "Bearer secret"
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Pushing to the docker daemon"""
+
+from .utils import get_builder_path
+from derex.builder import docker_daemon
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import walk_graph
+from http.server import BaseHTTPRequestHandler
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import json
+import pytest
+import socketserver
+import threading
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        tags = self.server.tags
+        if self.path == "/images/json":
+            body = [{"Id": "sha256:1234", "RepoTags": tags}]
+            self.respond(200, body)
+        elif self.path[len("/images/") : -len("/json")] in tags:
+            self.respond(200, {"Id": "sha256:1234"})
+        else:
+            self.respond(404, {"message": "No such image"})
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_docker(tmp_path: PosixPath, mocker: MockFixture):
+    socket_path = str(tmp_path / "docker.sock")
+    server = socketserver.ThreadingUnixStreamServer(socket_path, FakeDockerHandler)
+    server.tags = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mocker.patch("derex.builder.docker_daemon.DOCKER_SOCKET", socket_path)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_walk_graph():
+    rapidjson = create_builder(get_builder_path("rapidjson"))
+    names = [builder.conf["dest"] for builder in walk_graph(rapidjson)]
+    assert names == [
+        "derextests/base_rapidjson",
+        "derextests/buildwheels_rapidjson",
+        "derextests/rapidjson-wheel",
+    ]
+
+
+def test_present_images(fake_docker):
+    fake_docker.tags = ["derextests/foo:1234", "alpine:3.9"]
+    present = docker_daemon.present_images(
+        ["derextests/foo:1234", "derextests/bar:1234", "docker.io/library/alpine:3.9"]
+    )
+    assert present == {"derextests/foo:1234", "docker.io/library/alpine:3.9"}
+    assert docker_daemon.image_present("derextests/foo:1234")
+    assert not docker_daemon.image_present("derextests/bar:1234")
+
+
+def test_unreachable_daemon(tmp_path: PosixPath):
+    socket_path = str(tmp_path / "nothing.sock")
+    assert docker_daemon.present_images(["foo:bar"], socket_path) == set()
+    assert not docker_daemon.image_present("foo:bar", socket_path)
+
+
+def test_push_images_skips_present(fake_docker, mocker: MockFixture):
+    resolve = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.resolve", autospec=True
+    )
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    builders = walk_graph(create_builder(get_builder_path("rapidjson")))
+    fake_docker.tags = [builders[0].dest]
+
+    pushed = docker_daemon.push_images(builders, jobs=2)
+    assert pushed == [builder.dest for builder in builders[1:]]
+    pushed_dests = sorted(call[0][1] for call in buildah.call_args_list)
+    assert pushed_dests == sorted(pushed)
+    # Images docker holds are not resolved
+    assert [call[0][0] for call in resolve.call_args_list] == builders[1:]
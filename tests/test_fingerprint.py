@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Git-aware input fingerprinting"""
+
+from .utils import get_builder_path
+from derex.builder import fingerprint
+from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.session import BuildSession
+from pathlib import PosixPath
+
+import pytest
+import shutil
+import subprocess
+
+
+@pytest.fixture
+def git_spec(tmp_path: PosixPath) -> PosixPath:
+    """A copy of the base spec, committed to a fresh git repository"""
+    spec = tmp_path / "base"
+    shutil.copytree(get_builder_path("base"), spec)
+    git = lambda *args: subprocess.check_call(("git",) + args, cwd=tmp_path)
+    git("init", "-q")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-qm.")
+    return spec
+
+
+def test_git_hashes(git_spec: PosixPath):
+    files = ["a_directory", "exclamation_mark.txt"]
+    initial = fingerprint.git_hashes(str(git_spec), files)
+    blob_id = subprocess.check_output(
+        ["git", "hash-object", "exclamation_mark.txt"], cwd=git_spec
+    )
+    assert initial[0] == blob_id.decode().strip()
+
+    # Rewriting a file with the same content does not change anything
+    content = (git_spec / "exclamation_mark.txt").read_bytes()
+    (git_spec / "exclamation_mark.txt").write_bytes(content)
+    assert fingerprint.git_hashes(str(git_spec), files) == initial
+
+    (git_spec / "exclamation_mark.txt").write_text("Changed")
+    assert fingerprint.git_hashes(str(git_spec), files)[0] != initial[0]
+
+    # Untracked files are taken into account
+    (git_spec / "a_directory" / "new_file.txt").write_text("New")
+    assert fingerprint.git_hashes(str(git_spec), files)[1] != initial[1]
+
+
+def test_git_hashes_outside_git(tmp_path: PosixPath):
+    assert fingerprint.git_hashes(str(tmp_path), ["foo"]) is None
+
+
+def test_builder_git_fingerprint(git_spec: PosixPath):
+    from_disk = BuildahBuilder(str(git_spec)).hash()
+    session = BuildSession(fingerprint="git")
+    initial = BuildahBuilder(str(git_spec), session=session).hash()
+    assert initial != from_disk
+    (git_spec / "a_directory" / "a_file.txt").write_text("Changed")
+    assert BuildahBuilder(str(git_spec), session=session).hash() != initial
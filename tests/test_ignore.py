@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Exclude patterns for hashed and copied inputs"""
+
+from .utils import get_builder_path
+from derex.builder import fingerprint
+from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.ignore import is_excluded
+from derex.builder.ignore import stage_directory
+from derex.builder.ignore import walk_files
+from pathlib import PosixPath
+
+import os
+import pytest
+import shutil
+import subprocess
+
+
+@pytest.fixture
+def spec(tmp_path: PosixPath) -> PosixPath:
+    spec = tmp_path / "base"
+    shutil.copytree(get_builder_path("base"), spec)
+    (spec / "a_directory" / "node_modules").mkdir()
+    (spec / "a_directory" / "node_modules" / "module.js").write_text("foo")
+    (spec / "a_directory" / "cache.pyc").write_text("foo")
+    (spec / ".derexignore").write_text("# Comment\nnode_modules/\n*.pyc\n")
+    return spec
+
+
+def test_is_excluded():
+    patterns = ["*.pyc", "build/", "/a_directory/tmp", "!keep.pyc"]
+    assert is_excluded("foo/bar.pyc", patterns)
+    assert not is_excluded("foo/keep.pyc", patterns)
+    assert is_excluded("foo/build", patterns, is_dir=True)
+    assert not is_excluded("foo/build", patterns)
+    assert is_excluded("a_directory/tmp", patterns)
+    assert not is_excluded("another_directory/tmp", patterns)
+
+
+def test_excluded_files_are_not_hashed(spec: PosixPath):
+    initial = BuildahBuilder(str(spec)).hash()
+    (spec / "a_directory" / "node_modules" / "module.js").write_text("bar")
+    (spec / "a_directory" / "cache.pyc").write_text("bar")
+    assert BuildahBuilder(str(spec)).hash() == initial
+    (spec / "a_directory" / "a_file.txt").write_text("Changed")
+    assert BuildahBuilder(str(spec)).hash() != initial
+
+
+def test_spec_exclude(spec: PosixPath):
+    builder = BuildahBuilder(str(spec))
+    assert builder.exclude == ["node_modules/", "*.pyc"]
+    initial = builder.hash()
+    builder.exclude.append("a_file.txt")
+    assert builder.hash() != initial
+
+
+def test_copy_matches_hash(spec: PosixPath, tmp_path: PosixPath):
+    builder = BuildahBuilder(str(spec))
+    source = str(spec / "a_directory")
+    staged = stage_directory(source, builder.exclude, builder.path, str(tmp_path / "x"))
+    copied = sorted(
+        os.path.relpath(os.path.join(root, name), staged)
+        for root, _, files in os.walk(staged)
+        for name in files
+    )
+    hashed = [
+        os.path.relpath(path, source)
+        for path, _ in walk_files(source, builder.exclude, builder.path)
+    ]
+    assert copied == hashed == ["a_file.txt"]
+
+
+def test_git_fingerprint_honors_excludes(spec: PosixPath, tmp_path: PosixPath):
+    git = lambda *args: subprocess.check_call(("git",) + args, cwd=tmp_path)
+    git("init", "-q")
+    git("add", ".")
+    files = ["a_directory"]
+    initial = fingerprint.git_hashes(str(spec), files, ["node_modules/", "*.pyc"])
+    (spec / "a_directory" / "node_modules" / "module.js").write_text("bar")
+    (spec / "a_directory" / "new.pyc").write_text("bar")
+    assert fingerprint.git_hashes(str(spec), files, ["node_modules/", "*.pyc"]) == (
+        initial
+    )
+    assert fingerprint.git_hashes(str(spec), files) != initial
+
+
+def test_links_are_staged_as_links(spec: PosixPath, tmp_path: PosixPath):
+    builder = BuildahBuilder(str(spec))
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside" / "big.bin").write_text("not hashed")
+    (spec / "a_directory" / "linked_dir").symlink_to(str(tmp_path / "outside"))
+    (spec / "a_directory" / "linked_file").symlink_to("a_file.txt")
+    source = str(spec / "a_directory")
+    staged = PosixPath(
+        stage_directory(source, builder.exclude, builder.path, str(tmp_path / "x"))
+    )
+    assert os.readlink(str(staged / "linked_dir")) == str(tmp_path / "outside")
+    assert os.readlink(str(staged / "linked_file")) == "a_file.txt"
+    assert (staged / "a_file.txt").is_file()
+    assert not (staged / "a_file.txt").is_symlink()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cross-process build locks"""
+
+from .utils import get_builder_path
+from derex.builder import locks
+from derex.builder.builders.buildah import BuildahBuilder
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import pytest
+import subprocess
+import sys
+import time
+
+
+def test_build_lock_across_processes():
+    holder = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, time\n"
+            "from derex.builder import locks\n"
+            f"locks.LOCK_DIR = {locks.LOCK_DIR!r}\n"
+            "with locks.build_lock('derextests/foo:bar'):\n"
+            "    print('locked', flush=True)\n"
+            "    time.sleep(0.5)\n",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    assert holder.stdout.readline() == b"locked\n"
+    with locks.build_lock("derextests/foo:bar") as waited:
+        assert waited > 0.1
+    holder.wait()
+    with locks.build_lock("derextests/foo:bar") as waited:
+        assert waited == 0
+
+
+def test_owner_leases():
+    owner = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "from derex.builder import locks\n"
+            f"locks.LOCK_DIR = {locks.LOCK_DIR!r}\n"
+            "print(locks.owner_id(), flush=True)\n"
+            "sys.stdin.read()\n",
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    other = owner.stdout.readline().decode().strip()
+    assert other != locks.owner_id() == locks.owner_id()
+    assert locks.owner_alive(other)
+    assert locks.owner_alive(locks.owner_id())
+    owner.communicate(b"")  # Exits
+    assert locks.owner_alive(other) is False
+    assert locks.owner_alive(other) is None  # The lease is gone with it
+    assert locks.owner_alive("0123456789ab") is None
+
+
+def test_resolve_rechecks_after_lock(mocker: MockFixture):
+    builder = BuildahBuilder(get_builder_path("base"))
+    list_buildah_images = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.list_buildah_images"
+    )
+    # Not there at first, but another process finished it while we waited
+    list_buildah_images.side_effect = [[], [builder.dest]]
+    build = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.build")
+    registry = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.available_docker_registry"
+    )
+    builder.resolve()
+    build.assert_not_called()
+    registry.assert_not_called()
+    list_buildah_images.assert_called_with(refresh=True, session=builder.session)
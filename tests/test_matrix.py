@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Matrix variants and step checkpoints"""
+
+from derex.builder import history
+from derex.builder import plan
+from derex.builder.builders.base import ConfigurationError
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import walk_graph
+from derex.builder.session import get_session
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+from typing import Iterator
+
+import os
+import pytest
+
+
+@pytest.fixture
+def matrix(tmp_path: PosixPath, mocker: MockFixture) -> Iterator[str]:
+    get_session().clear_builders()
+    spec = tmp_path / "matrix"
+    spec.mkdir()
+    (spec / "spec.yml").write_text(
+        "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+        "source: docker.io/library/python:3.7-alpine\n"
+        "scripts: [common.sh, versioned.sh]\n"
+        "shared_scripts: [common.sh]\n"
+        "matrix:\n"
+        "  py37: {env: {FLAVOUR: slim}}\n"
+        "  py37-full: {env: {FLAVOUR: full}}\n"
+        "  py38: {source: docker.io/library/python:3.8-alpine}\n"
+        "dest: derextests/matrix\n"
+    )
+    (spec / "common.sh").write_text("apk add gcc\n")
+    (spec / "versioned.sh").write_text("echo ${FLAVOUR} > /flavour\n")
+    yield str(spec)
+    get_session().clear_builders()
+
+
+def test_variants(matrix: str):
+    builder = create_builder(matrix)
+    variants = walk_graph(builder)
+    assert [variant.variant for variant in variants] == ["py37", "py37-full", "py38"]
+    assert builder not in variants
+    assert builder.images() == [variant.dest for variant in variants]
+    assert variants[0].dest.startswith("derextests/matrix:py37-")
+    assert variants[2].source == "docker.io/library/python:3.8-alpine"
+    assert variants[0].script_variables("versioned.sh") == {"FLAVOUR": "slim"}
+    assert variants[0].script_variables("common.sh") == {}
+    with pytest.raises(ConfigurationError):
+        create_builder(matrix, "py39")
+
+
+def test_variant_hash_only_depends_on_own_entry(matrix: str):
+    py37 = create_builder(matrix, "py37").dest
+    spec = PosixPath(matrix) / "spec.yml"
+    spec.write_text(spec.read_text().replace("3.8-alpine", "3.8-slim"))
+    get_session().clear_builders()
+    assert create_builder(matrix, "py37").dest == py37
+    assert create_builder(matrix, "py38").dest != py37
+
+
+def test_checkpoints_are_shared(matrix: str):
+    slim, full, py38 = walk_graph(create_builder(matrix))
+    base = "docker.io/library/python:3.7-alpine"
+    slim_steps, full_steps = slim.checkpoints(base), full.checkpoints(base)
+    assert [script for script, _ in slim_steps] == [None, "common.sh", "versioned.sh"]
+    assert slim_steps[:2] == full_steps[:2]
+    assert slim_steps[2] != full_steps[2]
+    assert py38.checkpoints("docker.io/library/python:3.8-alpine")[0] != slim_steps[0]
+
+
+def test_scripts_get_all_variables_unless_shared(matrix: str):
+    spec = PosixPath(matrix) / "spec.yml"
+    spec.write_text(spec.read_text().replace("shared_scripts: [common.sh]\n", ""))
+    slim, full, _ = walk_graph(create_builder(matrix))
+    # Even if it doesn't mention them: the programs it runs might use them
+    assert slim.script_variables("common.sh") == {"FLAVOUR": "slim"}
+    base = "docker.io/library/python:3.7-alpine"
+    slim_steps, full_steps = slim.checkpoints(base), full.checkpoints(base)
+    assert slim_steps[0] == full_steps[0]  # Copying doesn't use them
+    assert slim_steps[1] != full_steps[1]
+
+    spec.write_text(spec.read_text() + "shared_scripts: [missing.sh]\n")
+    get_session().clear_builders()
+    with pytest.raises(ConfigurationError):
+        create_builder(matrix, "py37")
+
+
+def test_build_steps_resumes_from_checkpoint(matrix: str, mocker: MockFixture):
+    slim, full, _ = walk_graph(create_builder(matrix))
+    base = "docker.io/library/python:3.7-alpine"
+    images = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.list_buildah_images"
+    )
+    images.return_value = [checkpoint for _, checkpoint in slim.checkpoints(base)]
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    buildah.return_value = "container-id"
+    buildah_run = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.buildah_run"
+    )
+    full.build_steps(base)
+
+    shared = full.checkpoints(base)[1][1]
+    buildah.assert_any_call("from", shared, print_output=False)
+    buildah.assert_called_with(
+        "commit", "container-id", full.checkpoints(base)[2][1], print_output=False
+    )
+    commands = [call[0][1] for call in buildah_run.call_args_list]
+    assert ["env", "FLAVOUR=full", "/opt/derex/bin/versioned.sh"] in commands
+    assert ["/opt/derex/bin/common.sh"] not in commands
+
+
+def test_checkpoints_leave_build_env_out(matrix: str, mocker: MockFixture):
+    spec = PosixPath(matrix) / "spec.yml"
+    spec.write_text(spec.read_text() + "build_env: [PIP_TOKEN]\n")
+    mocker.patch.dict(os.environ, {"PIP_TOKEN": "secret"})
+    slim = create_builder(matrix, "py37")
+    mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.list_buildah_images",
+        return_value=[],
+    )
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    buildah.return_value = "container-id"
+    mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah_run")
+    mocker.patch("derex.builder.copy_engine.copy")
+    slim.build_steps("docker.io/library/python:3.7-alpine")
+
+    calls = [call[0][:2] for call in buildah.call_args_list]
+    for index, (command, _) in enumerate(calls):
+        if command == "commit":
+            assert calls[index - 1] == ("config", "--env")
+            assert buildah.call_args_list[index - 1][0][2] == "PIP_TOKEN="
+            assert buildah.call_args_list[index + 1][0][2] == "PIP_TOKEN=secret"
+    assert [command for command, _ in calls].count("commit") == 3
+
+
+def test_prune_checkpoints(matrix: str, mocker: MockFixture):
+    builder = create_builder(matrix)
+    slim = walk_graph(builder)[0]
+    current = [
+        checkpoint
+        for _, checkpoint in slim.checkpoints("docker.io/library/python:3.7-alpine")
+    ]
+    stale = "derextests/matrix:checkpoint-0123456789abcdef"
+    mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.list_buildah_images",
+        return_value=current + [stale, "derextests/other:checkpoint-0123"],
+    )
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    assert builder.prune_checkpoints() == [stale]
+    buildah.assert_called_once_with("rmi", stale, print_output=False)
+    assert builder.prune_checkpoints(keep_current=False) == current + [stale]
+
+
+def test_variants_have_their_own_history(matrix: str, mocker: MockFixture):
+    for variant in walk_graph(create_builder(matrix)):
+        inputs = variant.input_hashes()
+        history.record_inputs(history.name_of(variant), variant.dest, inputs)
+    assert history.name_of(create_builder(matrix, "py37")) == "derextests/matrix@py37"
+    (PosixPath(matrix) / "common.sh").write_text("apk add gcc g++\n")
+    get_session().clear_builders()
+
+    mocker.patch("derex.builder.builders.base.BaseBuilder.locate", return_value=None)
+    for variant in walk_graph(create_builder(matrix)):
+        entry = plan.plan_node(variant, check_registry=False)
+        assert entry["changes"] == [{"input": "script common.sh", "change": "modified"}]
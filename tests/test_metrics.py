@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Prometheus textfile metrics"""
+
+from .utils import get_builder_path
+from derex.builder import metrics
+from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.session import BuildSession
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated(mocker: MockFixture):
+    mocker.patch.dict("derex.builder.metrics.VALUES", clear=True)
+    mocker.patch.dict("derex.builder.metrics.MOUNTED_CACHES", clear=True)
+
+
+def test_render():
+    metrics.inc("buildah_calls_total", command="from")
+    metrics.inc("buildah_calls_total", command="from")
+    metrics.inc("wheel_cache_total", 3, result='odd"name')
+    text = metrics.render(metrics.VALUES)
+    assert "# TYPE derex_builder_buildah_calls_total counter" in text
+    assert 'derex_builder_buildah_calls_total{command="from"} 2.0' in text
+    assert 'derex_builder_wheel_cache_total{result="odd\\"name"} 3.0' in text
+    with pytest.raises(KeyError):
+        metrics.inc("no_such_metric")
+
+
+def test_write_merges_counters(tmp_path: PosixPath):
+    metrics.inc("hashed_bytes_total", 100)
+    metrics.set_gauge("cache_size_bytes", 10, cache="custom")
+    metrics.write(str(tmp_path))
+    metrics.inc("hashed_bytes_total", 50)
+    metrics.set_gauge("cache_size_bytes", 7, cache="custom")
+    metrics.write(str(tmp_path))
+
+    values = metrics.read_textfile(str(tmp_path / "derex_builder.prom"))
+    assert values["derex_builder_hashed_bytes_total"] == 150
+    assert values['derex_builder_cache_size_bytes{cache="custom"}'] == 7
+    assert "derex_builder_last_run_timestamp_seconds" in values
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_cache_sizes_of_builds(tmp_path: PosixPath, mocker: MockFixture):
+    directory_size = mocker.patch(
+        "derex.builder.metrics.directory_size", return_value=42
+    )
+    metrics.write(str(tmp_path))  # Nothing was built
+    directory_size.assert_not_called()
+
+    session = BuildSession(caches={"/root/.cache/pip": str(tmp_path)})
+    builder = BuildahBuilder(get_builder_path("base"), session=session)
+    mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    builder.buildah_run("container-id", ["true"])
+    metrics.write(str(tmp_path))
+    directory_size.assert_called_once_with(str(tmp_path))
+    values = metrics.read_textfile(str(tmp_path / "derex_builder.prom"))
+    assert values['derex_builder_cache_size_bytes{cache="PIP_CACHE"}'] == 42
+
+
+def test_write_disabled(mocker: MockFixture):
+    mocker.patch("derex.builder.metrics.METRICS_TEXTFILE", None)
+    metrics.inc("hashed_bytes_total", 100)
+    metrics.write()
+    assert metrics.VALUES  # Nothing was flushed
+
+
+def test_resolve_outcomes(mocker: MockFixture):
+    builder = BuildahBuilder(get_builder_path("base"))
+    list_buildah_images = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.list_buildah_images"
+    )
+    mocker.patch("derex.builder.builders.buildah.BuildahBuilder.build")
+    mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.available_docker_registry",
+        return_value=False,
+    )
+    list_buildah_images.return_value = []
+    builder.resolve()
+    list_buildah_images.return_value = [builder.dest]
+    builder.resolve()
+
+    spec = builder.conf["dest"]
+    for outcome in ("built", "local"):
+        key = metrics.series("resolutions_total", dict(outcome=outcome, spec=spec))
+        assert metrics.VALUES[key] == 1
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Plans of what resolving a graph would do"""
+
+from click.testing import CliRunner
+from derex.builder import cli
+from derex.builder import history
+from derex.builder import plan
+from derex.builder.builders.base import walk_graph
+from derex.builder.session import BuildSession
+from derex.builder.session import get_session
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import json
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def isolated(mocker: MockFixture):
+    mocker.patch.object(get_session(), "import_dir", None)
+    mocker.patch.object(get_session(), "artifact_cache", None)
+
+
+def test_plan(fork: str, mocker: MockFixture):
+    short, long, root = walk_graph(BuildSession().create_builder(fork))
+    for node in (long, root):
+        history.record_inputs(history.name_of(node), node.dest, node.input_hashes())
+    (PosixPath(long.path) / "script.sh").write_text("echo changed")
+
+    session = BuildSession()
+    builder = session.create_builder(fork)
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images",
+        return_value=[short.dest],
+    )
+    query = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.query_docker_registry"
+    )
+    entries = plan.plan(builder)
+    query.assert_not_called()
+    assert [entry["action"] for entry in entries] == ["present", "build", "build"]
+    assert entries[1]["previous"] == long.dest
+    assert entries[1]["changes"] == [
+        {"input": "script script.sh", "change": "modified"}
+    ]
+    assert entries[2]["changes"] == [{"input": "source builder", "change": "modified"}]
+    assert plan.summary(entries)["build"] == 2
+
+    # Answers from the registry are used when cached, or when asked for
+    session.registry_cache[entries[1]["dest"]] = (True, 0.0)
+    entries = plan.plan(builder)
+    assert [entry["action"] for entry in entries] == ["present", "pull", "build"]
+    query.assert_not_called()
+    query.return_value = True
+    entries = plan.plan(builder, check_registry=True)
+    # What a pulled image is based on doesn't matter
+    assert [entry["dest"] for entry in entries] == [builder.dest]
+    assert entries[0]["action"] == "pull"
+    query.assert_called_once()
+
+
+def test_plan_command(fork: str, mocker: MockFixture):
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images", return_value=[]
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ["plan", "--json", "--fail-on-build", fork])
+    assert result.exit_code == 1
+    output = json.loads(result.output)
+    assert output["summary"]["build"] == 3
+    assert output["images"][0]["reason"] == "no previous build recorded"
+
+    result = runner.invoke(cli.main, ["plan", fork])
+    assert result.exit_code == 0
+    summary = "0 present, 0 import, 0 fetch, 0 pull, 3 build"
+    assert result.output.splitlines()[-1] == summary
+
+
+def test_diff_inputs():
+    old = {"conf": "1", "script a.sh": "2", "copy b": "3"}
+    new = {"conf": "1", "script a.sh": "4", "copy c": "5"}
+    assert plan.diff_inputs(old, new) == [
+        {"input": "copy b", "change": "removed"},
+        {"input": "copy c", "change": "added"},
+        {"input": "script a.sh", "change": "modified"},
+    ]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Builder container pool"""
+
+from derex.builder import pool
+from derex.builder.session import BuildSession
+from pytest_mock import MockFixture
+
+import gc
+import pytest
+import weakref
+
+
+@pytest.fixture
+def buildah(mocker: MockFixture):
+    mocker.patch("derex.builder.pool.SWEPT", True)
+    names = iter(f"container-{index}" for index in range(10))
+    return mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.buildah",
+        side_effect=lambda command, *args, **kwargs: next(names)
+        if command == "from"
+        else "",
+    )
+
+
+def test_containers_are_reused(buildah, mocker: MockFixture):
+    containers = pool.ContainerPool()
+    prepare = mocker.Mock(return_value="state")
+    reset = mocker.Mock(return_value=True)
+    with containers.container("builder:1", prepare, reset) as first:
+        pass
+    with containers.container("builder:1", prepare, reset) as second:
+        pass
+    with containers.container("builder:2", prepare, reset) as other:
+        pass
+    assert first == second == "container-0"
+    assert other == "container-1"
+    prepare.assert_has_calls([mocker.call("container-0"), mocker.call("container-1")])
+    reset.assert_called_with("container-1", "state")
+
+    containers.close()
+    removed = [call[0][1] for call in buildah.call_args_list if call[0][0] == "rm"]
+    assert sorted(removed) == ["container-0", "container-1"]
+    assert not containers.idle
+
+
+def test_dirty_containers_are_removed(buildah, mocker: MockFixture):
+    containers = pool.ContainerPool()
+    prepare = mocker.Mock()
+    with containers.container("builder:1", prepare, lambda *args: False):
+        pass
+    buildah.assert_called_with("rm", "container-0", print_output=False)
+    with pytest.raises(ValueError):
+        with containers.container("builder:1", prepare, lambda *args: True):
+            raise ValueError()
+    buildah.assert_called_with("rm", "container-1", print_output=False)
+    assert not containers.idle["builder:1"]
+
+
+def test_pool_size(buildah, mocker: MockFixture):
+    containers = pool.ContainerPool(1)
+    prepare, reset = mocker.Mock(), mocker.Mock(return_value=True)
+    with containers.container("builder:1", prepare, reset):
+        with containers.container("builder:1", prepare, reset):
+            pass
+    assert [name for name, _ in containers.idle["builder:1"]] == ["container-1"]
+    buildah.assert_called_with("rm", "container-0", print_output=False)
+    containers.close()
+
+
+def test_sweep_stale_containers(buildah, mocker: MockFixture):
+    mocker.patch("derex.builder.pool.SWEPT", False)
+    buildah.side_effect = [
+        "derex-pool-0123456789ab-aaaa\n"
+        "derex-pool-ba9876543210-bbbb\n"
+        "derex-pool-aaaaaaaaaaaa-cccc\n"
+        "derex-pool-1234-dddd\n"  # Named after a PID by an older version
+        "unrelated-container\n",
+        "",
+    ]
+    owners = {"0123456789ab": True, "ba9876543210": False}
+    mocker.patch("derex.builder.pool.owner_alive", side_effect=owners.get)
+    pool.sweep()
+    pool.sweep()  # Only once per process
+    # Containers of unknown owners are left alone
+    buildah.assert_called_with("rm", "derex-pool-ba9876543210-bbbb", print_output=False)
+    assert buildah.call_count == 2
+
+
+def test_pools_are_closed_on_exit(buildah, mocker: MockFixture):
+    session = BuildSession()
+    prepare, reset = mocker.Mock(), mocker.Mock(return_value=True)
+    with session.pool.container("builder:1", prepare, reset):
+        pass
+    pool.close_pools()
+    buildah.assert_called_with("rm", "container-0", print_output=False)
+
+    # Exit hooks don't keep sessions alive
+    collected = weakref.ref(session)
+    del session
+    gc.collect()
+    assert collected() is None
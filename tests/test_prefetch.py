@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Background prefetch of base images"""
+
+from .utils import get_builder_path
+from derex.builder import prefetch
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import nodes_to_build
+from derex.builder.builders.base import walk_graph
+from derex.builder.session import BuildSession
+from pytest_mock import MockFixture
+
+import pytest
+import threading
+
+
+@pytest.fixture(autouse=True)
+def shutdown():
+    yield
+    prefetch.shutdown()
+
+
+def test_base_images():
+    builders = walk_graph(create_builder(get_builder_path("rapidjson")))
+    assert prefetch.base_images(builders) == ["docker.io/library/python:3-alpine3.9"]
+
+
+def test_prefetch_overlaps(mocker: MockFixture):
+    builders = walk_graph(create_builder(get_builder_path("dependent")))
+    list_images = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images"
+    )
+    list_images.return_value = []
+    release = threading.Event()
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    buildah.side_effect = lambda *args, **kwargs: release.wait(5)
+
+    assert prefetch.prefetch(builders) == ["docker.io/library/alpine:3.9"]
+    # Pulls run in the background
+    future = prefetch.FUTURES["docker.io/library/alpine:3.9"]
+    assert not future.done()
+    # resolve_base_image waits for the download to finish
+    release.set()
+    assert builders[0].resolve_base_image(builders[0].source, builders[0].path) == (
+        "docker.io/library/alpine:3.9"
+    )
+    assert future.done()
+    buildah.assert_called_once_with(
+        "pull", "--quiet", "docker.io/library/alpine:3.9", print_output=False
+    )
+
+
+def test_prefetch_skips_local_images(mocker: MockFixture):
+    builders = walk_graph(create_builder(get_builder_path("dependent")))
+    list_images = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images"
+    )
+    list_images.return_value = ["library/alpine:3.9"]
+    assert prefetch.prefetch(builders) == []
+
+
+def test_prefetch_is_best_effort(mocker: MockFixture):
+    builders = walk_graph(create_builder(get_builder_path("dependent")))
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images",
+        side_effect=FileNotFoundError("buildah"),
+    )
+    assert prefetch.prefetch(builders) == []
+    assert not prefetch.FUTURES
+
+
+def test_only_bases_of_builds_are_prefetched(mocker: MockFixture):
+    builder = create_builder(get_builder_path("dependent"))
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images", return_value=[]
+    )
+    registry = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_docker_registry",
+        return_value=True,
+    )
+    assert nodes_to_build(builder) == []
+    registry.return_value = False
+    assert nodes_to_build(builder) == walk_graph(builder)
+
+
+def test_pinned_references_are_prefetched(mocker: MockFixture):
+    mocker.patch("derex.builder.digests.query_digest", return_value="sha256:aaaa")
+    session = BuildSession(pin_digests=True)
+    builders = walk_graph(session.create_builder(get_builder_path("dependent")))
+    pinned = "docker.io/library/alpine@sha256:aaaa"
+    list_images = mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.list_buildah_images"
+    )
+    list_images.return_value = ["library/alpine@sha256:aaaa"]
+    assert prefetch.prefetch(builders) == []
+    # The tag being local says nothing about the digest it's pinned to
+    list_images.return_value = ["library/alpine:3.9"]
+    buildah = mocker.patch("derex.builder.builders.base.BaseBuilder.buildah")
+    assert prefetch.prefetch(builders) == [pinned]
+    wait = mocker.patch("derex.builder.prefetch.wait")
+    assert builders[0].resolve_base_image(builders[0].source, builders[0].path) == (
+        pinned
+    )
+    wait.assert_called_once_with(pinned)
+    prefetch.FUTURES[pinned].result()
+    buildah.assert_called_once_with("pull", "--quiet", pinned, print_output=False)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Resource budgets and admission of builds"""
+
+from .conftest import make_spec
+from derex.builder import locks
+from derex.builder import resources
+from derex.builder.session import BuildSession
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import os
+import pytest
+
+
+@pytest.fixture
+def spec(tmp_path: PosixPath) -> str:
+    return make_spec(
+        tmp_path,
+        "budgeted",
+        "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+        "source: docker.io/library/alpine:3.9\n"
+        "scripts: [script.sh]\n"
+        "resources: {cpus: 1.5, memory: 2G}\n"
+        "dest: derextests/budgeted\n",
+    )
+
+
+@pytest.fixture
+def reservations(mocker: MockFixture) -> PosixPath:
+    mocker.patch.dict(os.environ, {"DEREX_HOST_CPUS": "4", "DEREX_HOST_MEMORY": "8G"})
+    directory = PosixPath(resources.reservations_dir())
+    directory.mkdir(parents=True)
+    return directory
+
+
+def test_budgets():
+    budget = {"cpus": 1.5, "cpuset": "0-3,6", "cpu_shares": 512, "memory": "2G"}
+    assert resources.from_options(budget) == [
+        "--cpu-period=100000",
+        "--cpu-quota=150000",
+        "--cpuset-cpus=0-3,6",
+        "--cpu-shares=512",
+        "--memory=2G",
+    ]
+    assert resources.budget(budget) == (1.5, 2 * 2 ** 30)
+    assert resources.budget({"cpuset": "0-3,6"}) == (5.0, 0)
+    assert resources.budget({"jobs": 3}) == (3.0, 0)
+    assert resources.budget({}) == (1.0, 0)
+    assert resources.build_env({"jobs": 3}) == {
+        "CMAKE_BUILD_PARALLEL_LEVEL": "3",
+        "MAKEFLAGS": "-j3",
+    }
+    assert resources.from_environ({"DEREX_CPUS": "2", "DEREX_MAKE_JOBS": "4"}) == {
+        "cpus": 2.0,
+        "jobs": 4,
+    }
+
+
+def test_spec_budget(spec: str, mocker: MockFixture):
+    session = BuildSession(resources={"memory": "1G", "jobs": 2})
+    builder = session.create_builder(spec)
+    assert builder.resource_budget() == {"cpus": 1.5, "memory": "2G", "jobs": 2}
+    # Budgets don't change images
+    (PosixPath(spec) / "spec.yml").write_text(
+        (PosixPath(spec) / "spec.yml").read_text().replace("cpus: 1.5", "cpus: 3")
+    )
+    assert BuildSession().create_builder(spec).dest == builder.dest
+
+    buildah = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.buildah")
+    buildah.return_value = "container-id"
+    buildah_run = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.buildah_run"
+    )
+    mocker.patch("derex.builder.copy_engine.copy")
+    container = builder.start_container("alpine")
+    builder.run_script(container, "script.sh")
+    buildah.assert_any_call(
+        "from",
+        "--cpu-period=100000",
+        "--cpu-quota=150000",
+        "--memory=2G",
+        "alpine",
+        print_output=False,
+    )
+    buildah_run.assert_called_with(
+        "container-id",
+        [
+            "env",
+            "CMAKE_BUILD_PARALLEL_LEVEL=2",
+            "MAKEFLAGS=-j2",
+            "/opt/derex/bin/script.sh",
+        ],
+    )
+
+
+def test_admission(reservations: PosixPath, mocker: MockFixture):
+    running = reservations / f"{locks.owner_id()}-running.json"
+    running.write_text('{"name": "running", "cpus": 3, "memory": 0}')
+    (reservations / "0123456789ab-dead.json").write_text(
+        '{"name": "dead", "cpus": 4, "memory": 0}'
+    )
+
+    def finish(seconds: float):
+        running.unlink()
+
+    sleep = mocker.patch("derex.builder.resources.time.sleep", side_effect=finish)
+    with resources.admit("derextests/waiting", 2.0, 0):
+        sleep.assert_called_once()
+        assert not (reservations / "0123456789ab-dead.json").exists()
+        assert resources.read_reservations(str(reservations)) == [(2.0, 0)]
+        # Memory counts too, when limited
+        assert not resources.fits([(2.0, 0)], 1.0, 9 * 2 ** 30)
+        assert resources.fits([(2.0, 0)], 2.0, 2 * 2 ** 30)
+    assert not list(reservations.iterdir())
+
+    # A build larger than the host is admitted when the host is idle
+    with resources.admit("derextests/large", 16.0, 0):
+        assert sleep.call_count == 1
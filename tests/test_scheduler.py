@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Build history and critical path scheduling"""
+
+from .conftest import make_spec
+from .utils import get_builder_path
+from click.testing import CliRunner
+from derex.builder import cli
+from derex.builder import history
+from derex.builder import scheduler
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import needed_graph
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import pytest
+
+
+def test_history():
+    assert history.estimate("derextests/foo") is None
+    for seconds in (10, 12, 11, 30):
+        history.record("derextests/foo", "derextests/foo:1", "build", seconds)
+    history.record("derextests/foo", "derextests/foo:1", "step", 3, "script.sh")
+    assert history.durations("derextests/foo") == [30, 11, 12, 10]
+    assert history.estimate("derextests/foo") == 12
+    build, step = history.summary()
+    assert build["regression"] and build["runs"] == 4
+    assert step["step"] == "script.sh" and not step["regression"]
+
+
+def test_history_failures_are_ignored(tmp_path: PosixPath, mocker: MockFixture):
+    # A path that can't be created
+    (tmp_path / "file").write_text("")
+    mocker.patch("derex.builder.history.HISTORY_DB", str(tmp_path / "file" / "db"))
+    history.record("derextests/foo", "derextests/foo:1", "build", 10)
+    history.record_size("derextests/foo", "derextests/foo:1", 100)
+    history.record_inputs("derextests/foo", "derextests/foo:1", {})
+
+    # A corrupt database
+    corrupt = tmp_path / "corrupt.db"
+    corrupt.write_bytes(b"Not a database" * 100)
+    mocker.patch("derex.builder.history.HISTORY_DB", str(corrupt))
+    history.record("derextests/foo", "derextests/foo:1", "build", 10)
+    assert history.previous_size("derextests/foo", "derextests/foo:2") is None
+    assert history.previous_inputs("derextests/foo", "derextests/foo:2") is None
+    assert history.durations("derextests/foo") == []
+    assert history.estimate("derextests/foo") is None
+    assert history.summary() == []
+
+
+def test_critical_path_order(fork: str, mocker: MockFixture):
+    root = create_builder(fork)
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_docker_registry",
+        return_value=False,
+    )
+    history.record("derextests/short", "x", "build", 20)
+    history.record("derextests/long", "x", "build", 100)
+    history.record("derextests/root", "x", "build", 50)
+    assert scheduler.predict(root) == {"sequential": 170, "critical_path": 150}
+
+    started = []
+    for cls in ("buildah.BuildahBuilder", "wheel_compiler.BuildahWheelCompiler"):
+        mocker.patch(
+            f"derex.builder.builders.{cls}.resolve",
+            autospec=True,
+            side_effect=lambda builder: started.append(builder.conf["dest"]),
+        )
+    scheduler.resolve_graph(root, jobs=1)
+    # The longest chain starts first, even if walk_graph lists it second
+    assert started == ["derextests/long", "derextests/short", "derextests/root"]
+
+
+def test_available_images_are_not_built_through(
+    tmp_path: PosixPath, mocker: MockFixture
+):
+    make_spec(
+        tmp_path,
+        "bottom",
+        "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+        "source: docker.io/library/alpine:3.9\n"
+        "scripts: [script.sh]\ndest: derextests/bottom\n",
+    )
+    for name, source in (("middle", "bottom"), ("top", "middle")):
+        make_spec(
+            tmp_path,
+            name,
+            "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+            f"source: {{type: derex-relative, path: {source}}}\n"
+            f"scripts: [script.sh]\ndest: derextests/{name}\n",
+        )
+    top = create_builder(str(tmp_path / "top"))
+    middle, bottom = top.dependencies()[0], top.dependencies()[0].dependencies()[0]
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    located = {top.dest: "local"}
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.locate",
+        autospec=True,
+        side_effect=lambda node: located.get(node.dest),
+    )
+    resolve = mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.resolve", autospec=True
+    )
+    assert scheduler.resolve_graph(top, jobs=2) == [top.dest]
+    resolve.assert_called_once_with(top)
+
+    # Images to build need the ones they're based on, down to available ones
+    located = {middle.dest: "registry"}
+    assert scheduler.resolve_graph(top, jobs=2) == [middle.dest, top.dest]
+    located = {}
+    assert needed_graph(top) == [bottom, middle, top]
+
+
+def test_stats_command():
+    history.record("derextests/foo", "derextests/foo:1", "build", 10)
+    runner = CliRunner()
+    result = runner.invoke(cli.main, ["stats"])
+    assert result.exit_code == 0
+    assert "derextests/foo build: 1 runs, last 10.0s" in result.output
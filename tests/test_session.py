@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Build sessions"""
+
+from .utils import get_builder_path
+from derex.builder.builders.base import BaseBuilder
+from derex.builder.builders.base import create_builder
+from derex.builder.builders.base import walk_graph
+from derex.builder.session import BuildSession
+from derex.builder.session import get_session
+from pytest_mock import MockFixture
+
+
+def test_builders_belong_to_their_session():
+    first, second = BuildSession(), BuildSession()
+    path = get_builder_path("dependent")
+    builder = first.create_builder(path)
+    assert first.create_builder(path) is builder
+    assert second.create_builder(path) is not builder
+    assert all(node.session is first for node in walk_graph(builder))
+    assert create_builder(path).session is get_session()
+
+    first.clear_builders()
+    assert first.create_builder(path) is not builder
+
+
+def test_file_hashes_are_cached_per_session():
+    first, second = BuildSession(), BuildSession()
+    path = get_builder_path("base")
+    dest = first.create_builder(path).dest
+    assert first.file_hashes
+    assert not second.file_hashes
+    assert second.create_builder(path).dest == dest
+
+
+def test_inventory_is_invalidated_in_all_sessions(mocker: MockFixture):
+    run = mocker.patch("derex.builder.builders.base.BaseBuilder.run")
+    run.return_value = iter(['[{"names": ["localhost/derextests/base:1"]}]'])
+    first, second = BuildSession(), BuildSession()
+    assert BaseBuilder.list_buildah_images(session=first) == ["derextests/base:1"]
+    assert first.cached_images() == ["derextests/base:1"]
+    assert second.cached_images() is None
+
+    run.return_value = iter([])
+    BaseBuilder.buildah("tag", "derextests/base:1", "derextests/base:2")
+    assert first.cached_images() is None
+
+
+def test_configuration_from_environment(tmp_path):
+    session = BuildSession.from_environ(
+        {
+            "PIP_CACHE": str(tmp_path / "pip"),
+            "NPM_CACHE": "",
+            "WHEELS_CACHE": str(tmp_path),
+            "DEREX_REGISTRY_TTL": "10",
+            "DEREX_POOL_SIZE": "0",
+            "DEREX_FINGERPRINT": "git",
+            "DEREX_ARTIFACT_CACHE": str(tmp_path),
+            "DEREX_ARTIFACT_CACHE_SIZE": "1G",
+        }
+    )
+    assert session.caches == {"/root/.cache/pip": str(tmp_path / "pip")}
+    assert session.wheels_cache == str(tmp_path)
+    assert session.registry_ttl == 10.0
+    assert session.inventory_ttl == 30.0
+    assert session.pool.size == 0
+    assert session.fingerprint == "git"
+    assert session.artifact_cache == str(tmp_path)
+    assert session.artifact_cache_size == 2 ** 30
+    assert session.import_dir is None
+    assert session.hash_algorithm == "sha256"
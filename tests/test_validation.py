@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Deep validation of spec trees"""
+
+from .conftest import make_spec
+from .utils import get_builder_path
+from derex.builder import validation
+from pathlib import PosixPath
+
+import os
+import pytest
+
+
+def buildah_spec(source: str, dest: str, extra: str = "") -> str:
+    return (
+        "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+        f"source: {source}\nscripts: [script.sh]\ndest: derextests/{dest}\n" + extra
+    )
+
+
+@pytest.fixture
+def tree(tmp_path: PosixPath) -> str:
+    make_spec(tmp_path, "ok", buildah_spec("docker.io/library/alpine:3.9", "ok"))
+    make_spec(
+        tmp_path,
+        "missing",
+        buildah_spec(
+            "{type: derex-relative, path: nowhere}",
+            "missing",
+            "copy: {absent.txt: /absent.txt}\nscripts: [script.sh, absent.sh]\n",
+        ),
+    )
+    for name, other in (("loop_a", "loop_b"), ("loop_b", "loop_a")):
+        source = f"{{type: derex-relative, path: {other}}}"
+        make_spec(tmp_path, name, buildah_spec(source, name))
+    make_spec(
+        tmp_path,
+        "broken",
+        "builder: {class: derex.builder.builders.BuildahBuilder}\n"
+        "source: 12\nscripts: script.sh\n",
+    )
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_validate_tree(tree: str, jobs: int):
+    report = validation.validate_tree(validation.find_specs(tree), jobs=jobs)
+    errors = {os.path.basename(path): value for path, value in report.items()}
+    assert errors["ok"] == []
+    assert errors["missing"] == [
+        "absent.sh not found",
+        "absent.txt not found",
+        f"source nowhere: no spec.yml in {tree}/nowhere",
+    ]
+    assert errors["loop_a"] == [
+        f"dependency cycle: {tree}/loop_a -> {tree}/loop_b -> {tree}/loop_a"
+    ]
+    assert errors["loop_b"] == []
+    assert errors["broken"] == [
+        "scripts: 'script.sh' is not of type 'array'",
+        "source: 12 is not valid under any of the given schemas",
+        "spec: 'dest' is a required property",
+    ]
+
+
+def test_referenced_specs_are_checked():
+    report = validation.validate_tree([get_builder_path("rapidjson")])
+    assert sorted(map(os.path.basename, report)) == [
+        "base_rapidjson",
+        "build_rapidjson",
+        "rapidjson",
+    ]
+    assert not any(report.values())
+
+
+def test_find_cycles():
+    graph = {"a": ["b"], "b": ["c"], "c": ["a", "d"], "d": [], "e": ["e"]}
+    assert validation.find_cycles(graph) == [["a", "b", "c", "a"], ["e", "e"]]
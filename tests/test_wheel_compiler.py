@@ -7,6 +7,9 @@
 from .utils import get_builder_path
 from derex.builder.builders.base import create_builder
 from derex.builder.builders.buildah import BuildahBuilder
+from derex.builder.builders.wheel_compiler import check_installed
+from derex.builder.builders.wheel_compiler import InstallError
+from derex.builder.builders.wheel_compiler import wheel_versions
 from jsonschema.exceptions import ValidationError
 from pathlib import PosixPath
 from pytest_mock import MockFixture
@@ -28,3 +31,52 @@ def test_wheel_compiler():
         "python -c 'import rapidjson; print(rapidjson.dumps([\"foobar\"]))'",
     )
     assert res == b'["foobar"]\n'
+
+
+def test_install_exact(mocker: MockFixture, tmp_path: PosixPath):
+    compiler = create_builder(get_builder_path("rapidjson"))
+    buildah = mocker.patch(
+        "derex.builder.builders.wheel_compiler.BuildahWheelCompiler.buildah"
+    )
+    (tmp_path / "python_rapidjson-0.9.1-cp37-cp37m-linux_x86_64.whl").touch()
+    freezes = iter(["pip==19.3\n", "pip==19.3\npython-rapidjson==0.9.1\n"])
+    base_run = mocker.Mock(
+        side_effect=lambda *args: next(freezes) if "freeze" in args else ""
+    )
+    compiler.install_exact("container-id", base_run, str(tmp_path))
+
+    install = base_run.call_args_list[1][0]
+    assert install[:3] == ("pip", "install", "--no-index")
+    assert install[-2:] == ("-r", "/tmp/derex.builder.requirements/requirements.txt")
+    buildah.assert_called_with(
+        "config",
+        "--label",
+        "derex.builder.installed=python-rapidjson==0.9.1",
+        "container-id",
+    )
+
+
+def test_check_installed(tmp_path: PosixPath):
+    (tmp_path / "Foo.Bar-1.0-py3-none-any.whl").touch()
+    (tmp_path / "baz-2.0_rc1-py3-none-any.whl").touch()
+    wheels = wheel_versions(str(tmp_path))
+    check_installed({"foo-bar": "1.0", "baz": "2.0-rc1"}, wheels)
+    with pytest.raises(InstallError, match="requests==2.22.0"):
+        check_installed({"foo-bar": "1.0", "requests": "2.22.0"}, wheels)
+    with pytest.raises(InstallError, match="foo-bar==1.1"):
+        check_installed({"foo-bar": "1.1"}, wheels)
+
+
+def test_reset_builder(mocker: MockFixture):
+    compiler = create_builder(get_builder_path("rapidjson"))
+    buildah_run = mocker.patch(
+        "derex.builder.builders.wheel_compiler.BuildahWheelCompiler.buildah_run"
+    )
+    baseline = {"pip": "19.3", "wheel": "0.33.6"}
+    buildah_run.return_value = "pip==19.3\nwheel==0.33.6\npython-rapidjson==0.9.1\n"
+    assert compiler.reset_builder("container-id", baseline)
+    buildah_run.assert_called_with(
+        "container-id", ["pip", "uninstall", "--yes", "python-rapidjson"]
+    )
+    buildah_run.return_value = "pip==20.0\nwheel==0.33.6\n"
+    assert not compiler.reset_builder("container-id", baseline)
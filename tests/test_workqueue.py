@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Coordinator and workers sharing a queue directory"""
+
+from derex.builder import workqueue
+from derex.builder.builders.base import create_builder
+from pathlib import PosixPath
+from pytest_mock import MockFixture
+
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+
+@pytest.fixture(autouse=True)
+def isolated(mocker: MockFixture):
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_buildah", return_value=False
+    )
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.available_docker_registry",
+        return_value=False,
+    )
+
+
+@pytest.fixture
+def queue(tmp_path: PosixPath) -> str:
+    return str(tmp_path / "queue")
+
+
+def test_dependencies_and_claims(fork: str, queue: str):
+    ids = workqueue.submit(create_builder(fork), queue)
+    root = ids[-1]
+    ready = [job["id"] for job in workqueue.ready_jobs(queue)]
+    assert sorted(ready) == sorted(ids[:2])
+
+    job = workqueue.ready_jobs(queue)[0]
+    assert workqueue.claim(queue, job, "worker-1")
+    assert not workqueue.claim(queue, job, "worker-2")
+    assert workqueue.renew(queue, job["id"], "worker-1")
+    assert not workqueue.renew(queue, job["id"], "worker-2")
+    assert root not in [job["id"] for job in workqueue.ready_jobs(queue)]
+
+
+def test_available_images_are_queued_alone(
+    fork: str, queue: str, mocker: MockFixture
+):
+    root = create_builder(fork)
+    store = mocker.patch("derex.builder.artifact_cache.store")
+    mocker.patch(
+        "derex.builder.builders.base.BaseBuilder.locate",
+        autospec=True,
+        side_effect=lambda node: "local" if node is root else None,
+    )
+    ids = workqueue.submit(root, queue)
+    assert [job["id"] for job in workqueue.ready_jobs(queue)] == ids
+    assert len(ids) == 1
+    # Workers on other hosts load it from the artifact cache
+    store.assert_called_once_with(root, str(PosixPath(queue) / "artifacts"))
+
+
+def test_expired_leases(fork: str, queue: str, mocker: MockFixture):
+    mocker.patch("derex.builder.workqueue.MAX_ATTEMPTS", 2)
+    mocker.patch("derex.builder.workqueue.POLL_INTERVAL", 0)
+    ids = workqueue.submit(create_builder(fork), queue)
+    job = workqueue.ready_jobs(queue)[0]
+    assert workqueue.claim(queue, job, "worker-1")
+    assert workqueue.requeue_expired(queue) == []  # Still leased
+
+    # The worker died: nobody renews the lease
+    claimed = workqueue.state_path(queue, "claimed", job["id"])
+    workqueue.write_json(claimed, dict(job, worker="worker-1", expires=0))
+    assert workqueue.requeue_expired(queue) == [job["id"]]
+    mocker.patch("derex.builder.workqueue.LEASE", -1)
+    job = workqueue.read_json(workqueue.state_path(queue, "jobs", job["id"]))
+    assert workqueue.claim(queue, job, "worker-1")
+    assert workqueue.requeue_expired(queue) == [job["id"]]
+    failed = workqueue.read_json(workqueue.state_path(queue, "failed", job["id"]))
+    assert failed["attempts"] == 2
+    assert failed["errors"] == ["lease of worker-1 expired"] * 2
+    with pytest.raises(workqueue.JobFailed):
+        workqueue.wait_for(queue, ids)
+
+
+def test_failed_job_is_retried(fork: str, queue: str, mocker: MockFixture):
+    mocker.patch("derex.builder.workqueue.LEASE", 0.05)
+    mocker.patch(
+        "derex.builder.builders.buildah.BuildahBuilder.resolve",
+        side_effect=RuntimeError("boom"),
+    )
+    workqueue.submit(create_builder(fork), queue)
+    job = workqueue.ready_jobs(queue)[0]
+    assert workqueue.claim(queue, job, "worker-1")
+    workqueue.run_job(queue, job, "worker-1")
+    job = workqueue.read_json(workqueue.state_path(queue, "jobs", job["id"]))
+    assert job["attempts"] == 1
+    assert job["errors"] == ["worker-1: RuntimeError: boom"]
+    assert workqueue.list_jobs(queue, "claimed") == []
+
+
+def test_lease_lost_while_resolving(fork: str, queue: str, mocker: MockFixture):
+    mocker.patch("derex.builder.artifact_cache.store")
+    resolve = mocker.patch("derex.builder.builders.buildah.BuildahBuilder.resolve")
+    workqueue.submit(create_builder(fork), queue)
+    for error in (None, RuntimeError("boom")):
+        job = workqueue.ready_jobs(queue)[0]
+        claimed = workqueue.state_path(queue, "claimed", job["id"])
+        assert workqueue.claim(queue, job, "worker-1")
+
+        def expire_and_reclaim():
+            # The lease expires, the job is requeued and another worker takes it
+            workqueue.write_json(claimed, dict(job, worker="worker-1", expires=0))
+            assert workqueue.requeue_expired(queue) == [job["id"]]
+            requeued = workqueue.state_path(queue, "jobs", job["id"])
+            assert workqueue.claim(queue, workqueue.read_json(requeued), "worker-2")
+            if error is not None:
+                raise error
+
+        resolve.side_effect = expire_and_reclaim
+        workqueue.run_job(queue, job, "worker-1")
+        # The outcome is dropped, the claim of worker-2 is left alone
+        assert workqueue.read_json(claimed)["worker"] == "worker-2"
+        assert workqueue.list_jobs(queue, "done") == []
+        assert job["id"] not in workqueue.list_jobs(queue, "jobs")
+        os.rename(claimed, workqueue.state_path(queue, "jobs", job["id"]))
+
+
+WORKER = """
+import sys, time
+from derex.builder import workqueue
+from derex.builder.builders.base import BaseBuilder
+
+workqueue.POLL_INTERVAL = 0.05
+workqueue.artifact_cache.store = lambda builder, directory=None: None
+BaseBuilder.available_buildah = lambda self, refresh=False: False
+
+def resolve(self):
+    with open(sys.argv[2], "a") as log:
+        log.write(self.dest + " start\\n")
+    time.sleep(0.2)
+    with open(sys.argv[2], "a") as log:
+        log.write(self.dest + " end\\n")
+
+BaseBuilder.resolve = resolve
+workqueue.work(sys.argv[1], exit_when_idle=True)
+"""
+
+
+def test_worker_processes(fork: str, queue: str, tmp_path: PosixPath):
+    root = create_builder(fork)
+    ids = workqueue.submit(root, queue)
+    log = tmp_path / "log"
+    workers = [
+        subprocess.Popen([sys.executable, "-c", WORKER, queue, str(log)])
+        for _ in range(3)
+    ]
+    workqueue.wait_for(queue, ids, timeout=30)
+    assert [worker.wait(timeout=30) for worker in workers] == [0, 0, 0]
+
+    events = log.read_text().splitlines()
+    assert sorted(events) == sorted(
+        f"{node.dest} {event}"
+        for node in (root, *root.dependencies())
+        for event in ("start", "end")
+    )
+    # The root only starts after both its dependencies are done
+    assert events.index(f"{root.dest} start") == 4
+    for job_id in ids:
+        done = workqueue.state_path(queue, "done", job_id)
+        assert json.load(open(done))["worker"]